@@ -36,18 +36,41 @@ LOG = logging.getLogger('MQ2')
 __version__ = '1.1.0'
 
 
-def set_tmp_folder():
+# Suffix of the temporary folders created by MQ², used to recognize the
+# folders MQ² may remove once it is done with them.
+TMP_SUFFIX = '_mq2tmp'
+
+
+def set_tmp_folder(basedir=None):
     """ Create a temporary folder using the current time in which
     the zip can be extracted and which should be destroyed afterward.
+    The folder is created atomically with a unique name so that several
+    runs started at the same time never share it.
+
+    :kwarg basedir: the folder in which to create the temporary folder,
+        defaults to the system temporary folder.
+
     """
     output = "%s" % datetime.datetime.now()
     for char in [' ', ':', '.', '-']:
         output = output.replace(char, '')
     output.strip()
-    tmp_folder = os.path.join(tempfile.gettempdir(), output)
+    tmp_folder = tempfile.mkdtemp(
+        prefix='%s_' % output, suffix=TMP_SUFFIX, dir=basedir)
     return tmp_folder
 
 
+def is_tmp_folder(folder):
+    """ Return whether the provided folder is a temporary folder created
+    by :func:`set_tmp_folder`.
+
+    :arg folder: the path to the folder to check.
+
+    """
+    return bool(folder) and os.path.isdir(folder) \
+        and os.path.basename(os.path.normpath(folder)).endswith(TMP_SUFFIX)
+
+
 def extract_zip(filename, extract_dir):
     """ Extract the sources in a temporary folder.
     :arg filename, name of the zip file containing the data from MapQTL
@@ -100,9 +123,11 @@ def get_matrix_dimensions(filename):
     stream = None
     try:
         stream = open(filename, 'r')
-        length = len(stream.readlines())
-        stream.seek(0)
         width = len(stream.readline().split(','))
+        stream.seek(0)
+        length = 0
+        for row in stream:
+            length += 1
         return (length, width)
     except IOError as err:  # pragma: no cover
         LOG.info("Something wrong happend while reading the file %s "
@@ -185,3 +210,10 @@ class MQ2NoSuchSessionException(MQ2Exception):
     the session identifier provided by the user.
     """
     pass
+
+
+class MQ2QueueFullException(MQ2Exception):
+    """ Exception raised when a job is submitted to the MQ² service while
+    its queue is already full.
+    """
+    pass
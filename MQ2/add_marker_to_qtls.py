@@ -28,9 +28,12 @@ MQ2, code to add the closest marker to a specified location
     (ie: QTL peak).
 """
 
+import bisect
 import logging
+import math
 
 from MQ2 import read_input_file, write_matrix
+from MQ2.catalog import Catalog
 
 LOG = logging.getLogger('MQ2')
 
@@ -55,7 +58,92 @@ def add_marker_to_qtl(qtl, map_list):
     return closest
 
 
-def add_marker_to_qtls(qtlfile, mapfile, outputfile='qtls_with_mk.csv'):
+def _get_group_index(catalog, groups, positions):
+    """ Return, for each linkage group of the catalog, the sorted positions
+    of its markers and, for each of these positions, the index of the
+    first marker of the map at it. The markers without position are left
+    out.
+    """
+    index = [{} for group in catalog.groups]
+    for cnt, (group, position) in enumerate(zip(groups, positions)):
+        if not math.isnan(position):
+            index[group].setdefault(position, cnt)
+    output = []
+    for group in index:
+        keys = sorted(group)
+        output.append((keys, [group[key] for key in keys]))
+    return output
+
+
+def _get_closest(keys, rows, position):
+    """ Return the index of the closest marker of a linkage group to the
+    given position, the first in the map if several are as close, as
+    :func:`add_marker_to_qtl` does.
+
+    :arg keys: the sorted positions of the markers of the linkage group.
+    :arg rows: the index of the first marker at each of these positions.
+    :arg position: the position of the QTL.
+
+    """
+    closest = diff = None
+    cnt = bisect.bisect_left(keys, position)
+    # The positions as close as the nearest one on each side
+    for candidates in (range(cnt - 1, -1, -1), range(cnt, len(keys))):
+        side_diff = None
+        for cnt2 in candidates:
+            tmp_diff = abs(position - keys[cnt2])
+            if side_diff is not None and tmp_diff != side_diff:
+                break
+            side_diff = tmp_diff
+            if diff is None or tmp_diff < diff \
+                    or (tmp_diff == diff and rows[cnt2] < closest):
+                diff = tmp_diff
+                closest = rows[cnt2]
+    return closest
+
+
+def add_marker_to_qtl_list(qtl_list, map_list, catalog=None):
+    """ Return the list of QTLs with, for each of them, the closest
+    marker to the QTL peak appended.
+
+    The markers and linkage groups of the map are encoded once with the
+    catalog and the markers of each linkage group sorted by position, the
+    closest marker of each QTL is then found by bisection instead of
+    comparing the QTL to all the markers, as :func:`add_marker_to_qtl`
+    does.
+
+    :arg qtl_list: the list of QTLs, the first row being the headers.
+        Each row should be structured as follow::
+            Trait, Linkage group, position, other columns
+    :arg map_list: the genetic map, the first row being the headers and
+        each other row being structured as follow::
+            Marker, Linkage group, position
+    :kwarg catalog: the :class:`~MQ2.catalog.Catalog` of the run, a new
+        one is used if not specified.
+
+    """
+    catalog = catalog or Catalog()
+    markers, groups, positions = catalog.encode_map(map_list[1:])
+    index = _get_group_index(catalog, groups, positions)
+    qtls = []
+    qtls.append(list(qtl_list[0]) + ['Closest marker'])
+    for qtl in qtl_list[1:]:
+        qtl = list(qtl)
+        group = catalog.get_group(qtl[1])
+        closest = None
+        if group is not None:
+            closest = _get_closest(index[group][0], index[group][1],
+                                   float(qtl[2]))
+        if closest is None:
+            qtl.append('')
+        else:
+            qtl.append(catalog.markers[markers[closest]])
+        qtls.append(qtl)
+    return qtls
+
+
+def add_marker_to_qtls(qtlfile, mapfile, outputfile='qtls_with_mk.csv',
+                       catalog=None):
     """This function adds to a list of QTLs, the closest marker to the
     QTL peak.
 
@@ -71,17 +159,13 @@ def add_marker_to_qtls(qtlfile, mapfile, outputfile='qtls_with_mk.csv'):
             Marker, Linkage group, position
     :kwarg outputfile: the name of the output file in which the list of
         QTLs with their closest marker will be written.
+    :kwarg catalog: the :class:`~MQ2.catalog.Catalog` of the run.
 
     """
     qtl_list = read_input_file(qtlfile, ',')
     map_list = read_input_file(mapfile, ',')
     if not qtl_list or not map_list:  # pragma: no cover
         return
-    qtl_list[0].append('Closest marker')
-    qtls = []
-    qtls.append(qtl_list[0])
-    for qtl in qtl_list[1:]:
-        qtl.append(add_marker_to_qtl(qtl, map_list))
-        qtls.append(qtl)
+    qtls = add_marker_to_qtl_list(qtl_list, map_list, catalog=catalog)
     LOG.info('- %s QTLs processed in %s' % (len(qtls), qtlfile))
     write_matrix(outputfile, qtls)
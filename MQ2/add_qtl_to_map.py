@@ -28,9 +28,14 @@ MQ2, code to add the number of significant QTLs found for each position
     of the genetic map.
 """
 
+import array
+import bisect
+import itertools
 import logging
+import math
 
 from MQ2 import read_input_file, write_matrix
+from MQ2.catalog import Catalog
 
 LOG = logging.getLogger('MQ2')
 
@@ -51,7 +56,118 @@ def add_qtl_to_marker(marker, qtls):
     return marker
 
 
-def add_qtl_to_map(qtlfile, mapfile, outputfile='map_with_qtls.csv'):
+def add_qtl_to_map_list(qtl_list, map_list, catalog=None):
+    """ Return the genetic map with, for each marker, the number of
+    significant QTLs found appended.
+
+    The closest markers of the QTLs are encoded with the catalog and
+    counted once, each marker of the map then gets the count of its code
+    instead of comparing it to all the QTLs, as :func:`add_qtl_to_marker`
+    does.
+
+    :arg qtl_list: the list of QTLs, the first row being the headers
+        and the last column the closest marker of each QTL.
+    :arg map_list: the genetic map with all the markers, the first row
+        being the headers.
+    :kwarg catalog: the :class:`~MQ2.catalog.Catalog` of the run, a new
+        one is used if not specified.
+
+    """
+    catalog = catalog or Catalog()
+    codes = catalog.encode_map(map_list[1:])[0]
+    counts = array.array('l', [0] * len(catalog.markers))
+    for qtl in qtl_list[1:]:
+        code = catalog.get_marker(qtl[-1])
+        if code is not None:
+            counts[code] += 1
+
+    markers = []
+    markers.append(list(map_list[0]) + ['# QTLs'])
+    for marker, code in zip(map_list[1:], codes):
+        markers.append(list(marker) + [str(counts[code])])
+    return markers
+
+
+def add_qtl_intervals_to_map_list(qtl_list, map_list, catalog=None):
+    """ Return the genetic map with, for each marker, the number of
+    significant QTLs whose LOD2 interval covers it appended.
+
+    The markers of each linkage group are sorted by position once, the
+    bounds of each interval are then found by bisection and the counts
+    obtained by sweeping over the markers, adding one at the start of each
+    interval and removing one after its end. The cost is thus
+    O((n + m) log m) for n QTLs and m markers.
+    The QTLs without interval (``NA``) are credited to their closest
+    marker only.
+
+    :arg qtl_list: the list of QTLs, the first row being the headers and
+        the last three columns the closest marker, the start and the end
+        of the LOD2 interval of each QTL (see
+        :func:`MQ2.mapchart.append_flanking_markers`).
+    :arg map_list: the genetic map with all the markers, the first row
+        being the headers.
+    :kwarg catalog: the :class:`~MQ2.catalog.Catalog` of the run, a new
+        one is used if not specified.
+
+    """
+    catalog = catalog or Catalog()
+    rows = [list(row) for row in map_list[1:]]
+    codes, groups, positions = catalog.encode_map(rows)
+    nr_groups = len(catalog.groups)
+    # Row of the first marker of each (marker, linkage group) code
+    index = {}
+    members = [[] for group in catalog.groups]
+    for cnt, (code, group, position) in enumerate(
+            zip(codes, groups, positions)):
+        index.setdefault(code * nr_groups + group, cnt)
+        if not math.isnan(position):
+            members[group].append((position, cnt))
+
+    sweeps = []
+    for markers in members:
+        markers.sort()
+        sweeps.append(([position for position, cnt in markers],
+                       [cnt for position, cnt in markers],
+                       [0] * (len(markers) + 1)))
+
+    def get_row(marker, group):
+        """ Return the row of the marker on the linkage group. """
+        code = catalog.get_marker(marker)
+        if code is None:
+            return None
+        return index.get(code * nr_groups + group)
+
+    counts = [0] * len(rows)
+    for qtl in qtl_list[1:]:
+        group = catalog.get_group(qtl[1])
+        if group is None:
+            continue
+        start = get_row(qtl[-2], group)
+        stop = get_row(qtl[-1], group)
+        if not members[group] or start is None or stop is None \
+                or math.isnan(positions[start]) \
+                or math.isnan(positions[stop]):
+            closest = get_row(qtl[-3], group)
+            if closest is not None:
+                counts[closest] += 1
+            continue
+        group_positions, order, deltas = sweeps[group]
+        start, stop = sorted([positions[start], positions[stop]])
+        deltas[bisect.bisect_left(group_positions, start)] += 1
+        deltas[bisect.bisect_right(group_positions, stop)] -= 1
+
+    for group_positions, order, deltas in sweeps:
+        for cnt, covered in zip(order, itertools.accumulate(deltas)):
+            counts[cnt] += covered
+
+    markers = [list(map_list[0]) + ['# QTLs']]
+    for row, count in zip(rows, counts):
+        markers.append(row + [str(count)])
+    return markers
+
+
+def add_qtl_to_map(qtlfile, mapfile, outputfile='map_with_qtls.csv',
+                   intervals=False, catalog=None):
     """ This function adds to a genetic map for each marker the number
     of significant QTLs found.
 
@@ -60,17 +176,23 @@ def add_qtl_to_map(qtlfile, mapfile, outputfile='map_with_qtls.csv'):
     :arg mapfile, the genetic map with all the markers.
     :kwarg outputfile, the name of the output file in which the map will
         be written.
+    :kwarg intervals, whether to credit each QTL to all the markers of its
+        LOD2 interval instead of its closest marker only, see
+        :func:`add_qtl_intervals_to_map_list`. The QTL file must then
+        contain the flanking markers.
+    :kwarg catalog, the :class:`~MQ2.catalog.Catalog` of the run.
 
     """
     qtl_list = read_input_file(qtlfile, ',')
     map_list = read_input_file(mapfile, ',')
-    map_list[0].append('# QTLs')
-    markers = []
-    markers.append(map_list[0])
+    if intervals:
+        markers = add_qtl_intervals_to_map_list(qtl_list, map_list,
+                                                catalog=catalog)
+    else:
+        markers = add_qtl_to_map_list(qtl_list, map_list, catalog=catalog)
     qtl_cnt = 0
-    for marker in map_list[1:]:
-        markers.append(add_qtl_to_marker(marker, qtl_list[1:]))
-        qtl_cnt = qtl_cnt + int(markers[-1][-1])
+    for marker in markers[1:]:
+        qtl_cnt = qtl_cnt + int(marker[-1])
     LOG.info('- %s markers processed in %s' % (len(markers), mapfile))
     LOG.info('- %s QTLs located in the map: %s' % (qtl_cnt, outputfile))
     write_matrix(outputfile, markers)
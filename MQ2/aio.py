@@ -0,0 +1,220 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 asyncio API, runs MQ² without blocking the event loop.
+
+The extraction of the archive and the run itself, the synchronous
+:func:`MQ2.mq2.run_mq2` with all its options, are ran in a thread or, if
+given a :class:`concurrent.futures.ProcessPoolExecutor`, in a child
+process so that the parsing and the counting of the QTLs do not hold the
+GIL of the event loop. The progress of the run is reported stage by stage
+and the run can be cancelled between two stages by cancelling the task::
+
+    plugin, folder = await get_plugin_and_folder(inputzip='data.zip')
+    task = asyncio.ensure_future(run_mq2(
+        plugin, folder, lod_threshold=3, session=2,
+        outputfolder='results', progress=callback))
+
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+
+from MQ2 import MQ2Exception, is_tmp_folder
+from MQ2 import mq2
+
+
+LOG = logging.getLogger('MQ2')
+
+# Time, in seconds, after which the event loop checks whether the child
+# process of a run stopped without sending its last event
+EVENT_TIMEOUT = 0.1
+
+
+class _RunCancelled(Exception):
+    """ Raised in the thread or the process running a cancelled run to
+    stop it before its next stage.
+    """
+
+
+async def get_plugin_and_folder(inputzip=None, inputdir=None,
+                                inputfile=None, extract_dir=None):
+    """ Asynchronous version of :func:`MQ2.mq2.get_plugin_and_folder`,
+    the archive is extracted and the plugins check the files in a thread.
+    """
+    return await asyncio.to_thread(
+        mq2.get_plugin_and_folder, inputzip=inputzip, inputdir=inputdir,
+        inputfile=inputfile, extract_dir=extract_dir)
+
+
+async def _notify(progress, event):
+    """ Send the event to the progress callback, awaiting it if it is a
+    coroutine function.
+    """
+    if progress is None:
+        return
+    output = progress(event)
+    if inspect.isawaitable(output):
+        await output
+
+
+def _run_in_process(plugin_name, folder, events, acks, cancelled, kwargs):
+    """ Run :func:`MQ2.mq2.run_mq2` in a child process, sending each
+    event of the run to the event loop through the ``events`` queue and
+    waiting for the progress callback to be done with it, ``None`` being
+    sent once the run is finished.
+
+    :arg plugin_name: the name of the plugin used, the plugins are loaded
+        again in the child process.
+    :arg events: the queue of the events sent to the event loop.
+    :arg acks: the queue in which the event loop acknowledges them.
+    :arg cancelled: the event set when the run is cancelled.
+    :arg kwargs: the keyword arguments of the run.
+
+    """
+    plugins = [plugin for plugin in mq2.load_plugins()
+               if plugin.name == plugin_name]
+    if not plugins:
+        raise MQ2Exception('Plugin not found: "%s"' % plugin_name)
+
+    def notify(event):
+        """ Send the event to the event loop, stopping the run if it was
+        cancelled.
+        """
+        if cancelled.is_set():
+            raise _RunCancelled()
+        events.put(event)
+        acks.get()
+        if cancelled.is_set() and event['status'] == 'started':
+            raise _RunCancelled()
+
+    try:
+        return mq2.run_mq2(plugins[0], folder, cleanup=False,
+                           progress=notify, **kwargs)
+    finally:
+        events.put(None)
+
+
+async def _run_process(executor, plugin, folder, progress, stopped,
+                       kwargs):
+    """ Run :func:`MQ2.mq2.run_mq2` in the given process executor,
+    sending the events of the run to the progress callback until the run
+    is stopped.
+    """
+    loop = asyncio.get_running_loop()
+    with multiprocessing.Manager() as manager:
+        events = manager.Queue()
+        acks = manager.Queue()
+        cancelled = manager.Event()
+        future = loop.run_in_executor(executor, _run_in_process,
+                                      plugin.name, folder, events, acks,
+                                      cancelled, kwargs)
+        while True:
+            try:
+                event = await asyncio.to_thread(
+                    events.get, True, EVENT_TIMEOUT)
+            except queue.Empty:
+                if future.done():
+                    break
+                continue
+            if event is None:
+                break
+            if not stopped.is_set():
+                await _notify(progress, event)
+            if stopped.is_set():
+                cancelled.set()
+            acks.put(True)
+        return await future
+
+
+async def run_mq2(plugin, folder, cleanup=None, executor=None,
+                  progress=None, **kwargs):
+    """ Asynchronous version of :func:`MQ2.mq2.run_mq2`, the other keyword
+    arguments are those of the synchronous version.
+
+    :kwarg executor: the :class:`concurrent.futures.ThreadPoolExecutor`
+        or :class:`concurrent.futures.ProcessPoolExecutor` in which to
+        run the run, by default the executor of the event loop. In a
+        process, the plugins are loaded again and the other keyword
+        arguments must be picklable.
+    :kwarg progress: a callable, or coroutine function, called in the
+        event loop with a dictionary describing each event of the run:
+        ``stage`` (its name), ``index`` and ``total`` (position of the
+        stage in the run) and ``status`` (``started`` or ``done``), see
+        :func:`~MQ2.scheduler.run_stages`.
+
+    If the task running this coroutine is cancelled, no other stage is
+    started, the stages running are waited for and the input folder is
+    then removed if it is a temporary folder.
+
+    """
+    loop = asyncio.get_running_loop()
+    if cleanup is None:
+        cleanup = is_tmp_folder(folder)
+    cancelled = threading.Event()
+
+    def notify(event):
+        """ Send the event to the progress callback in the event loop,
+        stopping the run if it was cancelled.
+        """
+        if cancelled.is_set():
+            raise _RunCancelled()
+        asyncio.run_coroutine_threadsafe(
+            _notify(progress, event), loop).result()
+        if cancelled.is_set() and event['status'] == 'started':
+            raise _RunCancelled()
+
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        future = asyncio.ensure_future(_run_process(
+            executor, plugin, folder, progress, cancelled, kwargs))
+    else:
+        future = loop.run_in_executor(executor, functools.partial(
+            mq2.run_mq2, plugin, folder, cleanup=False, progress=notify,
+            **kwargs))
+    try:
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            LOG.debug('Run cancelled, waiting for the stages running')
+            cancelled.set()
+            try:
+                await future
+            except _RunCancelled:
+                pass
+            raise
+    finally:
+        if cleanup and folder and os.path.isdir(folder):
+            await asyncio.to_thread(
+                functools.partial(shutil.rmtree, folder,
+                                  ignore_errors=True))
@@ -0,0 +1,173 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 in-memory analysis, runs the MQ² pipeline on data already loaded in
+    memory and returns the results without touching the filesystem.
+"""
+
+import logging
+import os
+
+from MQ2 import MQ2Exception, write_matrix
+from MQ2.add_marker_to_qtls import add_marker_to_qtl_list
+from MQ2.add_qtl_to_map import add_qtl_to_map_list
+from MQ2.catalog import Catalog
+from MQ2.mapchart import (get_map_chart_data, format_map_chart,
+                          add_flanking_markers)
+from MQ2.mq2 import OUTPUT_FILES, add_count_to_matrix
+from MQ2.plugins.csv_plugin import (get_qtls_from_rqtl_data,
+                                    get_map_from_matrix)
+
+
+LOG = logging.getLogger('MQ2')
+
+
+def _to_rows(data):
+    """ Return the provided matrix as a list of rows of strings, the
+    same way they would be read back from a CSV file.
+    The data may be a list of rows (lists or tuples) or a pandas
+    DataFrame whose columns are the headers.
+    """
+    if hasattr(data, 'columns') and hasattr(data, 'itertuples'):
+        rows = [list(data.columns)]
+        rows.extend([list(row) for row in data.itertuples(index=False)])
+    else:
+        rows = [list(row) for row in data]
+    output = []
+    for row in rows:
+        output.append(['' if cel is None else str(cel).strip()
+                       for cel in row])
+    return output
+
+
+class MQ2Result(object):
+    """ The results of an analysis ran by :func:`analyze`.
+
+    :attr qtls: the list of the significant QTLs, the first row being the
+        headers: ``trait, linkage group, position, marker, LOD, closest
+        marker, LOD2 interval start, LOD2 interval end``.
+    :attr map_with_qtls: the genetic map with for each marker the number
+        of QTLs whose peak is the closest to it, the first row being the
+        headers.
+    :attr matrix: the QTL matrix with an extra column containing for each
+        row the number of LOD values above the threshold.
+    :attr genetic_map: the genetic map used.
+    :attr map_chart: the content of the MapChart input file.
+
+    """
+
+    def __init__(self, qtls, map_with_qtls, matrix, genetic_map,
+                 map_chart):
+        """ Constructor. """
+        self.qtls = qtls
+        self.map_with_qtls = map_with_qtls
+        self.matrix = matrix
+        self.genetic_map = genetic_map
+        self.map_chart = map_chart
+
+    def get_hotspots(self):
+        """ Return a dictionary associating each marker of the genetic
+        map to the number of QTLs found on it.
+        """
+        return dict([(row[0], int(row[-1]))
+                     for row in self.map_with_qtls[1:]])
+
+    def write(self, outputfolder):
+        """ Write the results in the given folder, using the same file
+        names as :func:`MQ2.mq2.run_mq2`.
+        The list of QTLs without the markers (``qtls.csv``) is not
+        written.
+        """
+        write_matrix(os.path.join(outputfolder, OUTPUT_FILES['qtls_mk']),
+                     self.qtls)
+        write_matrix(os.path.join(outputfolder, OUTPUT_FILES['map_qtl']),
+                     self.map_with_qtls)
+        write_matrix(os.path.join(outputfolder, OUTPUT_FILES['matrix']),
+                     self.matrix)
+        write_matrix(os.path.join(outputfolder, OUTPUT_FILES['map']),
+                     self.genetic_map)
+        stream = open(
+            os.path.join(outputfolder, OUTPUT_FILES['map_chart']), 'w')
+        try:
+            stream.write(self.map_chart)
+        finally:
+            stream.close()
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the MQ2Result object. """
+        return 'MQ2Result<qtls: %s, markers: %s>' % (
+            len(self.qtls) - 1, len(self.map_with_qtls) - 1)
+
+
+def analyze(matrix, genetic_map=None, lod_threshold=3):
+    """ Run the MQ² analysis on the given QTL matrix and return a
+    :class:`MQ2Result`.
+
+    :arg matrix: the QTL matrix, either as a list of rows or as a pandas
+        DataFrame. The first row (or the columns of the DataFrame) are
+        the headers, then each row is of type:
+        ``marker, linkage group, position, trait1 lod, trait2 lod...``
+    :kwarg genetic_map: the genetic map as a list of
+        ``marker, linkage group, position`` rows, with or without
+        headers. If not provided, it is built from the rows of the matrix
+        which are not pseudo-markers.
+    :kwarg lod_threshold: threshold used to determine if a given LOD
+        value is reflective the presence of a QTL.
+
+    """
+    try:
+        lod_threshold = float(lod_threshold)
+    except (TypeError, ValueError):
+        raise MQ2Exception('LOD threshold should be a number')
+
+    matrix = _to_rows(matrix)
+    if len(matrix) < 2 or len(matrix[0]) < 4:
+        raise MQ2Exception('The matrix should contain a header row and '
+                           'at least one trait column')
+
+    if genetic_map is None:
+        genetic_map = get_map_from_matrix(matrix[1:])
+    else:
+        genetic_map = _to_rows(genetic_map)
+        try:
+            float(genetic_map[0][2])
+            genetic_map.insert(0, ['Locus', 'Group', 'Position'])
+        except (IndexError, ValueError):
+            pass
+
+    qtls = get_qtls_from_rqtl_data(matrix, lod_threshold)
+    qtls = _to_rows(qtls)
+    catalog = Catalog()
+    qtls = add_marker_to_qtl_list(qtls, genetic_map, catalog=catalog)
+    map_with_qtls = add_qtl_to_map_list(qtls, genetic_map, catalog=catalog)
+    matrix = add_count_to_matrix(matrix, lod_threshold)
+    lines, flanking_markers = format_map_chart(
+        get_map_chart_data(matrix, lod_threshold))
+    qtls = add_flanking_markers(qtls, flanking_markers)
+    LOG.info('- %s QTLs found in memory' % (len(qtls) - 1))
+
+    return MQ2Result(qtls, map_with_qtls, matrix, genetic_map,
+                     ''.join(lines))
@@ -0,0 +1,297 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 result cache, keeps the output of the runs in a local folder indexed
+    by the hash of their input and settings so that identical runs are
+    restored instead of being computed again.
+"""
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+try:  # pragma: no cover
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on Windows
+    fcntl = None
+
+from MQ2 import __version__
+
+
+LOG = logging.getLogger('MQ2')
+
+# Default maximum size of the cache: 1GB
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# File of an entry listing the outputs stored in it
+OUTPUTS_FILE = '.outputs.json'
+
+# Suffix of the temporary folders in which the entries are written
+TMP_SUFFIX = '.tmp'
+
+# Time, in seconds, after which a temporary folder left untouched is
+# considered to be left over by an interrupted process: 1 hour
+STALE_TMP_AGE = 60 * 60
+
+
+def _hash_file(checksum, filename):
+    """ Add the content of the given file to the checksum. """
+    with open(filename, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            checksum.update(chunk)
+
+
+def _get_size(folder):
+    """ Return the size of the files in the given folder. """
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for filename in files:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:  # pragma: no cover
+                pass
+    return size
+
+
+class ResultCache(object):
+    """ A folder containing the output of previous runs.
+
+    Each entry is a sub-folder named after the key of the run, see
+    :meth:`get_key`, containing the outputs of the run and the list of
+    these outputs. Entries are written in a temporary folder and then
+    renamed, so that other processes never see a partial entry. The
+    modification time of an entry is updated each time it is restored
+    and the least recently used entries are removed when the cache grows
+    over its maximum size, entries being restored while holding a shared
+    lock and removed while holding an exclusive one.
+
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        """ Constructor.
+
+        :arg cache_dir: the folder containing the cache, created if
+            needed.
+        :kwarg max_size: the maximum size of the cache in bytes.
+
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(plugin, folder, session=None, lod_threshold=None,
+                settings=None):
+        """ Return the key identifying a run: the SHA256 hash of its
+        input files, plugin, session, LOD threshold, other settings and
+        the version of MQ².
+
+        :arg plugin: the plugin used for the run.
+        :arg folder: the folder or file given as input.
+        :kwarg session: the session analyzed.
+        :kwarg lod_threshold: the LOD threshold used.
+        :kwarg settings: a dictionary of any other settings which
+            influence the output of the run.
+
+        """
+        checksum = hashlib.sha256()
+        header = {
+            'version': __version__,
+            'plugin': plugin.name,
+            'session': None if session is None else '%s' % session,
+            'lod_threshold': None if lod_threshold is None
+            else '%s' % lod_threshold,
+            'settings': settings or {},
+        }
+        checksum.update(json.dumps(header, sort_keys=True).encode('utf-8'))
+        if os.path.isdir(folder):
+            filenames = []
+            for root, dirs, files in os.walk(folder):
+                for filename in files:
+                    filenames.append(os.path.relpath(
+                        os.path.join(root, filename), folder))
+            for filename in sorted(filenames):
+                checksum.update(filename.encode('utf-8') + b'\0')
+                _hash_file(checksum, os.path.join(folder, filename))
+                checksum.update(b'\0')
+        else:
+            _hash_file(checksum, folder)
+        return checksum.hexdigest()
+
+    def _get_path(self, key):
+        """ Return the path to the entry of the given key. """
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _get_outputs(self, path):
+        """ Return the names of the outputs stored in the entry of the
+        given path, None if the entry is incomplete.
+        """
+        try:
+            with open(os.path.join(path, OUTPUTS_FILE)) as stream:
+                outputs = json.load(stream)
+        except (IOError, OSError, ValueError):
+            return None
+        for name in outputs:
+            if not os.path.isfile(os.path.join(path, name)):
+                LOG.debug('Output %s missing from the cache entry %s'
+                          % (name, path))
+                return None
+        return outputs
+
+    def restore(self, key, files):
+        """ Copy the output files of the entry of the given key to their
+        destination. Returns whether the entry was found and restored,
+        False if it does not exist or if any of the outputs recorded in
+        it is missing.
+
+        :arg key: the key of the run, see :meth:`get_key`.
+        :arg files: a dictionary associating the name of each output
+            (see :data:`MQ2.mq2.OUTPUT_FILES`) to its destination.
+
+        """
+        path = self._get_path(key)
+        with self._lock(shared=True):
+            outputs = self._get_outputs(path)
+            if outputs is None:
+                return False
+            try:
+                os.utime(path)
+                for name in outputs:
+                    if name in files:
+                        shutil.copyfile(os.path.join(path, name),
+                                        files[name])
+            except (IOError, OSError) as err:  # pragma: no cover
+                LOG.debug('Could not restore %s from the cache: %s'
+                          % (key, err))
+                return False
+        LOG.info('Results restored from the cache (%s)' % key)
+        return True
+
+    def store(self, key, files):
+        """ Add the output files of a run to the cache.
+
+        :arg key: the key of the run, see :meth:`get_key`.
+        :arg files: a dictionary associating the name of each output
+            (see :data:`MQ2.mq2.OUTPUT_FILES`) to its location.
+
+        """
+        path = self._get_path(key)
+        if os.path.isdir(path) and self._get_outputs(path) is not None:
+            return
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(
+            prefix='.%s' % key[:8], suffix=TMP_SUFFIX, dir=parent)
+        try:
+            outputs = []
+            for name, source in files.items():
+                if os.path.exists(source):
+                    shutil.copyfile(source, os.path.join(tmp_path, name))
+                    outputs.append(name)
+            with open(os.path.join(tmp_path, OUTPUTS_FILE), 'w') as stream:
+                json.dump(sorted(outputs), stream)
+            with self._lock():
+                if os.path.isdir(path) \
+                        and self._get_outputs(path) is None:
+                    # Incomplete entry, replaced
+                    shutil.rmtree(path, ignore_errors=True)
+                os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        LOG.info('Results stored in the cache (%s)' % key)
+        self.evict()
+
+    @contextlib.contextmanager
+    def _lock(self, shared=False):
+        """ Hold a lock on the cache: an exclusive one while removing
+        entries so that concurrent processes do not remove the same
+        entries, a shared one while restoring an entry so that it is not
+        removed in the meantime.
+        """
+        if fcntl is None:  # pragma: no cover
+            yield
+            return
+        with open(os.path.join(self.cache_dir, '.lock'), 'a') as stream:
+            fcntl.flock(stream, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(stream, fcntl.LOCK_UN)
+
+    def evict(self):
+        """ Remove the least recently used entries until the size of the
+        cache is below its maximum size, as well as the temporary folders
+        left over by the processes interrupted while storing an entry.
+        """
+        with self._lock():
+            entries = []
+            now = time.time()
+            for prefix in os.listdir(self.cache_dir):
+                prefix = os.path.join(self.cache_dir, prefix)
+                if not os.path.isdir(prefix):
+                    continue
+                for entry in os.listdir(prefix):
+                    if entry.startswith('.'):
+                        if entry.endswith(TMP_SUFFIX):
+                            self._remove_stale(
+                                os.path.join(prefix, entry), now)
+                        continue
+                    entry = os.path.join(prefix, entry)
+                    try:
+                        entries.append((os.path.getmtime(entry),
+                                        _get_size(entry), entry))
+                    except OSError:  # pragma: no cover
+                        pass
+            entries.sort()
+            size = sum([entry[1] for entry in entries])
+            while entries and size > self.max_size:
+                mtime, entry_size, entry = entries.pop(0)
+                LOG.info('Evicting %s from the cache' % entry)
+                shutil.rmtree(entry, ignore_errors=True)
+                size -= entry_size
+
+    @staticmethod
+    def _remove_stale(tmp_path, now):
+        """ Remove the given temporary folder if it was not modified for
+        :data:`STALE_TMP_AGE` seconds, the entries still being written
+        are kept.
+        """
+        try:
+            if now - os.path.getmtime(tmp_path) < STALE_TMP_AGE:
+                return
+        except OSError:  # pragma: no cover
+            return
+        LOG.info('Removing %s left over in the cache' % tmp_path)
+        shutil.rmtree(tmp_path, ignore_errors=True)
@@ -0,0 +1,142 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 marker catalog, assigns integer codes to the names of the markers
+    and to the linkage groups of a run.
+
+The stages joining the QTLs to the genetic map (closest marker, number of
+QTLs per marker) encode the names of the markers and the linkage groups
+once, with the catalog of the run, and then compare and index integers
+instead of strings. The names are only decoded when the output files are
+written. The codes are given in the order in which the names are first
+seen and are stable for the whole run.
+"""
+
+import array
+import logging
+
+
+LOG = logging.getLogger('MQ2')
+
+
+def _to_position(value):
+    """ Return the position of a marker as a float, NaN if the position
+    is not a number.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class Catalog(object):
+    """ The integer codes of the markers and of the linkage groups of a
+    run, see the documentation of the module.
+
+    :attr markers: the name of each marker, indexed by its code.
+    :attr groups: the name of each linkage group, indexed by its code.
+
+    """
+
+    def __init__(self):
+        """ Constructor, creates an empty catalog. """
+        self.markers = []
+        self.groups = []
+        self._marker_codes = {}
+        self._group_codes = {}
+
+    @classmethod
+    def from_dict(cls, info):
+        """ Return the catalog saved with :meth:`to_dict`. """
+        catalog = cls()
+        for name in info['markers']:
+            catalog.add_marker(name)
+        for name in info['groups']:
+            catalog.add_group(name)
+        return catalog
+
+    def to_dict(self):
+        """ Return the catalog as a dictionary which can be saved as JSON.
+        """
+        return {'markers': self.markers, 'groups': self.groups}
+
+    def add_marker(self, name):
+        """ Return the code of the given marker, adding it to the catalog
+        if needed.
+        """
+        code = self._marker_codes.get(name)
+        if code is None:
+            code = self._marker_codes[name] = len(self.markers)
+            self.markers.append(name)
+        return code
+
+    def add_group(self, name):
+        """ Return the code of the given linkage group, adding it to the
+        catalog if needed.
+        """
+        code = self._group_codes.get(name)
+        if code is None:
+            code = self._group_codes[name] = len(self.groups)
+            self.groups.append(name)
+        return code
+
+    def get_marker(self, name):
+        """ Return the code of the given marker, None if it is not in the
+        catalog.
+        """
+        return self._marker_codes.get(name)
+
+    def get_group(self, name):
+        """ Return the code of the given linkage group, None if it is not
+        in the catalog.
+        """
+        return self._group_codes.get(name)
+
+    def encode_map(self, map_list):
+        """ Return the given genetic map as three arrays: the code of the
+        marker, the code of the linkage group and the position (NaN if it
+        is not a number) of each of its rows. The markers and linkage
+        groups are added to the catalog.
+
+        :arg map_list: the rows of the genetic map, without the headers,
+            each row being structured as follow::
+                Marker, Linkage group, position
+
+        """
+        markers = array.array('l')
+        groups = array.array('l')
+        positions = array.array('d')
+        for row in map_list:
+            markers.append(self.add_marker(row[0]))
+            groups.append(self.add_group(row[1]))
+            positions.append(
+                _to_position(row[2]) if len(row) > 2 else float('nan'))
+        return markers, groups, positions
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the Catalog object. """
+        return 'Catalog<%s markers, %s linkage groups>' % (
+            len(self.markers), len(self.groups))
@@ -0,0 +1,220 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 trait-chunked execution, reads a QTL matrix file one chunk of traits
+    at a time so that the memory used by a run stays under a budget.
+
+A :class:`MatrixFile` offers the same reading interface as a
+:class:`~MQ2.lodstore.LODStore` (``markers``, ``traits``,
+``nr_positions``, ``block_memory``, ``zones`` and ``iter_blocks``) so
+that the functions processing a store block by block can process a matrix
+file chunk by chunk. The file is read once to find the markers and traits and
+then, if the traits do not fit in a single chunk, once more to spill the
+LOD values of each chunk in a temporary file from which they are read back
+one chunk at a time.
+"""
+
+import array
+import logging
+import tempfile
+
+from MQ2.lodstore import NAN, get_block_size
+
+
+LOG = logging.getLogger('MQ2')
+
+
+def get_memory_budget(max_memory):
+    """ Return, in bytes, the memory available to a chunk of traits given
+    the memory budget of a run, in MB.
+    """
+    return int(float(max_memory) * 1024 * 1024)
+
+
+def _split_row(row, noquote=False):
+    """ Return the cells of a row of a matrix file. """
+    row = row.strip()
+    if noquote:
+        row = row.replace('"', '')
+    return row.split(',')
+
+
+def _to_float(value):
+    """ Return the LOD value of a cell, NaN if it is empty. """
+    value = value.strip()
+    if not value:
+        return NAN
+    return float(value)
+
+
+def _read_cells(row, start, stop, noquote=False):
+    """ Return the LOD values of the traits between the given indexes in
+    a row of a matrix file, NaN for the missing cells.
+    """
+    cells = _split_row(row, noquote)[start + 3:stop + 3]
+    values = [_to_float(cel) for cel in cells]
+    return values + [NAN] * (stop - start - len(values))
+
+
+class MatrixFile(object):
+    """ A QTL matrix file read one chunk of traits at a time, see the
+    documentation of the module.
+
+    It can be used as a context manager, like a
+    :class:`~MQ2.lodstore.LODStore`.
+
+    """
+
+    def __init__(self, path, noquote=False, count_column=False,
+                 block_memory=None):
+        """ Constructor, reads the markers and the traits of the file.
+
+        :arg path: the path to the QTL matrix file.
+        :kwarg noquote: whether to remove the quotes from the cells, as
+            :func:`MQ2.read_input_file` does.
+        :kwarg count_column: whether the last column of the file is the
+            number of QTLs of each row (see
+            :func:`MQ2.mq2.add_count_to_matrix`) and not a trait.
+        :kwarg block_memory: the memory, in bytes, used by a chunk of
+            traits returned by :meth:`iter_blocks`.
+
+        """
+        self.path = path
+        self.noquote = noquote
+        self.block_memory = block_memory
+        # The LOD values are only known once read, see MQ2.zonemap
+        self.zones = None
+        self.markers = []
+        with open(path) as stream:
+            headers = [cel.strip() for cel in
+                       _split_row(stream.readline(), noquote)]
+            for row in stream:
+                self.markers.append(
+                    [cel.strip() for cel in
+                     _split_row(row, noquote)[:3]])
+        self.headers = headers[:3]
+        self.traits = headers[3:-1] if count_column else headers[3:]
+        self.nr_positions = len(self.markers)
+
+    def get_block_size(self, memory=None):
+        """ Return the number of traits of a chunk using at most the given
+        memory, in bytes (by default :attr:`block_memory`).
+        """
+        return get_block_size(self.nr_positions,
+                              memory or self.block_memory)
+
+    def iter_blocks(self, block_size=None):
+        """ Iterate over the chunks of traits of the file, yielding for
+        each chunk the index of its first trait, the name of its traits
+        and their LOD values as arrays of floats.
+
+        :kwarg block_size: the number of traits per chunk, defaults to
+            the number of traits fitting in :attr:`block_memory`.
+
+        """
+        block_size = block_size or self.get_block_size()
+        nr_traits = len(self.traits)
+        if block_size >= nr_traits:
+            columns = [array.array('d') for trait in self.traits]
+            with open(self.path) as stream:
+                stream.readline()
+                for row in stream:
+                    for column, value in zip(columns, _read_cells(
+                            row, 0, nr_traits, self.noquote)):
+                        column.append(value)
+            if nr_traits:
+                yield 0, list(self.traits), columns
+            return
+
+        starts = list(range(0, nr_traits, block_size))
+        with tempfile.TemporaryFile(prefix='mq2_chunks_') as spill:
+            self._spill_blocks(spill, starts, block_size)
+            for start in starts:
+                stop = min(start + block_size, nr_traits)
+                LOG.debug('Reading traits %s to %s of %s'
+                          % (start, stop, self.path))
+                values = array.array('d')
+                spill.seek(start * self.nr_positions * values.itemsize)
+                values.fromfile(spill, (stop - start) * self.nr_positions)
+                width = stop - start
+                yield start, self.traits[start:stop], [
+                    values[cnt::width] for cnt in range(width)]
+
+    def _spill_blocks(self, spill, starts, block_size):
+        """ Read the matrix file in a single pass and write the LOD values
+        of each chunk of traits in the spill file, the chunks one after
+        the other and the values of a chunk row after row. The rows are
+        written a group at a time, a group holding as many values as a
+        chunk.
+        """
+        nr_traits = len(self.traits)
+        nr_rows = max(1, block_size * self.nr_positions // nr_traits)
+        itemsize = array.array('d').itemsize
+
+        def flush(first, rows):
+            """ Write the values of the rows starting at the given row
+            index in each chunk of the spill file.
+            """
+            for start in starts:
+                stop = min(start + block_size, nr_traits)
+                values = array.array('d')
+                for row in rows:
+                    values.extend(row[start:stop])
+                spill.seek((start * self.nr_positions
+                            + first * (stop - start)) * itemsize)
+                values.tofile(spill)
+
+        LOG.debug('Splitting the traits of %s in %s chunks'
+                  % (self.path, len(starts)))
+        with open(self.path) as stream:
+            stream.readline()
+            rows = []
+            first = 0
+            for row in stream:
+                rows.append(array.array('d', _read_cells(
+                    row, 0, nr_traits, self.noquote)))
+                if len(rows) == nr_rows:
+                    flush(first, rows)
+                    first += len(rows)
+                    rows = []
+            if rows:
+                flush(first, rows)
+        spill.flush()
+
+    def close(self):
+        """ Nothing to release, the file is opened for each iteration. """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the MatrixFile object. """
+        return 'MatrixFile<%s positions x %s traits>' % (
+            self.nr_positions, len(self.traits))
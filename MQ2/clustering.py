@@ -0,0 +1,208 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 trait clustering, groups the traits whose LOD profiles along the
+    genetic map are correlated, as candidate co-regulated traits.
+
+The LOD profile of each trait is centred and scaled to a unit norm, the
+Pearson correlation of two traits is then the dot product of their
+profiles. The scaled profiles are kept in a temporary
+:class:`~MQ2.lodstore.LODStore` and the correlations are computed one
+pair of blocks of traits at a time, as matrix products when numpy is
+installed, so that the memory used stays bounded whatever the number of
+traits. The traits are linked when their correlation is above a threshold
+and the clusters are the connected components of this graph, that is a
+single-linkage hierarchical clustering cut at the threshold.
+"""
+
+import array
+import logging
+import math
+import operator
+import os
+import shutil
+import tempfile
+
+try:  # pragma: no cover
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from MQ2 import MQ2Exception, write_matrix
+from MQ2.lodstore import LODStore
+
+
+LOG = logging.getLogger('MQ2')
+
+# Headers of the file listing the clusters
+CLUSTER_HEADERS = ['Trait', 'Cluster', 'Cluster size']
+
+
+def _scale_profile(values):
+    """ Return the given LOD profile centred and scaled to a unit norm, as
+    an array of floats, None if the profile is constant. Missing values
+    are considered as a LOD of 0.
+    """
+    values = [0. if math.isnan(value) else value for value in values]
+    if not values:
+        return None
+    mean = math.fsum(values) / len(values)
+    values = [value - mean for value in values]
+    norm = math.sqrt(math.fsum([value * value for value in values]))
+    if not norm:
+        return None
+    return array.array('d', [value / norm for value in values])
+
+
+def _find(parents, node):
+    """ Return the root of the component of the given node, compressing the
+    path to it.
+    """
+    root = node
+    while parents[root] != root:
+        root = parents[root]
+    while parents[node] != root:
+        parents[node], node = root, parents[node]
+    return root
+
+
+def _get_correlated_pairs(first, second, threshold, same_block=False):
+    """ Return the ``(i, j)`` indexes of the profiles of the two blocks
+    whose correlation is at least ``threshold``. If both blocks are the
+    same, only the pairs with ``i < j`` are returned.
+    """
+    if numpy is not None:
+        first = numpy.array(first)
+        second = numpy.array(second)
+        correlations = first.dot(second.T)
+        if same_block:
+            correlations[numpy.tril_indices(len(first))] = -numpy.inf
+        return zip(*[index.tolist() for index in
+                     numpy.nonzero(correlations >= threshold)])
+
+    pairs = []
+    for cnt, profile in enumerate(first):
+        start = cnt + 1 if same_block else 0
+        for cnt2 in range(start, len(second)):
+            if sum(map(operator.mul, profile, second[cnt2])) >= threshold:
+                pairs.append((cnt, cnt2))
+    return pairs
+
+
+def get_trait_clusters(source, threshold=0.8, lod_threshold=None,
+                       memory=None):
+    """ Return the list of the clusters of traits with correlated LOD
+    profiles, each cluster being the list of its traits. The clusters are
+    sorted by decreasing size and the traits of a cluster in the order of
+    the matrix. Each trait without correlated trait forms its own cluster.
+
+    :arg source: the LOD values, as a :class:`~MQ2.lodstore.LODStore` or a
+        :class:`~MQ2.chunked.MatrixFile`.
+    :kwarg threshold: the correlation from which two traits are linked.
+    :kwarg lod_threshold: if specified, only the traits with a LOD above
+        it are clustered.
+    :kwarg memory: the memory, in bytes, used by the two blocks of traits
+        loaded at a time, defaults to the block memory of the source.
+
+    """
+    if not -1 <= threshold <= 1:
+        raise MQ2Exception('The correlation threshold should be between '
+                           '-1 and 1')
+    if lod_threshold is not None:
+        lod_threshold = float(lod_threshold)
+
+    tmp_dir = tempfile.mkdtemp(prefix='mq2_clusters_')
+    try:
+        traits = []
+        profiles = []
+        store = LODStore.create(
+            os.path.join(tmp_dir, 'profiles.bin'), source.markers,
+            source.traits, zones=False)
+        with store:
+            for start, names, columns in source.iter_blocks():
+                for name, values in zip(names, columns):
+                    if lod_threshold is not None and not [
+                            value for value in values
+                            if value >= lod_threshold]:
+                        continue
+                    traits.append(name)
+                    profile = _scale_profile(values)
+                    if profile is not None:
+                        store.set_trait(len(profiles), profile)
+                        profiles.append(len(traits) - 1)
+            LOG.info('- Correlating the LOD profiles of %s traits'
+                     % len(profiles))
+
+            parents = list(range(len(traits)))
+            block_size = store.get_block_size(
+                (memory or source.block_memory or store.block_memory) // 2)
+            for start in range(0, len(profiles), block_size):
+                stop = min(start + block_size, len(profiles))
+                first = [store.get_trait(cnt) for cnt in range(start, stop)]
+                for start2 in range(start, len(profiles), block_size):
+                    stop2 = min(start2 + block_size, len(profiles))
+                    if start2 == start:
+                        second = first
+                    else:
+                        second = [store.get_trait(cnt)
+                                  for cnt in range(start2, stop2)]
+                    for cnt, cnt2 in _get_correlated_pairs(
+                            first, second, threshold,
+                            same_block=start2 == start):
+                        root = _find(parents, profiles[start + cnt])
+                        root2 = _find(parents, profiles[start2 + cnt2])
+                        if root != root2:
+                            parents[max(root, root2)] = min(root, root2)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    clusters = {}
+    for cnt, trait in enumerate(traits):
+        clusters.setdefault(_find(parents, cnt), []).append(trait)
+    return [clusters[root] for root in sorted(
+        clusters, key=lambda root: (-len(clusters[root]), root))]
+
+
+def write_cluster_file(source, outputfile='trait_clusters.csv',
+                       threshold=0.8, lod_threshold=None, memory=None):
+    """ Write the cluster of each trait, see :func:`get_trait_clusters`.
+
+    :arg source: the LOD values.
+    :kwarg outputfile: the name of the output file, listing for each
+        trait its cluster (numbered from 1, the largest cluster first) and
+        the size of its cluster.
+
+    """
+    clusters = get_trait_clusters(
+        source, threshold=threshold, lod_threshold=lod_threshold,
+        memory=memory)
+    output = [list(CLUSTER_HEADERS)]
+    for cnt, cluster in enumerate(clusters):
+        for trait in cluster:
+            output.append([trait, str(cnt + 1), str(len(cluster))])
+    write_matrix(outputfile, output)
+    LOG.info('- %s traits grouped in %s clusters in %s' % (
+        len(output) - 1, len(clusters), outputfile))
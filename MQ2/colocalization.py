@@ -0,0 +1,169 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 trait colocalization, lists the pairs of traits whose QTLs have
+    overlapping LOD2 intervals on the same linkage group.
+
+The intervals of each linkage group are sorted by start and swept once,
+keeping the intervals still open ordered by end in a heap: each interval
+only meets the open intervals, which all overlap it. The cost is thus
+O(n log n + k) for n QTLs and k overlapping pairs, instead of comparing
+all the pairs of traits.
+"""
+
+import bisect
+import heapq
+import logging
+
+from MQ2 import read_input_file, write_matrix
+
+
+LOG = logging.getLogger('MQ2')
+
+# Headers of the colocalization file
+COLOCALIZATION_HEADERS = ['Trait 1', 'Trait 2', 'Linkage Group',
+                          'Overlap start', 'Overlap end', 'Overlap (cM)',
+                          'Shared markers']
+
+
+def _to_position(value):
+    """ Return the position of a marker as a float, None if the position
+    is not a number.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_qtl_intervals(qtl_list, genetic_map):
+    """ Return, for each linkage group, the list of the LOD2 intervals of
+    its QTLs as ``(start, end, trait)`` positions.
+    The QTLs without interval (``NA``) are given an interval of length 0
+    at the position of their closest marker.
+
+    :arg qtl_list: the list of QTLs, the first row being the headers and
+        the last three columns the closest marker, the start and the end
+        of the LOD2 interval of each QTL (see
+        :func:`MQ2.mapchart.append_flanking_markers`).
+    :arg genetic_map: the genetic map, the first row being the headers.
+
+    """
+    positions = {}
+    for row in genetic_map[1:]:
+        positions.setdefault((row[0], row[1]), _to_position(row[2]))
+    intervals = {}
+    for qtl in qtl_list[1:]:
+        group = qtl[1]
+        start = positions.get((qtl[-2], group))
+        end = positions.get((qtl[-1], group))
+        if start is None or end is None:
+            start = end = positions.get((qtl[-3], group))
+        if start is None:
+            LOG.debug('No position found for the QTL of %s on %s'
+                      % (qtl[0], group))
+            continue
+        start, end = sorted([start, end])
+        intervals.setdefault(group, []).append((start, end, qtl[0]))
+    return intervals
+
+
+def iter_overlaps(intervals):
+    """ Iterate over the pairs of overlapping intervals of a linkage group,
+    yielding ``(interval, interval)`` tuples. Intervals touching at a
+    single position overlap.
+
+    :arg intervals: a list of ``(start, end, ...)`` tuples.
+
+    """
+    intervals = sorted(intervals)
+    opened = []
+    for cnt, interval in enumerate(intervals):
+        while opened and opened[0][0] < interval[0]:
+            heapq.heappop(opened)
+        for end, other in opened:
+            yield intervals[other], interval
+        heapq.heappush(opened, (interval[1], cnt))
+
+
+def get_colocalization(qtl_list, genetic_map):
+    """ Return the list of the pairs of traits with overlapping QTL
+    intervals, the first row being the headers (see
+    :data:`COLOCALIZATION_HEADERS`). There is one row per pair of
+    overlapping QTLs, the QTLs of a trait are not compared to each other.
+
+    See :func:`get_qtl_intervals` for the arguments.
+
+    """
+    markers = {}
+    for row in genetic_map[1:]:
+        position = _to_position(row[2])
+        if position is not None:
+            markers.setdefault(row[1], []).append((position, row[0]))
+    for group in markers:
+        markers[group].sort()
+
+    output = [list(COLOCALIZATION_HEADERS)]
+    intervals = get_qtl_intervals(qtl_list, genetic_map)
+    for group in sorted(intervals):
+        group_markers = markers.get(group, [])
+        group_positions = [marker[0] for marker in group_markers]
+        rows = []
+        for first, second in iter_overlaps(intervals[group]):
+            if first[2] == second[2]:
+                continue
+            start = max(first[0], second[0])
+            end = min(first[1], second[1])
+            shared = group_markers[
+                bisect.bisect_left(group_positions, start):
+                bisect.bisect_right(group_positions, end)]
+            traits = sorted([first[2], second[2]])
+            rows.append((traits, start, end, shared))
+        rows.sort(key=lambda row: (row[0], row[1], row[2]))
+        for traits, start, end, shared in rows:
+            output.append(traits + [
+                group, '%.3f' % start, '%.3f' % end, '%.3f' % (end - start),
+                ' '.join([marker[1] for marker in shared])])
+    return output
+
+
+def write_colocalization_file(qtlfile, mapfile,
+                              outputfile='colocalization.csv'):
+    """ Write the pairs of traits with overlapping QTL intervals, see
+    :func:`get_colocalization`.
+
+    :arg qtlfile: the list of QTLs with their closest and flanking
+        markers.
+    :arg mapfile: the genetic map with all the markers.
+    :kwarg outputfile: the name of the output file.
+
+    """
+    qtl_list = read_input_file(qtlfile, ',')
+    genetic_map = read_input_file(mapfile, ',')
+    output = get_colocalization(qtl_list, genetic_map)
+    write_matrix(outputfile, output)
+    LOG.info('- %s pairs of colocalized QTLs written in %s'
+             % (len(output) - 1, outputfile))
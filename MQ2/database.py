@@ -0,0 +1,342 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 results database, appends the results of the runs to a SQLite
+    database so that the QTLs of many experiments can be queried at once.
+
+The database contains the tables:
+
+- ``runs``: one row per run (name, date, plugin, session, LOD threshold,
+  whether the QTLs were counted on their interval and version of MQ²),
+- ``traits``: the traits analyzed in each run,
+- ``qtls``: the QTLs found in each run (trait, linkage group, peak
+  position and marker, LOD, closest marker and LOD2 interval),
+- ``markers``: the markers of the genetic map of each run with the number
+  of QTLs found on them.
+
+It can be queried with SQL or with the ``MQ2-query`` command, for example
+to list the QTLs found within 5 cM of a marker in all the runs::
+
+    MQ2-query results.sqlite near D2M336 --distance 5
+
+"""
+
+import argparse
+import csv
+import datetime
+import logging
+import os
+import sqlite3
+import sys
+
+from MQ2 import __version__, MQ2Exception, read_input_file
+
+
+LOG = logging.getLogger('MQ2')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    created TEXT,
+    plugin TEXT,
+    session TEXT,
+    lod_threshold REAL,
+    count_intervals INTEGER,
+    version TEXT
+);
+CREATE TABLE IF NOT EXISTS traits (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS qtls (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    trait TEXT NOT NULL,
+    linkage_group TEXT,
+    position REAL,
+    peak_marker TEXT,
+    lod REAL,
+    closest_marker TEXT,
+    interval_start TEXT,
+    interval_start_position REAL,
+    interval_end TEXT,
+    interval_end_position REAL
+);
+CREATE TABLE IF NOT EXISTS markers (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    marker TEXT NOT NULL,
+    linkage_group TEXT,
+    position REAL,
+    nr_qtls INTEGER
+);
+CREATE INDEX IF NOT EXISTS traits_run_idx ON traits (run_id);
+CREATE INDEX IF NOT EXISTS qtls_position_idx
+    ON qtls (linkage_group, position);
+CREATE INDEX IF NOT EXISTS qtls_peak_marker_idx ON qtls (peak_marker);
+CREATE INDEX IF NOT EXISTS qtls_closest_marker_idx ON qtls (closest_marker);
+CREATE INDEX IF NOT EXISTS qtls_trait_idx ON qtls (trait);
+CREATE INDEX IF NOT EXISTS markers_marker_idx ON markers (marker);
+CREATE INDEX IF NOT EXISTS markers_position_idx
+    ON markers (linkage_group, position);
+"""
+
+
+def _to_float(value):
+    """ Return the given value as a float, None if it is not a number.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def connect(database):
+    """ Return a connection to the given database, creating its tables
+    and indexes if needed.
+    The database uses a write-ahead log so that it can be queried while
+    runs are being added to it.
+    """
+    connection = sqlite3.connect(database, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    columns = [row[1] for row in
+               connection.execute('PRAGMA table_info(runs)')]
+    if 'count_intervals' not in columns:
+        # Database created by an earlier version of MQ²
+        connection.execute(
+            'ALTER TABLE runs ADD COLUMN count_intervals INTEGER')
+    return connection
+
+
+def add_run(database, files, name=None, plugin=None, session=None,
+            lod_threshold=None, count_intervals=False):
+    """ Add the results of a run to the database and return the
+    identifier of the run.
+    All the rows of the run are inserted in a single transaction.
+
+    :arg database: the path to the SQLite database, or a connection
+        returned by :func:`connect`.
+    :arg files: a dictionary giving the path to each of the files
+        generated by the run, see :func:`MQ2.mq2.get_output_files`.
+    :kwarg name: the name of the run, for example its input file.
+    :kwarg plugin: the name of the plugin used.
+    :kwarg session: the session analyzed.
+    :kwarg lod_threshold: the LOD threshold used.
+    :kwarg count_intervals: whether the QTLs were credited to all the
+        markers of their LOD2 interval in the number of QTLs per marker.
+
+    """
+    for key in ['qtls_mk', 'map_qtl', 'matrix']:
+        if not os.path.exists(files[key]):
+            raise MQ2Exception('File not found: "%s"' % files[key])
+    markers = read_input_file(files['map_qtl'], sep=',')[1:]
+    positions = dict([((row[0], row[1]), _to_float(row[2]))
+                      for row in markers])
+    qtls = []
+    for row in read_input_file(files['qtls_mk'], sep=',')[1:]:
+        qtls.append((row[0], row[1], _to_float(row[2]), row[3],
+                     _to_float(row[4]), row[-3],
+                     row[-2], positions.get((row[-2], row[1])),
+                     row[-1], positions.get((row[-1], row[1]))))
+    with open(files['matrix']) as stream:
+        traits = stream.readline().strip().split(',')[3:]
+    if traits and traits[-1] == '# QTLs':
+        traits = traits[:-1]
+
+    connection = database
+    if not isinstance(database, sqlite3.Connection):
+        connection = connect(database)
+    try:
+        with connection:
+            cursor = connection.execute(
+                'INSERT INTO runs (name, created, plugin, session, '
+                'lod_threshold, count_intervals, version) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (name, datetime.datetime.now().isoformat(), plugin,
+                 None if session is None else str(session),
+                 _to_float(lod_threshold), int(bool(count_intervals)),
+                 __version__))
+            run_id = cursor.lastrowid
+            connection.executemany(
+                'INSERT INTO traits (run_id, name) VALUES (?, ?)',
+                [(run_id, trait) for trait in traits])
+            connection.executemany(
+                'INSERT INTO qtls (run_id, trait, linkage_group, position, '
+                'peak_marker, lod, closest_marker, interval_start, '
+                'interval_start_position, interval_end, '
+                'interval_end_position) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id,) + qtl for qtl in qtls])
+            connection.executemany(
+                'INSERT INTO markers (run_id, marker, linkage_group, '
+                'position, nr_qtls) VALUES (?, ?, ?, ?, ?)',
+                [(run_id, row[0], row[1], _to_float(row[2]), int(row[3]))
+                 for row in markers])
+    finally:
+        if connection is not database:
+            connection.close()
+    LOG.info('Run %s added to the database %s with %s QTLs'
+             % (run_id, database, len(qtls)))
+    return run_id
+
+
+def _query(database, query, parameters=()):
+    """ Return the headers and the rows returned by the given query. """
+    connection = connect(database)
+    try:
+        cursor = connection.execute(query, parameters)
+        headers = [column[0] for column in cursor.description]
+        return [headers] + cursor.fetchall()
+    finally:
+        connection.close()
+
+
+def get_runs(database):
+    """ Return the runs stored in the database, the first row being the
+    headers.
+    """
+    return _query(
+        database,
+        'SELECT id, name, created, plugin, session, lod_threshold, '
+        'count_intervals, version, (SELECT COUNT(*) FROM qtls WHERE run_id = runs.id) '
+        'AS nr_qtls FROM runs ORDER BY id')
+
+
+def find_qtls_near_marker(database, marker, distance=5):
+    """ Return the QTLs, of all the runs, whose peak is on the same
+    linkage group as the given marker and at most ``distance`` cM from
+    it. The first row being the headers.
+    """
+    return _query(
+        database,
+        'SELECT runs.name AS run, qtls.trait, qtls.linkage_group, '
+        'qtls.position, qtls.peak_marker, qtls.lod, qtls.closest_marker, '
+        'ABS(qtls.position - markers.position) AS distance '
+        'FROM markers '
+        'JOIN qtls ON qtls.linkage_group = markers.linkage_group '
+        'AND qtls.position BETWEEN markers.position - ? '
+        'AND markers.position + ? AND qtls.run_id = markers.run_id '
+        'JOIN runs ON runs.id = qtls.run_id '
+        'WHERE markers.marker = ? '
+        'ORDER BY distance, qtls.lod DESC',
+        (float(distance), float(distance), marker))
+
+
+def find_qtls_in_region(database, linkage_group, start, stop):
+    """ Return the QTLs, of all the runs, whose peak is on the given
+    linkage group between the given positions. The first row being the
+    headers.
+    """
+    return _query(
+        database,
+        'SELECT runs.name AS run, qtls.trait, qtls.linkage_group, '
+        'qtls.position, qtls.peak_marker, qtls.lod, qtls.closest_marker '
+        'FROM qtls JOIN runs ON runs.id = qtls.run_id '
+        'WHERE qtls.linkage_group = ? AND qtls.position BETWEEN ? AND ? '
+        'ORDER BY qtls.position, qtls.lod DESC',
+        (str(linkage_group), float(start), float(stop)))
+
+
+def get_hotspots(database, min_qtls=1, limit=20):
+    """ Return the markers on which the most QTLs were found, summed over
+    all the runs. The first row being the headers.
+
+    :kwarg min_qtls: the minimum number of QTLs of the markers returned.
+    :kwarg limit: the maximum number of markers returned.
+
+    """
+    return _query(
+        database,
+        'SELECT marker, linkage_group, MIN(position) AS position, '
+        'SUM(nr_qtls) AS nr_qtls, '
+        'COUNT(DISTINCT CASE WHEN nr_qtls > 0 THEN run_id END) AS nr_runs '
+        'FROM markers GROUP BY marker, linkage_group '
+        'HAVING SUM(nr_qtls) >= ? ORDER BY nr_qtls DESC, marker LIMIT ?',
+        (int(min_qtls), int(limit)))
+
+
+def _get_arguments(args=None):  # pragma: no cover
+    """ Handle the command line arguments of the query program. """
+    parser = argparse.ArgumentParser(
+        description='Query a database of MQ² results')
+    parser.add_argument('database', help='The SQLite database to query.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser('runs', help='List the runs of the database.')
+
+    near = subparsers.add_parser(
+        'near', help='List the QTLs close to a marker.')
+    near.add_argument('marker')
+    near.add_argument(
+        '--distance', default=5, type=float,
+        help='Maximum distance, in cM, to the marker (default: 5).')
+
+    region = subparsers.add_parser(
+        'region', help='List the QTLs in a region of a linkage group.')
+    region.add_argument('linkage_group')
+    region.add_argument('start', type=float)
+    region.add_argument('stop', type=float)
+
+    hotspots = subparsers.add_parser(
+        'hotspots', help='List the markers with the most QTLs.')
+    hotspots.add_argument(
+        '--min', dest='min_qtls', default=1, type=int,
+        help='Minimum number of QTLs of the markers listed.')
+    hotspots.add_argument(
+        '--limit', default=20, type=int,
+        help='Maximum number of markers listed (default: 20).')
+    return parser.parse_args(args)
+
+
+def cli_main(args=None):  # pragma: no cover
+    """ Main function of the ``MQ2-query`` command, writes the result of
+    the query as CSV on the standard output.
+    """
+    logging.basicConfig()
+    args = _get_arguments(args)
+    if not os.path.exists(args.database):
+        print('Database not found: "%s"' % args.database)
+        return 1
+    if args.command == 'runs':
+        rows = get_runs(args.database)
+    elif args.command == 'near':
+        rows = find_qtls_near_marker(
+            args.database, args.marker, distance=args.distance)
+    elif args.command == 'region':
+        rows = find_qtls_in_region(
+            args.database, args.linkage_group, args.start, args.stop)
+    else:
+        rows = get_hotspots(
+            args.database, min_qtls=args.min_qtls, limit=args.limit)
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerows(rows)
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(cli_main())
@@ -0,0 +1,584 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 distributed runs, split the traits of a MapQTL session into shards
+    analyzed by worker nodes and merge their results.
+
+The coordinator (:func:`run_distributed`) parses the genetic map from
+the first file of the session and splits the sorted ``.mqo`` files of
+the session into shards of consecutive files. Each shard is sent, as
+JSON, to a worker over HTTP:
+
+- ``GET /status``: version of MQ² of the worker.
+- ``POST /shards``: analyze the shard sent as body, a JSON object
+  ``{"session": <session>, "lod": <lod>, "files": [[<name>, <content>],
+  ...]}``, and send back its partial results (see
+  :func:`analyze_shard`) as a line of JSON followed by the LOD values of
+  its traits, as CSV rows.
+
+The workers parse their files one at a time in a single pass, count the
+QTLs found on each row, find the closest marker of each QTL, count the
+QTLs found on each marker and search the QTLs and their LOD2 interval
+for the MapChart file. Only these results are sent as JSON, the LOD
+values are written in a slice of the QTL matrix which the coordinator
+saves as it receives it. The coordinator checks that all the shards
+used the same map, adds up the counts of the shards, merges the slices
+row by row in the QTL matrix and writes the usual output files,
+identical to those of :func:`MQ2.mq2.run_mq2`.
+
+Workers are started on each node with ``MQ2 --shard-worker [HOST:]PORT``,
+or in local processes with :class:`LocalWorkers` for testing.
+"""
+
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+from MQ2 import (__version__, MQ2Exception, MQ2NoMatrixException,
+                 MQ2NoSessionException, MQ2NoSuchSessionException,
+                 write_matrix)
+from MQ2.add_marker_to_qtls import add_marker_to_qtl_list
+from MQ2.add_qtl_to_map import add_qtl_to_map_list
+from MQ2.mapchart import (add_flanking_markers, get_map_chart_data_from_qtls,
+                          write_map_chart_file)
+from MQ2.mq2 import get_output_files
+from MQ2.plugins.mapqtl_plugin import (MapQTLPlugin, get_trait_name,
+                                       get_trait_results, parse_mapqtl_file)
+from MQ2.qtl import QTL
+from MQ2.workspace import Workspace
+from MQ2.zonemap import get_groups
+
+
+LOG = logging.getLogger('MQ2')
+
+# Time, in seconds, the coordinator waits for the results of a shard
+TIMEOUT = 3600
+
+
+def get_shards(inputfiles, nr_shards):
+    """ Return the given files split in at most the given number of
+    shards of consecutive files of similar size.
+    """
+    nr_shards = max(min(nr_shards, len(inputfiles)), 1)
+    size, extra = divmod(len(inputfiles), nr_shards)
+    shards = []
+    start = 0
+    for cnt in range(nr_shards):
+        stop = start + size + (1 if cnt < extra else 0)
+        shards.append(inputfiles[start:stop])
+        start = stop
+    return [shard for shard in shards if shard]
+
+
+def _write_shard_files(folder, files):
+    """ Write the files of a shard, given as ``(name, content)``, in the
+    given folder. The names are relative paths which may not leave the
+    folder.
+    """
+    for name, content in files:
+        parts = name.replace('\\', '/').split('/')
+        if os.path.isabs(name) or '..' in parts or '' in parts:
+            raise MQ2Exception('Invalid file name in the shard: %s' % name)
+        filename = os.path.join(folder, *parts)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as stream:
+            stream.write(content)
+
+
+def _get_session_files(folder, session):
+    """ Return the sorted list of the MapQTL files of the given session
+    in the folder, checking that the session exists.
+    """
+    sessions = MapQTLPlugin.get_session_identifiers(folder)
+    if session is None:
+        raise MQ2NoSessionException(
+            'The MapQTL plugin requires a session identifier to '
+            'identify the session to process.'
+            'Sessions are: %s' % ','.join(sessions))
+    elif str(session) not in sessions:
+        raise MQ2NoSuchSessionException(
+            'The MapQTL session provided (%s) could not be found in the '
+            'dataset. '
+            'Sessions are: %s' % (session, ','.join(sessions)))
+    return sorted(MapQTLPlugin.get_files(folder, session_id=session))
+
+
+def analyze_shard(files, session, lod_threshold, matrix_file):
+    """ Analyze a shard of the MapQTL files of a session, write the LOD
+    values of its traits in the given file and return its partial results
+    as a dictionary with the following keys:
+
+    - ``fingerprint``: the fingerprint of the map of the files, see
+      :func:`~MQ2.plugins.mapqtl_plugin.parse_mapqtl_file`.
+    - ``headers``: the headers of the list of QTLs.
+    - ``traits``: the name of the traits of the shard.
+    - ``counts``: for each row of the QTL matrix, the number of QTLs
+      found, see :func:`~MQ2.plugins.mapqtl_plugin.get_trait_results`.
+    - ``qtls``: the QTLs found, with their closest marker appended.
+    - ``markers``: for each marker of the map, the number of QTLs whose
+      peak is the closest to it.
+    - ``map_chart``: the QTLs of the MapChart file found on each linkage
+      group, see :func:`~MQ2.mapchart.get_map_chart_qtls`, with the QTLs
+      as dictionaries.
+
+    The file of LOD values is the slice of the QTL matrix of the traits
+    of the shard: the name of the traits followed by their LOD value at
+    each row, as CSV.
+
+    :arg files: the list of the files of the shard, as ``(name,
+        content)``, their names being relative paths.
+    :arg session: the MapQTL session analyzed.
+    :arg lod_threshold: the LOD threshold to use.
+    :arg matrix_file: the file in which to write the LOD values.
+
+    """
+    try:
+        lod_threshold = float(lod_threshold)
+    except (TypeError, ValueError):
+        raise MQ2Exception('LOD threshold should be a number')
+    if not files:
+        raise MQ2Exception('The shard does not contain any file')
+
+    fingerprint = None
+    traits = []
+    columns = []
+    qtls = []
+    with Workspace() as workspace:
+        _write_shard_files(workspace.input_dir, files)
+        for filename in _get_session_files(workspace.input_dir, session):
+            headers, lods, file_qtls, file_fingerprint, rows = \
+                parse_mapqtl_file(filename, lod_threshold,
+                                  keep_map=fingerprint is None)
+            if fingerprint is None:
+                fingerprint = file_fingerprint
+                markers = [[row[3].strip(), row[1].strip(), row[2].strip()]
+                           for row in rows]
+                map_list = [row for row in markers if row[0]]
+                counts = [0] * (len(markers) - 1)
+                found = [[] for group in get_groups(markers[1:])[:-1]]
+            elif file_fingerprint != fingerprint:
+                raise MQ2NoMatrixException(
+                    'The map used in the file "%s" does not'
+                    ' correspond to the map used in at least one'
+                    ' other file.' % os.path.basename(filename))
+            trait = get_trait_name(filename)
+            trait_counts, trait_found = get_trait_results(
+                markers[1:], trait, lods, lod_threshold)
+            for row in trait_counts:
+                counts[row] += 1
+            for groupcnt, first, qtl in trait_found:
+                found[groupcnt].append([first, len(traits), qtl])
+            traits.append(trait)
+            columns.append(lods)
+            qtls.extend([[str(el).strip() for el in qtl]
+                         for qtl in file_qtls])
+    if fingerprint is None:
+        raise MQ2Exception('No files correspond to this plugin')
+
+    write_matrix(matrix_file, itertools.chain([traits], zip(*columns)))
+    headers = [cel.strip() for cel in headers]
+    headers[0] = 'Trait name'
+    qtls = add_marker_to_qtl_list([headers] + qtls, map_list)
+    marker_counts = add_qtl_to_map_list(qtls, map_list)
+    LOG.info('- Shard of %s traits analyzed, %s QTLs found'
+             % (len(traits), len(qtls) - 1))
+    return {
+        'fingerprint': fingerprint,
+        'headers': headers,
+        'traits': traits,
+        'counts': counts,
+        'qtls': qtls[1:],
+        'markers': [int(row[-1]) for row in marker_counts[1:]],
+        'map_chart': found,
+    }
+
+
+def send_shard(url, files, session, lod_threshold, matrix_file,
+               timeout=TIMEOUT):
+    """ Send a shard to the worker at the given URL, save the LOD values
+    of its traits in the given file as they are received and return its
+    partial results, see :func:`analyze_shard`.
+
+    :arg url: the base URL of the worker, for example
+        ``http://node1:8090``.
+    :arg files: the list of the files of the shard, as ``(name,
+        content)``.
+    :arg session: the MapQTL session analyzed.
+    :arg lod_threshold: the LOD threshold to use.
+    :arg matrix_file: the file in which to save the LOD values.
+    :kwarg timeout: the time, in seconds, to wait for the results.
+
+    """
+    body = json.dumps({'session': session, 'lod': lod_threshold,
+                       'files': files}).encode('utf-8')
+    request = Request('%s/shards' % url.rstrip('/'), data=body,
+                      headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            result = json.loads(response.readline().decode('utf-8'))
+            with open(matrix_file, 'wb') as stream:
+                shutil.copyfileobj(response, stream)
+            return result
+    except HTTPError as err:
+        try:
+            message = json.loads(err.read().decode('utf-8'))['error']
+        except (ValueError, KeyError):
+            message = '%s' % err
+        raise MQ2Exception('The worker %s failed: %s' % (url, message))
+    except (URLError, OSError) as err:
+        raise MQ2Exception('Could not reach the worker %s: %s'
+                           % (url, err))
+
+
+def merge_shards(results, markers, map_list):
+    """ Return the content of the output files of a run given the partial
+    results of its shards, in the order of the traits, as a dictionary
+    associating the key of each file (see :data:`MQ2.mq2.OUTPUT_FILES`)
+    to its rows or, for the MapChart file, to its data. The QTL matrix,
+    merged from the slices of the shards by :func:`write_shard_matrix`,
+    is replaced by its traits (``traits``) and the number of QTLs found
+    on each of its rows (``qtl_counts``).
+
+    :arg results: the partial results of the shards, see
+        :func:`analyze_shard`.
+    :arg markers: the ``marker, linkage group, position`` columns of the
+        QTL matrix, the first row being the headers.
+    :arg map_list: the genetic map, the first row being the headers.
+
+    """
+    counts = [0] * (len(markers) - 1)
+    marker_counts = [0] * (len(map_list) - 1)
+    traits = []
+    qtls = []
+    found = None
+    for result in results:
+        counts = [cnt + extra for cnt, extra in
+                  zip(counts, result['counts'])]
+        marker_counts = [cnt + extra for cnt, extra in
+                         zip(marker_counts, result['markers'])]
+        qtls.extend(result['qtls'])
+        if found is None:
+            found = [[] for entries in result['map_chart']]
+        for groupcnt, entries in enumerate(result['map_chart']):
+            found[groupcnt].extend(
+                [(first, len(traits) + trait, QTL.from_dict(qtl))
+                 for first, trait, qtl in entries])
+        traits.extend(result['traits'])
+
+    qtl_headers = list(results[-1]['headers'])
+    return {
+        'qtls': [qtl_headers] + [qtl[:-1] for qtl in qtls],
+        'traits': traits,
+        'qtl_counts': counts,
+        'map': map_list,
+        'map_qtl': [list(map_list[0]) + ['# QTLs']] + [
+            list(row) + [str(cnt)]
+            for row, cnt in zip(map_list[1:], marker_counts)],
+        'qtls_mk': [qtl_headers + ['Closest marker']] + qtls,
+        'map_chart': get_map_chart_data_from_qtls(
+            [list(row) for row in markers[1:]], found or []),
+    }
+
+
+def _iter_matrix_rows(markers, traits, streams, counts):
+    """ Iterate over the rows of the QTL matrix, the LOD values of each
+    row being read from the slice of each shard, see
+    :func:`write_shard_matrix`.
+    """
+    for stream in streams:
+        # The traits of the slice
+        stream.readline()
+    yield list(markers[0]) + traits + ['# QTLs']
+    for cnt, marker in enumerate(markers[1:]):
+        row = list(marker)
+        for stream in streams:
+            line = stream.readline()
+            if not line:
+                raise MQ2Exception('The LOD values of a shard are missing '
+                                   'rows of the QTL matrix')
+            row.extend(line.strip().split(','))
+        yield row + [str(counts[cnt])]
+
+
+def write_shard_matrix(matrix_file, markers, traits, counts, slices):
+    """ Write the QTL matrix of a run, merging one row at a time the
+    slices of the QTL matrix written by the shards.
+
+    :arg matrix_file: the file in which to write the QTL matrix.
+    :arg markers: the ``marker, linkage group, position`` columns of the
+        QTL matrix, the first row being the headers.
+    :arg traits: the traits of the QTL matrix, see :func:`merge_shards`.
+    :arg counts: the number of QTLs found on each row.
+    :arg slices: the files containing the LOD values of each shard, in
+        the order of the traits.
+
+    """
+    with contextlib.ExitStack() as stack:
+        streams = [stack.enter_context(open(filename))
+                   for filename in slices]
+        write_matrix(matrix_file, _iter_matrix_rows(
+            markers, traits, streams, counts))
+
+
+def run_distributed(folder, workers, session=None, lod_threshold=None,
+                    outputfolder=None, nr_shards=None, timeout=TIMEOUT):
+    """ Run MQ² on a MapQTL session, the traits being analyzed in shards
+    by the given workers, see the documentation of the module.
+
+    :arg folder: the folder containing the MapQTL files.
+    :arg workers: the list of the base URLs of the workers.
+    :kwarg session: the MapQTL session to analyze.
+    :kwarg lod_threshold: the LOD threshold to use.
+    :kwarg outputfolder: the folder in which to write the output files,
+        defaults to the current working directory.
+    :kwarg nr_shards: the number of shards in which to split the files,
+        defaults to the number of workers. The shards are sent to the
+        workers in turn.
+    :kwarg timeout: the time, in seconds, to wait for the results of a
+        shard.
+
+    """
+    if not workers:
+        raise MQ2Exception('No worker specified')
+    if folder is None or not os.path.isdir(folder):
+        raise MQ2Exception('Distributed runs require a folder containing '
+                           'MapQTL files')
+    inputfiles = _get_session_files(folder, session)
+    try:
+        lod_threshold = float(lod_threshold)
+    except (TypeError, ValueError):
+        raise MQ2Exception('LOD threshold should be a number')
+
+    fingerprint, first = parse_mapqtl_file(
+        inputfiles[0], lod_threshold, keep_map=True)[3:]
+    markers = [[row[3].strip(), row[1].strip(), row[2].strip()]
+               for row in first]
+    map_list = [[row[3], row[1], row[2]] for row in first if row[3]]
+
+    shards = get_shards(inputfiles, nr_shards or len(workers))
+    LOG.info('Analyzing %s files in %s shards on %s workers'
+             % (len(inputfiles), len(shards), len(workers)))
+
+    files = get_output_files(outputfolder)
+    with Workspace() as workspace:
+        slices = [os.path.join(workspace.path, 'shard_%s.csv' % cnt)
+                  for cnt in range(len(shards))]
+
+        def run_shard(shardcnt):
+            """ Send a shard to its worker and return its results. """
+            files = []
+            for filename in shards[shardcnt]:
+                with open(filename) as stream:
+                    files.append((os.path.relpath(filename, folder),
+                                  stream.read()))
+            result = send_shard(workers[shardcnt % len(workers)], files,
+                                session, lod_threshold, slices[shardcnt],
+                                timeout=timeout)
+            if result['fingerprint'] != fingerprint:
+                raise MQ2NoMatrixException(
+                    'The map used in the file "%s" does not correspond '
+                    'to the map used in at least one other file.'
+                    % shards[shardcnt][0])
+            return result
+
+        with concurrent.futures.ThreadPoolExecutor(
+                len(workers)) as executor:
+            results = list(executor.map(run_shard, range(len(shards))))
+
+        output = merge_shards(results, markers, map_list)
+        write_shard_matrix(files['matrix'], markers, output['traits'],
+                           output['qtl_counts'], slices)
+    for key in ['qtls', 'map', 'map_qtl']:
+        write_matrix(files[key], output[key])
+    flanking_markers = write_map_chart_file(
+        output['map_chart'], files['map_chart'])
+    write_matrix(files['qtls_mk'], add_flanking_markers(
+        output['qtls_mk'], flanking_markers))
+    return files
+
+
+class ShardRequestHandler(BaseHTTPRequestHandler):
+    """ Handles the HTTP requests sent to a worker by the coordinator. """
+
+    server_version = 'MQ2/%s' % __version__
+
+    def log_message(self, format, *args):  # pragma: no cover
+        LOG.info('%s - %s' % (self.address_string(), format % args))
+
+    def _send_json(self, data, code=200):
+        """ Send back the provided data as JSON. """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """ Handle the GET requests. """
+        if self.path.rstrip('/') == '/status':
+            self._send_json({'version': __version__})
+        else:
+            self._send_json({'error': 'Not found'}, code=404)
+
+    def do_POST(self):
+        """ Handle the POST requests. """
+        if self.path.rstrip('/') != '/shards':
+            return self._send_json({'error': 'Not found'}, code=404)
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            files = [(name, content) for name, content in data['files']]
+        except (ValueError, KeyError, TypeError):
+            return self._send_json({'error': 'Invalid shard'}, code=400)
+        with Workspace() as workspace:
+            matrix_file = os.path.join(workspace.path, 'matrix.csv')
+            try:
+                result = analyze_shard(files, data.get('session'),
+                                       data.get('lod', 3), matrix_file)
+            except MQ2Exception as err:
+                return self._send_json({'error': '%s' % err}, code=400)
+            self._send_shard(result, matrix_file)
+
+    def _send_shard(self, result, matrix_file):
+        """ Send back the results of a shard as a line of JSON followed
+        by the content of its file of LOD values.
+        """
+        head = ('%s\n' % json.dumps(result)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length',
+                         str(len(head) + os.path.getsize(matrix_file)))
+        self.end_headers()
+        self.wfile.write(head)
+        with open(matrix_file, 'rb') as stream:
+            shutil.copyfileobj(stream, self.wfile)
+
+
+def make_worker_server(host='localhost', port=0):
+    """ Return the HTTP server of a worker, use port 0 to let the system
+    pick a free port (available as ``server.server_address[1]``).
+    """
+    server = ThreadingHTTPServer((host, port), ShardRequestHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve_worker(host='localhost', port=8090):
+    """ Start a worker and serve the shards sent to it until interrupted.
+
+    :kwarg host: the interface on which to listen.
+    :kwarg port: the port on which to listen.
+
+    """
+    server = make_worker_server(host=host, port=port)
+    LOG.info('MQ2 worker on http://%s:%s/' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        server.server_close()
+
+
+def _run_local_worker(connection):  # pragma: no cover
+    """ Start a worker on a free port of the local machine and send its
+    port back through the given connection. Ran in the processes of
+    :class:`LocalWorkers`.
+    """
+    server = make_worker_server()
+    connection.send(server.server_address[1])
+    connection.close()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class LocalWorkers(object):
+    """ Workers running in processes of the local machine, to run and
+    test distributed runs without other nodes.
+
+    It can be used as a context manager, in which case the workers are
+    stopped when leaving the context::
+
+        with LocalWorkers(2) as workers:
+            run_distributed(folder, workers.urls, session=2,
+                            lod_threshold=3)
+
+    :attr urls: the base URL of each worker.
+
+    """
+
+    def __init__(self, count=2):
+        """ Constructor, starts the worker processes.
+
+        :kwarg count: the number of workers to start.
+
+        """
+        self.processes = []
+        self.urls = []
+        try:
+            for cnt in range(count):
+                parent, child = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=_run_local_worker, args=(child,))
+                process.daemon = True
+                process.start()
+                self.processes.append(process)
+                self.urls.append('http://localhost:%s' % parent.recv())
+                parent.close()
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        """ Stop the worker processes. """
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the LocalWorkers object. """
+        return 'LocalWorkers<%s>' % ', '.join(self.urls)
@@ -0,0 +1,286 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 hotspot significance, assesses by permutation whether the number of
+    QTLs found on a marker, or on a window around it, is larger than
+    expected by chance.
+
+Under the null hypothesis the QTLs are spread uniformly along the genetic
+map, in cM. For each permutation the QTLs are placed at random positions
+of the map, each on the closest marker of its linkage group, and the
+largest number of QTLs found in a window is kept. The count threshold is
+the ``1 - alpha`` quantile of these maxima, a marker is a significant
+hotspot if the number of QTLs in its window is above it.
+
+The QTLs are counted on the marker closest to their peak, the test does
+not apply to the QTLs counted on every marker of their interval.
+"""
+
+import bisect
+import collections
+import concurrent.futures
+import itertools
+import logging
+import math
+import os
+import random
+
+try:  # pragma: no cover
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from MQ2 import MQ2Exception, read_input_file, write_matrix
+
+
+LOG = logging.getLogger('MQ2')
+
+# Number of permutations ran by each task sent to the workers
+BATCH_SIZE = 250
+
+# Headers of the columns added to the map
+HOTSPOT_HEADERS = ['Window QTLs', 'Hotspot threshold', 'Significant']
+
+
+def get_windows(genetic_map, window=0):
+    """ Return for each marker of the genetic map the ``(start, stop)``
+    indexes of the markers in its window: the markers of the same
+    linkage group located at most ``window / 2`` cM from it.
+    The indexes refer to the order of the markers in the map which must
+    be sorted by linkage group and position.
+
+    :arg genetic_map: the genetic map without headers, as a list of
+        ``marker, linkage group, position`` rows.
+    :kwarg window: the size of the window in cM, with a window of 0 only
+        the marker itself is considered.
+
+    """
+    if not window:
+        return [(cnt, cnt + 1) for cnt in range(len(genetic_map))]
+    windows = []
+    for group, rows in itertools.groupby(
+            enumerate(genetic_map), key=lambda row: row[1][1]):
+        rows = list(rows)
+        offset = rows[0][0]
+        try:
+            positions = [float(row[1][2]) for row in rows]
+        except (IndexError, ValueError):
+            windows.extend([(cnt, cnt + 1) for cnt, row in rows])
+            continue
+        for position in positions:
+            start = bisect.bisect_left(positions, position - window / 2.)
+            stop = bisect.bisect_right(positions, position + window / 2.)
+            windows.append((offset + start, offset + stop))
+    return windows
+
+
+def get_marker_weights(genetic_map):
+    """ Return for each marker of the genetic map the length of the map,
+    in cM, for which it is the closest marker of its linkage group: half
+    the distance to the previous marker plus half the distance to the
+    next one. The markers whose position is unknown have a weight of 0,
+    as have all the markers if the map has no length.
+    The map must be sorted by linkage group and position.
+
+    :arg genetic_map: the genetic map without headers, as a list of
+        ``marker, linkage group, position`` rows.
+
+    """
+    weights = []
+    for group, rows in itertools.groupby(
+            genetic_map, key=lambda row: row[1]):
+        rows = list(rows)
+        try:
+            positions = [float(row[2]) for row in rows]
+        except (IndexError, ValueError):
+            weights.extend([0.] * len(rows))
+            continue
+        middles = [(first + second) / 2.
+                   for first, second in zip(positions, positions[1:])]
+        weights.extend([stop - start for start, stop in zip(
+            positions[:1] + middles, middles + positions[-1:])])
+    if not sum(weights):
+        return [1.] * len(genetic_map)
+    return weights
+
+
+def _get_window_counts(counts, windows):
+    """ Return the number of QTLs found in each window given the number of
+    QTLs found on each marker.
+    """
+    cumulated = list(itertools.accumulate(counts, initial=0))
+    return [cumulated[stop] - cumulated[start] for start, stop in windows]
+
+
+def _permute(nr_qtls, weights, windows, permutations, seed):
+    """ Run a batch of permutations, the QTLs being placed on each marker
+    with a probability proportional to its weight, and return, for each
+    of them, the largest number of QTLs found in a window.
+    """
+    nr_markers = len(weights)
+    if numpy is not None:
+        generator = numpy.random.default_rng(seed)
+        total = float(sum(weights))
+        counts = generator.multinomial(
+            nr_qtls, [weight / total for weight in weights],
+            size=permutations)
+        if all([stop - start == 1 for start, stop in windows]):
+            return [int(value) for value in counts.max(axis=1)]
+        cumulated = numpy.zeros(
+            (permutations, nr_markers + 1), dtype=counts.dtype)
+        numpy.cumsum(counts, axis=1, out=cumulated[:, 1:])
+        starts, stops = [numpy.array(col) for col in zip(*windows)]
+        maxima = (cumulated[:, stops] - cumulated[:, starts]).max(axis=1)
+        return [int(value) for value in maxima]
+
+    generator = random.Random(seed)
+    markers = range(nr_markers)
+    cum_weights = list(itertools.accumulate(weights))
+    single = all([stop - start == 1 for start, stop in windows])
+    maxima = []
+    for cnt in range(permutations):
+        counts = collections.Counter(generator.choices(
+            markers, cum_weights=cum_weights, k=nr_qtls))
+        if single:
+            maxima.append(max(counts.values()) if counts else 0)
+        else:
+            counts = [counts.get(marker, 0) for marker in markers]
+            maxima.append(max(_get_window_counts(counts, windows)))
+    return maxima
+
+
+def get_hotspot_threshold(nr_qtls, windows, permutations=1000, alpha=0.05,
+                          workers=None, seed=None, weights=None):
+    """ Return the number of QTLs above which a window is a significant
+    hotspot at the given alpha level.
+
+    :arg nr_qtls: the number of QTLs to place on the map.
+    :arg windows: the windows of the markers, see :func:`get_windows`.
+    :kwarg permutations: the number of permutations to run.
+    :kwarg alpha: the significance level.
+    :kwarg workers: the number of processes in which to run the
+        permutations, defaults to the number of CPUs. With a single
+        worker the permutations are ran in the current process.
+    :kwarg seed: the seed of the random number generator, to obtain
+        reproducible thresholds.
+    :kwarg weights: the weight of each marker, see
+        :func:`get_marker_weights`, by default the QTLs are placed
+        uniformly over the markers.
+
+    """
+    if not windows or not nr_qtls:
+        return 0
+    permutations = int(permutations)
+    if permutations < 1:
+        raise MQ2Exception('The number of permutations should be a '
+                           'positive integer')
+    if not 0 < alpha < 1:
+        raise MQ2Exception('The alpha level should be between 0 and 1')
+
+    if weights is None:
+        weights = [1.] * len(windows)
+    generator = random.Random(seed)
+    batches = []
+    for start in range(0, permutations, BATCH_SIZE):
+        batches.append((nr_qtls, weights, windows,
+                        min(BATCH_SIZE, permutations - start),
+                        generator.getrandbits(64)))
+
+    workers = min(workers or os.cpu_count() or 1, len(batches))
+    maxima = []
+    if workers == 1:
+        for batch in batches:
+            maxima.extend(_permute(*batch))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for output in executor.map(_permute, *zip(*batches)):
+                maxima.extend(output)
+
+    maxima.sort()
+    index = int(math.ceil((1 - alpha) * len(maxima))) - 1
+    return maxima[max(index, 0)]
+
+
+def add_hotspot_significance(map_with_qtls, permutations=1000, alpha=0.05,
+                             window=0, workers=None, seed=None):
+    """ Return the genetic map with the number of QTLs found on each
+    marker (see :func:`MQ2.add_qtl_to_map.add_qtl_to_map_list`) with three
+    extra columns: the number of QTLs in the window of the marker, the
+    hotspot threshold and whether the marker is a significant hotspot
+    (``1``) or not (``0``).
+
+    :arg map_with_qtls: the genetic map, the first row being the headers
+        and the last column the number of QTLs found on each marker.
+    :kwarg window: the size in cM of the window around each marker in
+        which to count the QTLs, see :func:`get_windows`.
+
+    See :func:`get_hotspot_threshold` for the other arguments.
+
+    """
+    rows = [list(row) for row in map_with_qtls[1:]]
+    order = list(range(len(rows)))
+
+    def _get_key(cnt):
+        """ Sort the markers by linkage group and position. """
+        try:
+            return (rows[cnt][1], float(rows[cnt][2]))
+        except (IndexError, ValueError):
+            return (rows[cnt][1], 0)
+    order.sort(key=_get_key)
+
+    genetic_map = [rows[cnt] for cnt in order]
+    windows = get_windows(genetic_map, window=window)
+    counts = [int(row[-1]) for row in genetic_map]
+    threshold = get_hotspot_threshold(
+        sum(counts), windows, permutations=permutations, alpha=alpha,
+        workers=workers, seed=seed,
+        weights=get_marker_weights(genetic_map))
+    LOG.info('- Hotspot threshold: %s QTLs (%s permutations, alpha %s)'
+             % (threshold, permutations, alpha))
+
+    window_counts = _get_window_counts(counts, windows)
+    for cnt, count in zip(order, window_counts):
+        rows[cnt].extend([str(count), str(threshold),
+                          str(int(count > threshold))])
+    return [list(map_with_qtls[0]) + HOTSPOT_HEADERS] + rows
+
+
+def add_hotspot_to_map(map_qtl_file, permutations=1000, alpha=0.05,
+                       window=0, workers=None, seed=None):
+    """ Add the hotspot significance to the map with the number of QTLs
+    found on each marker, see :func:`add_hotspot_significance`.
+
+    :arg map_qtl_file: the file containing the map with the number of
+        QTLs found on each marker, it is overwritten.
+
+    """
+    markers = read_input_file(map_qtl_file, sep=',')
+    markers = add_hotspot_significance(
+        markers, permutations=permutations, alpha=alpha, window=window,
+        workers=workers, seed=seed)
+    write_matrix(map_qtl_file, markers)
+    LOG.info('- %s significant hotspots in %s' % (
+        len([row for row in markers[1:] if row[-1] == '1']), map_qtl_file))
@@ -0,0 +1,412 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 LOD store, keeps the LOD values of a QTL matrix in a memory-mapped
+    file so that datasets larger than the memory can be analyzed.
+
+The values are stored as native 64 bits floats, trait after trait (all
+the positions of the first trait, then all the positions of the second
+trait...), missing values being stored as NaN. The markers, traits and
+number of decimals of each trait are kept in a JSON file next to the
+data file (``<path>.json``), as well as the zone map of the LOD values
+(see :mod:`MQ2.zonemap`), updated for the traits written since the last
+flush.
+The plugins write the values trait by trait or row by row and the stages
+of MQ² read them block by block, a block being a range of traits, so that
+only a block has to be loaded in memory at a time.
+"""
+
+import array
+import json
+import logging
+import math
+import mmap
+import os
+
+from MQ2 import MQ2Exception
+from MQ2.zonemap import ZoneMap
+
+
+LOG = logging.getLogger('MQ2')
+
+# Memory used by a block of traits read from the store, in bytes
+BLOCK_MEMORY = 64 * 1024 * 1024
+
+# Size of the values in the store, in bytes
+ITEM_SIZE = array.array('d').itemsize
+
+NAN = float('nan')
+
+
+def _get_decimals(value):
+    """ Return the number of decimals of the given string representation
+    of a number, None if it is not written with a fixed number of
+    decimals.
+    """
+    if 'e' in value or 'E' in value:
+        return None
+    if '.' not in value:
+        return 0
+    return len(value) - value.index('.') - 1
+
+
+def get_block_size(nr_positions, memory=None):
+    """ Return the number of traits of ``nr_positions`` LOD values each
+    fitting in the given memory, in bytes (by default
+    :data:`BLOCK_MEMORY`). A block contains at least one trait.
+    """
+    memory = memory or BLOCK_MEMORY
+    return max(1, int(memory // max(nr_positions * ITEM_SIZE, 1)))
+
+
+def format_value(value, decimals=None):
+    """ Return the string representation of a value of the store, with the
+    given number of decimals if specified. Missing values are returned as
+    an empty string.
+    """
+    if math.isnan(value):
+        return ''
+    if decimals is None:
+        return str(value)
+    return '%.*f' % (decimals, value)
+
+
+def to_values(values, decimals=-1):
+    """ Return the given LOD values as an array of floats, missing values
+    (None or an empty string) being NaN, and the number of decimals used
+    by the values written as strings: -1 if there are none, None if they
+    do not all use the same fixed number of decimals.
+
+    :arg values: the LOD values, as numbers or strings.
+    :kwarg decimals: the number of decimals of the values previously
+        converted for the same trait.
+
+    """
+    output = array.array('d')
+    for value in values:
+        if value is None or value == '':
+            output.append(NAN)
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+            if not value:
+                output.append(NAN)
+                continue
+            value_decimals = _get_decimals(value)
+            if decimals == -1:
+                decimals = value_decimals
+            elif decimals != value_decimals:
+                decimals = None
+        output.append(float(value))
+    return output, decimals
+
+
+class LODStore(object):
+    """ A matrix of LOD values in a memory-mapped file, see the
+    documentation of the module.
+
+    Use :meth:`create` to create a new store and :meth:`open` to open an
+    existing one. Stores can be used as context managers, the store is
+    closed when leaving the context.
+
+    :attr markers: the list of ``marker, linkage group, position`` of
+        each position (row) of the matrix.
+    :attr traits: the list of the traits (columns) of the matrix.
+    :attr headers: the headers of the marker columns of the matrix.
+    :attr block_memory: the memory, in bytes, used by a block of traits
+        returned by :meth:`iter_blocks`.
+    :attr zones: the :class:`~MQ2.zonemap.ZoneMap` of the LOD values, None
+        for a store written by a version of MQ² without zone maps.
+
+    """
+
+    def __init__(self, path, markers, traits, headers, decimals=None,
+                 writable=False, zones=None):
+        """ Constructor, use :meth:`create` or :meth:`open` instead. """
+        self.path = path
+        self.markers = markers
+        self.traits = traits
+        self.headers = headers
+        self.decimals = decimals or [-1] * len(traits)
+        self.writable = writable
+        self.zones = zones
+        if writable:
+            self.zones = ZoneMap.from_markers(markers)
+        self._changed = set()
+        self.nr_positions = len(markers)
+        self.block_memory = BLOCK_MEMORY
+        size = max(len(traits) * self.nr_positions * ITEM_SIZE, ITEM_SIZE)
+        if writable:
+            self._stream = open(path, 'w+b')
+            self._stream.truncate(size)
+            access = mmap.ACCESS_WRITE
+        else:
+            self._stream = open(path, 'rb')
+            access = mmap.ACCESS_READ
+        self._mmap = mmap.mmap(self._stream.fileno(), size, access=access)
+
+    @classmethod
+    def create(cls, path, markers, traits,
+               headers=('Locus', 'Group', 'Position'), zones=True):
+        """ Create a new store, of the size required by the given markers
+        and traits, in the given file.
+
+        :arg path: the path of the data file of the store.
+        :arg markers: the list of ``marker, linkage group, position`` of
+            each position of the matrix.
+        :arg traits: the list of the traits of the matrix.
+        :kwarg headers: the headers of the marker columns.
+        :kwarg zones: whether to keep the zone map of the LOD values.
+
+        """
+        LOG.debug('Creating a LOD store of %s positions x %s traits in %s'
+                  % (len(markers), len(traits), path))
+        store = cls(path, [list(row) for row in markers], list(traits),
+                    list(headers), writable=True)
+        if not zones:
+            store.zones = None
+        return store
+
+    @classmethod
+    def open(cls, path):
+        """ Open, read-only, the store kept in the given file. """
+        try:
+            with open('%s.json' % path) as stream:
+                info = json.load(stream)
+        except (IOError, ValueError) as err:
+            raise MQ2Exception('Could not open the LOD store %s: %s'
+                               % (path, err))
+        zones = None
+        if info.get('zones'):
+            zones = ZoneMap.from_dict(info['zones'])
+        return cls(path, info['markers'], info['traits'], info['headers'],
+                   decimals=info['decimals'], zones=zones)
+
+    @classmethod
+    def from_data_file(cls, path, markers, traits, decimals,
+                       headers=('Locus', 'Group', 'Position')):
+        """ Open, read-only, a data file containing the LOD values of the
+        given traits, written trait after trait as by :meth:`set_trait`
+        (see :func:`to_values`), without the description of the store.
+
+        :arg path: the path of the data file.
+        :arg markers: the list of ``marker, linkage group, position`` of
+            each position of the matrix.
+        :arg traits: the list of the traits of the matrix.
+        :arg decimals: the number of decimals of each trait, see
+            :func:`to_values`.
+        :kwarg headers: the headers of the marker columns.
+
+        """
+        return cls(path, [list(row) for row in markers], list(traits),
+                   list(headers), decimals=list(decimals))
+
+    @classmethod
+    def from_matrix_file(cls, matrix_file, path, chunk_size=1000):
+        """ Create a store from a QTL matrix file, as written by the
+        plugins, reading it a chunk of rows at a time.
+
+        :arg matrix_file: the path to the QTL matrix file.
+        :arg path: the path of the data file of the store.
+        :kwarg chunk_size: the number of rows read at a time.
+
+        """
+        markers = []
+        with open(matrix_file) as stream:
+            headers = stream.readline().strip().split(',')
+            for row in stream:
+                markers.append(row.strip().split(',', 3)[:3])
+        store = cls.create(path, markers, headers[3:], headers=headers[:3])
+        with open(matrix_file) as stream:
+            stream.readline()
+            rows = []
+            start = 0
+            for row in stream:
+                rows.append(row.strip().split(',')[3:])
+                if len(rows) == chunk_size:
+                    store.set_rows(start, rows)
+                    start += len(rows)
+                    rows = []
+            store.set_rows(start, rows)
+        store.flush()
+        return store
+
+    def _get_offset(self, trait, position=0):
+        """ Return the offset in the file of the given position of the
+        given trait.
+        """
+        return (trait * self.nr_positions + position) * ITEM_SIZE
+
+    def _to_values(self, trait, values):
+        """ Return the given values as an array of floats, recording the
+        number of decimals used by the trait if they are strings.
+        """
+        output, self.decimals[trait] = to_values(
+            values, decimals=self.decimals[trait])
+        return output
+
+    def set_trait(self, trait, values, position=0):
+        """ Write the LOD values of a trait.
+
+        :arg trait: the index of the trait.
+        :arg values: the LOD values, as numbers or strings, an empty
+            string or None being a missing value.
+        :kwarg position: the index of the position of the first value.
+
+        """
+        values = self._to_values(trait, values)
+        offset = self._get_offset(trait, position)
+        self._mmap[offset:offset + len(values) * ITEM_SIZE] = \
+            values.tobytes()
+        self._changed.add(trait)
+
+    def set_rows(self, start, rows):
+        """ Write the LOD values of consecutive positions of the matrix.
+
+        :arg start: the index of the position of the first row.
+        :arg rows: the rows of LOD values, one value per trait.
+
+        """
+        if not rows:
+            return
+        for trait in range(len(self.traits)):
+            self.set_trait(trait, [row[trait] for row in rows],
+                           position=start)
+
+    def get_trait(self, trait, start=0, stop=None):
+        """ Return the LOD values of a trait as an array of floats.
+
+        :arg trait: the index of the trait.
+        :kwarg start: the index of the first position to return.
+        :kwarg stop: the index of the position after the last one to
+            return, defaults to the number of positions.
+
+        """
+        if stop is None:
+            stop = self.nr_positions
+        values = array.array('d')
+        values.frombytes(self._mmap[self._get_offset(trait, start):
+                                    self._get_offset(trait, stop)])
+        return values
+
+    def get_block_size(self, memory=None):
+        """ Return the number of traits of a block using at most the given
+        memory, in bytes (by default :attr:`block_memory`).
+        """
+        return get_block_size(self.nr_positions,
+                              memory or self.block_memory)
+
+    def iter_blocks(self, block_size=None):
+        """ Iterate over the blocks of traits of the store, yielding for
+        each block the index of its first trait, the name of its traits
+        and their LOD values as arrays of floats.
+
+        :kwarg block_size: the number of traits per block, defaults to
+            the number of traits fitting in :attr:`block_memory`.
+
+        """
+        block_size = block_size or self.get_block_size()
+        for start in range(0, len(self.traits), block_size):
+            stop = min(start + block_size, len(self.traits))
+            yield (start, self.traits[start:stop],
+                   [self.get_trait(trait) for trait in range(start, stop)])
+
+    def iter_rows(self, chunk_size=1000):
+        """ Iterate over the rows of the QTL matrix, as written in the
+        QTL matrix file: the marker columns followed by the formatted LOD
+        value of each trait. The first row contains the headers.
+        Only ``chunk_size`` rows are loaded in memory at a time.
+        """
+        yield list(self.headers) + list(self.traits)
+        decimals = [None if value == -1 else value
+                    for value in self.decimals]
+        for start in range(0, self.nr_positions, chunk_size):
+            stop = min(start + chunk_size, self.nr_positions)
+            columns = [self.get_trait(trait, start, stop)
+                       for trait in range(len(self.traits))]
+            for cnt in range(stop - start):
+                row = list(self.markers[start + cnt])
+                row.extend([format_value(column[cnt], decimals[trait])
+                            for trait, column in enumerate(columns)])
+                yield row
+
+    def write_matrix_file(self, matrix_file):
+        """ Write the QTL matrix contained in the store in the given file,
+        a chunk of rows at a time.
+        """
+        with open(matrix_file, 'w') as stream:
+            for row in self.iter_rows():
+                stream.write(','.join(
+                    [str(cel).strip() for cel in row]) + '\n')
+        LOG.info('Wrote QTLs in file %s' % matrix_file)
+
+    def flush(self):
+        """ Write the pending changes and the description of the store on
+        the disk.
+        """
+        if not self.writable:
+            return
+        self._mmap.flush()
+        if self.zones is not None:
+            for trait in range(len(self.traits)):
+                if trait in self._changed or trait >= self.zones.nr_traits:
+                    self.zones.set_trait(trait, self.get_trait(trait))
+        self._changed = set()
+        info = {
+            'markers': self.markers,
+            'traits': self.traits,
+            'headers': self.headers,
+            'decimals': self.decimals,
+            'zones': self.zones.to_dict() if self.zones else None,
+        }
+        with open('%s.json' % self.path, 'w') as stream:
+            json.dump(info, stream)
+
+    def close(self):
+        """ Flush and close the store. """
+        if self._mmap.closed:
+            return
+        self.flush()
+        self._mmap.close()
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the LODStore object. """
+        return 'LODStore<%s positions x %s traits>' % (
+            self.nr_positions, len(self.traits))
+
+
+def remove_store(path):
+    """ Remove the files of the store kept in the given file. """
+    for filename in [path, '%s.json' % path]:
+        if os.path.exists(filename):
+            os.unlink(filename)
@@ -27,24 +27,67 @@
 MQ2 map chart generation from the data matrix.
 """
 
+import bisect
+import concurrent.futures
+import os
 import re
 import logging
 
-from MQ2 import read_input_file, write_matrix
-from MQ2.qtl import QTL
+from MQ2 import MQ2Exception, read_input_file, write_matrix
+from MQ2.qtl import QTL, QTLSet
+from MQ2.shared import SharedLODs
+from MQ2.zonemap import ZoneMap, get_groups, get_profile_zones
 
 
 LOG = logging.getLogger('MQ2')
 
+# Drop of LOD from the peak defining the limits of a QTL interval
+INTERVAL_THRESHOLD = 2
+
+
+def _get_interval(markers, lods, peak):
+    """ Return the index of the first and of the last marker of the QTL
+    interval around the given peak.
+    The interval is a LOD 2 interval (see :data:`INTERVAL_THRESHOLD`).
+    The approach is conservative in the way it takes the first and last
+    marker within the interval.
+
+    :arg markers: the name of the markers of the linkage group.
+    :arg lods: the LOD values of the trait at each of these markers.
+    :arg peak: the index of the peak of the QTL.
+
+    """
+    lod2_threshold = float(lods[peak]) - float(INTERVAL_THRESHOLD)
+    # Search QTL start
+    cnt = start = peak
+    while cnt >= 0:
+        start = cnt
+        if re.match(r'c\d+\.loc[\d\.]+', markers[cnt]):
+            cnt = cnt - 1
+            continue
+        if float(lods[cnt]) < lod2_threshold:
+            break
+        cnt = cnt - 1
+
+    # Search QTL end
+    cnt = end = peak
+    while cnt < len(markers):
+        end = cnt
+        if re.match(r'c\d+\.loc[\d\.]+', markers[cnt]):
+            cnt += 1
+            continue
+        if float(lods[cnt]) < lod2_threshold:
+            break
+        cnt = cnt + 1
+    return start, end
+
 
 def _extrac_qtl(peak, block, headers):
     """ Given a row containing the peak of the QTL and all the rows of
     the linkage group of the said QTL (splitted per trait), determine
     the QTL interval and find the start and stop marker of the said
-    interval.
-    The interval is a LOD 2 interval.
-    The approach is conservative in the way it takes the first and last
-    marker within the interval.
+    interval, see :func:`_get_interval`.
+    Returns the QTLs found as a :class:`~MQ2.qtl.QTLSet`.
 
     :arg peak, a list containing the row information for the peak marker
     :arg block, a hash containing per column, all the rows in the
@@ -53,48 +96,27 @@ def _extrac_qtl(peak, block, headers):
         which block to look at for each trait process.
 
     """
-    qtls = []
+    qtls = QTLSet()
     if not peak:
         return qtls
-    threshold = 2
     for trait in peak:
         blockcnt = headers.index(trait)
         local_block = block[blockcnt]
-        lod2_threshold = float(peak[trait][-1]) - float(threshold)
-        # Search QTL start
-        cnt = local_block.index(peak[trait])
-        start = local_block[cnt]
-        while cnt >= 0:
-            start = local_block[cnt]
-            if re.match(r'c\d+\.loc[\d\.]+', local_block[cnt][0]):
-                cnt = cnt - 1
-                continue
-            if float(local_block[cnt][-1]) < lod2_threshold:
-                break
-            cnt = cnt - 1
-
-        # Search QTL end
-        end = []
-        cnt = local_block.index(peak[trait])
-        end = local_block[cnt]
-        while cnt < len(local_block):
-            end = local_block[cnt]
-            if re.match(r'c\d+\.loc[\d\.]+', local_block[cnt][0]):
-                cnt += 1
-                continue
-            if float(local_block[cnt][-1]) < lod2_threshold:
-                break
-            cnt = cnt + 1
+        start, end = _get_interval(
+            [row[0] for row in local_block],
+            [row[-1] for row in local_block],
+            local_block.index(peak[trait]))
+        start = local_block[start]
+        end = local_block[end]
 
         qtl = QTL()
         qtl.trait = trait
+        qtl.linkage_group = peak[trait][1]
         qtl.start_mk = start[0]
-        qtl.start_position = start[2]
         qtl.peak_mk = peak[trait][0]
-        qtl.peak_start_position = peak[trait][2]
-        qtl.peak_stop_position = peak[trait][2]
         qtl.stop_mk = end[0]
-        qtl.stop_position = end[2]
+        qtl.set_positions(start[2], peak[trait][2], end[2])
+        qtl.peak_lod = float(peak[trait][-1])
         qtls.append(qtl)
     return qtls
 
@@ -121,21 +143,25 @@ def _order_linkage_group(group):
     return output
 
 
-def generate_map_chart_file(qtl_matrix, lod_threshold,
-                            map_chart_file='MapChart.map'):
-    """ This function converts our QTL matrix file into a MapChart input
-    file.
+def get_map_chart_data(qtl_matrix, lod_threshold, zones=None):
+    """ Return, for each linkage group of the QTL matrix, the list of its
+    markers and their position and the list of QTLs found on it.
 
-    :arg qtl_matrix: the path to the QTL matrix file generated by
-        the plugin.
+    :arg qtl_matrix: the QTL matrix as a list of rows, the first row
+        being the headers and the last column the number of QTLs (see
+        :func:`MQ2.mq2.add_count_to_matrix`).
     :arg lod_threshold: threshold used to determine if a given LOD value
         is reflective the presence of a QTL.
-    :kwarg map_chart_file: name of the output file containing the
-        MapChart information.
+    :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the QTL matrix, if
+        specified only the LOD values of the zones reaching the threshold
+        are looked at.
 
     """
+    if zones is not None:
+        return get_map_chart_data_from_qtls(
+            [row[:3] for row in qtl_matrix[1:]],
+            get_map_chart_qtls(qtl_matrix, lod_threshold, zones=zones))
 
-    qtl_matrix = read_input_file(qtl_matrix, sep=',')
     tmp_dic = {}
     cnt = 1
     tmp = {}
@@ -180,62 +206,445 @@ def generate_map_chart_file(qtl_matrix, lod_threshold,
                     tmp[qtl_matrix[0][colcnt]] = temp
             colcnt = colcnt + 1
         cnt = cnt + 1
+    return tmp_dic
+
+
+def get_map_chart_data_from_store(store, lod_threshold, zones=None):
+    """ Return the same data as :func:`get_map_chart_data` for the QTL
+    matrix kept in a :class:`~MQ2.lodstore.LODStore`, or any object
+    offering the same reading interface (such as a
+    :class:`~MQ2.chunked.MatrixFile`), reading it one block of traits at
+    a time.
+
+    :arg store: the :class:`~MQ2.lodstore.LODStore` to read.
+    :arg lod_threshold: threshold used to determine if a given LOD value
+        is reflective the presence of a QTL.
+    :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the LOD values,
+        defaults to the one of the store. If known, only the zones
+        reaching the threshold are searched and, if the store offers a
+        ``get_trait`` method (as a :class:`~MQ2.lodstore.LODStore` does),
+        only their LOD values are read.
+
+    """
+    zones = zones or getattr(store, 'zones', None)
+    if zones is not None and getattr(store, 'get_trait', None):
+        return _get_map_chart_data_from_zones(
+            store.markers, store.traits, zones, lod_threshold,
+            store.get_trait)
+
+    lod_threshold = float(lod_threshold)
+    groups = get_groups(store.markers)
+    # As in get_map_chart_data, the last linkage group is not searched
+    found = [[] for group in groups[:-1]]
+    for offset, traits, profiles in store.iter_blocks():
+        for colcnt, (trait, lods) in enumerate(zip(traits, profiles)):
+            if zones is not None:
+                maxima, peaks = zones.get_zones(offset + colcnt)
+            else:
+                maxima, peaks = get_profile_zones(lods, groups[:-1])
+            for groupcnt, (linkgrp, start, stop) in enumerate(groups[:-1]):
+                if not maxima[groupcnt] >= lod_threshold:
+                    continue
+                first, qtl = _get_zone_qtl(
+                    trait, linkgrp, store.markers[start:stop],
+                    lods[start:stop], peaks[groupcnt] - start, lod_threshold)
+                found[groupcnt].append(
+                    (start + first, offset + colcnt, qtl))
+    return _get_map_chart_dict(store.markers, groups, found)
+
+
+def _get_map_chart_data_from_zones(markers, traits, zones, lod_threshold,
+                                   get_lods):
+    """ Return the data of :func:`get_map_chart_data` given the markers and
+    the traits of the QTL matrix and its :class:`~MQ2.zonemap.ZoneMap`,
+    only looking at the LOD values of the zones reaching the threshold.
+
+    :arg get_lods: a function returning the LOD values of a trait between
+        two rows, given the index of the trait and of the two rows.
+
+    """
+    found = _find_zone_qtls(markers, traits, zones, lod_threshold, get_lods)
+    return _get_map_chart_dict(markers, zones.groups, found)
+
+
+def _find_zone_qtls(markers, traits, zones, lod_threshold, get_lods,
+                    start=0, stop=None):
+    """ Return the QTLs found on each linkage group (but the last one) as
+    ``(first row above threshold, trait index, QTL)``, see
+    :func:`_get_map_chart_data_from_zones`.
+
+    :kwarg start: the index of the first trait to search.
+    :kwarg stop: the index of the trait after the last one to search,
+        defaults to the number of traits.
+
+    """
+    lod_threshold = float(lod_threshold)
+    groups = zones.groups
+    # As in get_map_chart_data, the last linkage group is not searched
+    found = [[] for group in groups[:-1]]
+    if stop is None:
+        stop = len(traits)
+    for colcnt in range(start, stop):
+        peaks = zones.get_zones(colcnt)[1]
+        for groupcnt in zones.get_significant_groups(colcnt, lod_threshold):
+            if groupcnt == len(groups) - 1:
+                continue
+            linkgrp, first_row, last_row = groups[groupcnt]
+            first, qtl = _get_zone_qtl(
+                traits[colcnt], linkgrp, markers[first_row:last_row],
+                get_lods(colcnt, first_row, last_row),
+                peaks[groupcnt] - first_row, lod_threshold)
+            found[groupcnt].append((first_row + first, colcnt, qtl))
+    return found
+
+
+def get_map_chart_data_from_shared(shared, lod_threshold, processes=None):
+    """ Return the same data as :func:`get_map_chart_data` for the QTL
+    matrix kept in a :class:`~MQ2.shared.SharedLODs`, the traits being
+    split between several processes which read the LOD values in place.
+
+    :arg shared: the :class:`~MQ2.shared.SharedLODs` to read, its zone
+        map should be known.
+    :arg lod_threshold: threshold used to determine if a given LOD value
+        is reflective the presence of a QTL.
+    :kwarg processes: the number of processes in which to search the
+        QTLs, defaults to the number of CPUs. With a single process the
+        QTLs are searched in the current process.
+
+    """
+    zones = shared.zones
+    if zones is None:
+        raise MQ2Exception('The zone map of the shared LOD matrix is '
+                           'required to search its QTLs')
+    nr_traits = len(shared.traits)
+    processes = max(min(processes or os.cpu_count() or 1, nr_traits), 1)
+    if processes == 1:
+        return _get_map_chart_data_from_zones(
+            shared.markers, shared.traits, zones, lod_threshold,
+            shared.get_trait)
+
+    step = -(-nr_traits // processes)
+    tasks = [(shared.name, lod_threshold, start,
+              min(start + step, nr_traits))
+             for start in range(0, nr_traits, step)]
+    found = [[] for group in zones.groups[:-1]]
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        for output in executor.map(_search_shared, *zip(*tasks)):
+            for groupcnt, qtls_found in enumerate(output):
+                found[groupcnt].extend(qtls_found)
+    return _get_map_chart_dict(shared.markers, zones.groups, found)
+
+
+def _search_shared(name, lod_threshold, start, stop):
+    """ Return the QTLs found, see :func:`_find_zone_qtls`, for the given
+    traits of the :class:`~MQ2.shared.SharedLODs` of the given name.
+    Ran in the worker processes of :func:`get_map_chart_data_from_shared`.
+    """
+    with SharedLODs.attach(name) as shared:
+        return _find_zone_qtls(
+            shared.markers, shared.traits, shared.zones, lod_threshold,
+            shared.get_trait, start=start, stop=stop)
+
+
+def _get_zone_qtl(trait, linkgrp, markers, lods, peak, lod_threshold):
+    """ Return the index of the first row reaching the threshold in the
+    rows of a linkage group and the QTL of the trait on it, see
+    :func:`_get_qtl`.
+    """
+    first = 0
+    while not lods[first] >= lod_threshold:
+        first += 1
+    return first, _get_qtl(trait, linkgrp, markers,
+                           [row[0] for row in markers], lods, peak)
+
+
+def _get_qtl(trait, linkgrp, markers, names, lods, peak):
+    """ Return the :class:`~MQ2.qtl.QTL` of the given trait whose peak
+    is at the given index of the markers of the linkage group, see
+    :func:`_get_interval`.
+    """
+    interval_start, interval_end = _get_interval(names, lods, peak)
+    qtl = QTL()
+    qtl.trait = trait
+    qtl.linkage_group = linkgrp
+    qtl.start_mk = markers[interval_start][0]
+    qtl.peak_mk = markers[peak][0]
+    qtl.stop_mk = markers[interval_end][0]
+    qtl.set_positions(markers[interval_start][2],
+                      markers[peak][2],
+                      markers[interval_end][2])
+    qtl.peak_lod = lods[peak]
+    return qtl
+
+
+def get_map_chart_qtls(qtl_matrix, lod_threshold, zones=None):
+    """ Return the QTLs of the QTL matrix found on each linkage group (but
+    the last one) as ``(first row above threshold, trait index, QTL)``.
+    The QTLs found in several parts of the traits of a matrix can be
+    merged and turned into the data of :func:`get_map_chart_data` with
+    :func:`get_map_chart_data_from_qtls`.
+
+    :arg qtl_matrix: the QTL matrix as a list of rows, the first row
+        being the headers and the last column the number of QTLs.
+    :arg lod_threshold: threshold used to determine if a given LOD value
+        is reflective the presence of a QTL.
+    :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the QTL matrix,
+        computed from it if not specified.
+
+    """
+    if zones is None:
+        zones = ZoneMap.from_matrix(qtl_matrix, count_column=True)
+    rows = qtl_matrix[1:]
+
+    def get_lods(trait, start, stop):
+        """ Return the LOD values of the trait between the rows. """
+        return [_to_float(row[trait + 3]) for row in rows[start:stop]]
+
+    return _find_zone_qtls([row[:3] for row in rows], qtl_matrix[0][3:-1],
+                           zones, lod_threshold, get_lods)
+
+
+def get_trait_map_chart_qtls(markers, trait, lods, lod_threshold,
+                              zones=None):
+    """ Return the QTLs of a single trait found on each linkage group (but
+    the last one) as ``(first row above threshold, 0, QTL)``, see
+    :func:`get_map_chart_qtls`. The QTLs of several traits searched
+    separately can be merged once the index of each trait is set.
+
+    :arg markers: the list of ``marker, linkage group, position`` of
+        each row of the QTL matrix.
+    :arg trait: the name of the trait.
+    :arg lods: the LOD values of the trait at each row, as floats.
+    :arg lod_threshold: threshold used to determine if a given LOD value
+        is reflective the presence of a QTL.
+    :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the trait alone,
+        computed from its LOD values if not specified.
+
+    """
+    if zones is None:
+        zones = ZoneMap.from_markers(markers)
+        zones.add_trait(lods)
 
+    def get_lods(trait, start, stop):
+        """ Return the LOD values of the trait between the rows. """
+        return lods[start:stop]
+
+    return _find_zone_qtls(markers, [trait], zones, lod_threshold,
+                           get_lods)
+
+
+def get_map_chart_data_from_qtls(markers, found):
+    """ Return the data of :func:`get_map_chart_data` given the markers
+    of the QTL matrix and the QTLs found on each linkage group, see
+    :func:`get_map_chart_qtls`.
+
+    :arg markers: the list of ``marker, linkage group, position`` of
+        each row of the QTL matrix.
+    :arg found: for each linkage group but the last one, the list of the
+        QTLs found on it as ``(first row above threshold, trait index,
+        QTL)``.
+
+    """
+    return _get_map_chart_dict(markers, get_groups(markers), found)
+
+
+def _get_map_chart_dict(markers, groups, found):
+    """ Return the data of :func:`get_map_chart_data` given the markers,
+    the consecutive rows of each linkage group and the QTLs found on each
+    linkage group (but the last one) as ``(first row above threshold,
+    trait index, QTL)``.
+    """
+    tmp_dic = {}
+    for (linkgrp, start, stop), qtls_found in zip(groups, found + [[]]):
+        tmp_dic[linkgrp] = [
+            [[row[0], row[2]] for row in markers[start:stop]], []]
+        if not qtls_found:
+            continue
+        # The QTLs are listed in the order in which the traits first
+        # reach the threshold in the linkage group.
+        qtls_found.sort(key=lambda entry: entry[:2])
+        qtls = QTLSet()
+        qtls.extend([entry[2] for entry in qtls_found])
+        tmp_dic[linkgrp][1] = qtls
+    return tmp_dic
+
+
+def _to_float(value):
+    """ Return the LOD value of a cell as a float, NaN if it is missing.
+    """
+    value = value.strip()
+    if not value:
+        return float('nan')
+    return float(value)
+
+
+class _SparseProfile(dict):
+    """ The LOD values of a trait on a linkage group indexed by row, the
+    rows whose value was not kept being below any interval.
+    """
+
+    def __missing__(self, key):
+        return float('-inf')
+
+
+def get_map_chart_data_from_sparse(sparse, lod_threshold, zones=None):
+    """ Return the same data as :func:`get_map_chart_data` for the QTL
+    matrix kept in a :class:`~MQ2.sparse.SparseLODs`, only looking at the
+    LOD values kept.
+
+    :arg sparse: the :class:`~MQ2.sparse.SparseLODs` to read.
+    :arg lod_threshold: threshold used to determine if a given LOD value
+        is reflective the presence of a QTL.
+    :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the sparse matrix,
+        computed from it if not specified.
+
+    """
+    if zones is None:
+        zones = ZoneMap.from_sparse(sparse)
+
+    def get_lods(trait, start, stop):
+        """ Return the LOD values kept between the two rows. """
+        indexes = sparse.indexes[trait]
+        values = sparse.values[trait]
+        lods = _SparseProfile()
+        for cnt in range(bisect.bisect_left(indexes, start),
+                         bisect.bisect_left(indexes, stop)):
+            lods[indexes[cnt] - start] = values[cnt]
+        return lods
+
+    return _get_map_chart_data_from_zones(
+        sparse.markers, sparse.traits, zones, lod_threshold, get_lods)
+
+
+def format_map_chart(map_chart_data):
+    """ Return the content of the MapChart input file as a list of lines
+    and the flanking markers of each QTL, as a dictionary associating
+    the peak marker of the QTL to its flanking markers.
+
+    :arg map_chart_data: the output of :func:`get_map_chart_data`.
+
+    """
+    tmp_dic = map_chart_data
     qtl_info = {}
+    lines = []
+    keys = list(tmp_dic.keys())
+    ## Remove unknown group, reason:
+    # The unlinked markers, if present, are always put in group U by
+    # MapQTL. If you don't omit them and there are many (often), then
+    # their names take so much space that it is difficult to fit them
+    # on the page.
+    if 'U' in keys:
+        keys.remove('U')
+    # Try to convert all the groups to int, which would result in
+    # a better sorting. If that fails, fail silently.
+    try:
+        keys = [int(key) for key in keys]
+    except ValueError:
+        pass
+    keys.sort()
+    for key in keys:
+        key = str(key)  # Needed since we might have converted them to int
+        if tmp_dic[key]:
+            if key == 'U':  # pragma: no cover
+                # We removed the key before, we should not be here
+                continue
+            lines.append('group %s\n' % key)
+            for entry in _order_linkage_group(tmp_dic[key][0]):
+                lines.append('  '.join(entry) + '\n')
+            if tmp_dic[key][1]:
+                lines.append('\n')
+                lines.append('qtls\n')
+                qtl_info.update(tmp_dic[key][1].get_flanking_markers())
+                lines.extend(tmp_dic[key][1].to_map_chart())
+            lines.append('\n')
+            lines.append('\n')
+    return lines, qtl_info
+
 
+def generate_map_chart_file(qtl_matrix, lod_threshold,
+                            map_chart_file='MapChart.map', store=None,
+                            sparse=None, zones=None, shared=None,
+                            processes=None):
+    """ This function converts our QTL matrix file into a MapChart input
+    file.
+
+    :arg qtl_matrix: the path to the QTL matrix file generated by
+        the plugin.
+    :arg lod_threshold: threshold used to determine if a given LOD value
+        is reflective the presence of a QTL.
+    :kwarg map_chart_file: name of the output file containing the
+        MapChart information.
+    :kwarg store: a :class:`~MQ2.lodstore.LODStore` containing the LOD
+        values of the QTL matrix, if specified the QTL matrix file is
+        not read.
+    :kwarg sparse: a :class:`~MQ2.sparse.SparseLODs` containing the LOD
+        values of the QTL matrix above a floor, if specified the QTL
+        matrix file is not read.
+    :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the QTL matrix, if
+        specified only the zones reaching the threshold are searched.
+    :kwarg shared: a :class:`~MQ2.shared.SharedLODs` containing the LOD
+        values of the QTL matrix, if specified the QTL matrix file is
+        not read and the QTLs are searched in several processes.
+    :kwarg processes: the number of processes searching the QTLs of the
+        shared matrix, see :func:`get_map_chart_data_from_shared`.
+
+    """
+
+    if shared is not None:
+        map_chart_data = get_map_chart_data_from_shared(
+            shared, lod_threshold, processes=processes)
+    elif sparse is not None:
+        map_chart_data = get_map_chart_data_from_sparse(
+            sparse, lod_threshold, zones=zones)
+    elif store is not None:
+        map_chart_data = get_map_chart_data_from_store(
+            store, lod_threshold, zones=zones)
+    else:
+        qtl_matrix = read_input_file(qtl_matrix, sep=',')
+        map_chart_data = get_map_chart_data(qtl_matrix, lod_threshold,
+                                            zones=zones)
+    return write_map_chart_file(map_chart_data, map_chart_file)
+
+
+def write_map_chart_file(map_chart_data, map_chart_file='MapChart.map'):
+    """ Write the MapChart input file and return the flanking markers of
+    each QTL, see :func:`format_map_chart`.
+
+    :arg map_chart_data: the output of :func:`get_map_chart_data`.
+    :kwarg map_chart_file: name of the output file containing the
+        MapChart information.
+
+    """
+    lines, qtl_info = format_map_chart(map_chart_data)
+
+    stream = None
     try:
         stream = open(map_chart_file, 'w')
-        keys = list(tmp_dic.keys())
-        ## Remove unknown group, reason:
-        # The unlinked markers, if present, are always put in group U by
-        # MapQTL. If you don't omit them and there are many (often), then
-        # their names take so much space that it is difficult to fit them
-        # on the page.
-        if 'U' in keys:
-            keys.remove('U')
-        # Try to convert all the groups to int, which would result in
-        # a better sorting. If that fails, fail silently.
-        try:
-            keys = [int(key) for key in keys]
-        except ValueError:
-            pass
-        keys.sort()
-        for key in keys:
-            key = str(key)  # Needed since we might have converted them to int
-            if tmp_dic[key]:
-                if key == 'U':  # pragma: no cover
-                    # We removed the key before, we should not be here
-                    continue
-                stream.write('group %s\n' % key)
-                for entry in _order_linkage_group(tmp_dic[key][0]):
-                    stream.write('  '.join(entry) + '\n')
-                if tmp_dic[key][1]:
-                    stream.write('\n')
-                    stream.write('qtls\n')
-                    for qtl in tmp_dic[key][1]:
-                        qtl_info[qtl.peak_mk] = qtl.get_flanking_markers()
-                        stream.write('%s \n' % qtl.to_string())
-                stream.write('\n')
-                stream.write('\n')
+        stream.writelines(lines)
     except IOError as err:  # pragma: no cover
         LOG.info('An error occured while writing the map chart map '
                  'to the file %s' % map_chart_file)
         LOG.debug("Error: %s" % err)
     finally:
-        stream.close()
+        if stream:
+            stream.close()
     LOG.info('Wrote MapChart map in file %s' % map_chart_file)
 
     return qtl_info
 
 
-def append_flanking_markers(qtls_mk_file, flanking_markers):
-    """ Append the flanking markers extracted in the process of
-    generating the MapChart to the QTL list file.
+def add_flanking_markers(qtls_mk, flanking_markers):
+    """ Return the list of QTLs with their flanking markers appended.
+
+    :arg qtls_mk: the list of QTLs with their closest marker, the first
+        row being the headers.
+    :arg flanking_markers: the dictionary returned by
+        :func:`format_map_chart`.
+
     """
-    matrix = read_input_file(qtls_mk_file, sep=',')
     output = []
     cnt = 0
-    for row in matrix:
+    for row in qtls_mk:
         if cnt == 0:
             markers = ['LOD2 interval start', 'LOD2 interval end']
         elif row[3] in flanking_markers:
@@ -243,6 +652,16 @@ def append_flanking_markers(qtls_mk_file, flanking_markers):
         else:
             markers = ['NA', 'NA']
         cnt += 1
+        row = list(row)
         row.extend(markers)
         output.append(row)
+    return output
+
+
+def append_flanking_markers(qtls_mk_file, flanking_markers):
+    """ Append the flanking markers extracted in the process of
+    generating the MapChart to the QTL list file.
+    """
+    matrix = read_input_file(qtls_mk_file, sep=',')
+    output = add_flanking_markers(matrix, flanking_markers)
     write_matrix(qtls_mk_file, output)
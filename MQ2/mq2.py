@@ -29,6 +29,8 @@ MQ2 main program
 
 
 import argparse
+import datetime
+import inspect
 import logging
 import os
 import shutil
@@ -41,19 +43,60 @@ sys.path.insert(0, os.path.join(os.path.dirname(
 
 from MQ2 import (__version__,
                  set_tmp_folder,
+                 is_tmp_folder,
                  extract_zip,
+                 get_matrix_dimensions,
                  MQ2Exception,
                  read_input_file,
                  write_matrix)
 from MQ2.plugin_interface import PluginInterface
 from MQ2.add_marker_to_qtls import add_marker_to_qtls
+from MQ2.cache import ResultCache, DEFAULT_MAX_SIZE
+from MQ2.catalog import Catalog
+from MQ2.chunked import MatrixFile, get_memory_budget
+from MQ2.clustering import write_cluster_file
+from MQ2.colocalization import write_colocalization_file
+from MQ2.database import add_run
+from MQ2.hotspot import add_hotspot_to_map
+from MQ2.lodstore import LODStore, remove_store
 from MQ2.add_qtl_to_map import add_qtl_to_map
-from MQ2.mapchart import generate_map_chart_file, append_flanking_markers
+from MQ2.mapchart import (generate_map_chart_file, append_flanking_markers,
+                          write_map_chart_file, INTERVAL_THRESHOLD)
+from MQ2.profiling import Profiler
+from MQ2.scheduler import (get_required_stages, measure_stage,
+                           run_stages, uses)
+from MQ2.sparse import SparseLODs, get_default_floor
+from MQ2.streaming import convert_streaming, is_streaming
+from MQ2.shared import SharedLODs, get_shared_size
+from MQ2.windows import (get_windows_filename, parse_resolutions,
+                         write_window_files)
+from MQ2.zonemap import ZoneMap
 
 
-logging.basicConfig()
 LOG = logging.getLogger('MQ2')
 
+# Name of the files generated by a run of MQ²
+OUTPUT_FILES = {
+    'qtls': 'qtls.csv',
+    'matrix': 'qtls_matrix.csv',
+    'map': 'map.csv',
+    'map_qtl': 'map_with_qtls.csv',
+    'qtls_mk': 'qtls_with_mk.csv',
+    'map_chart': 'MapChart.map',
+}
+
+# Name of the optional file listing the colocalized traits
+COLOCALIZATION_FILE = 'colocalization.csv'
+
+# Name of the optional file listing the clusters of traits
+CLUSTER_FILE = 'trait_clusters.csv'
+
+# Name of the file in which the state of an incremental run is saved
+STATE_FILE = 'mq2_state.json'
+
+# Cache of the plugins loaded, see load_plugins()
+_PLUGINS = {}
+
 
 def _get_arguments():  # pragma: no cover
     """ Handle the command line arguments given to this program """
@@ -80,6 +123,146 @@ def _get_arguments():  # pragma: no cover
         '--session', default=None,
         help='Session to analyze if required.')
 
+    parser.add_argument(
+        '-o', '--output', dest='outputfolder', default=None,
+        help='Folder in which to write the output files, defaults to '
+        'the current working directory.')
+
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Keep the results of the parsing of each input file in the '
+        'output folder and only parse the new or modified files when '
+        'the same session is analyzed again.')
+
+    parser.add_argument(
+        '--lod-store', dest='lod_store', default=None,
+        help='Keep the LOD values in a memory-mapped file at the '
+        'specified path instead of in memory, to analyze datasets larger '
+        'than the memory.')
+
+    parser.add_argument(
+        '--max-memory', dest='max_memory', default=None, type=float,
+        help='Memory budget, in MB, of the LOD values processed at a time. '
+        'The traits are then read and processed in chunks sized to fit '
+        'in it instead of loading the whole QTL matrix in memory. With '
+        '--serve, the budget is shared by the workers.')
+
+    parser.add_argument(
+        '--sparse', action='store_true',
+        help='Only keep in memory the LOD values above a floor, the QTLs '
+        'are then counted and searched among these values only.')
+    parser.add_argument(
+        '--sparse-floor', dest='sparse_floor', default=None, type=float,
+        help='Lowest LOD value kept with --sparse, at most the LOD '
+        'threshold minus %s (the default).' % INTERVAL_THRESHOLD)
+    parser.add_argument(
+        '--processes', default=None, type=int,
+        help='Number of processes searching the QTLs of the MapChart '
+        'file, the LOD values being shared with them in memory.')
+    parser.add_argument(
+        '--stage-threads', dest='stage_threads', default=None, type=int,
+        help='Number of threads running the independent stages of the '
+        'run at the same time, defaults to the number of CPUs.')
+    parser.add_argument(
+        '--outputs', default=None, metavar='OUTPUT,...',
+        help='Only run the stages needed to produce the given comma '
+        'separated outputs, named by their file (map_with_qtls.csv) or '
+        'their key (map_qtl). By default all the outputs are produced.')
+    parser.add_argument(
+        '--count-intervals', dest='count_intervals', action='store_true',
+        help='Credit each QTL to all the markers of its LOD2 interval '
+        'instead of its closest marker only when counting the QTLs found '
+        'on each marker.')
+    parser.add_argument(
+        '--windows', default=None, metavar='SIZE[:STEP],...',
+        help='Count the QTLs in windows of the given sizes, and steps, in '
+        'cM along each linkage group, for example 1,2,5:1,10:2.')
+    parser.add_argument(
+        '--colocalization', action='store_true',
+        help='Write in %s the pairs of traits whose QTLs have '
+        'overlapping LOD2 intervals.' % COLOCALIZATION_FILE)
+    parser.add_argument(
+        '--cluster-threshold', dest='cluster_threshold', default=None,
+        type=float,
+        help='Group the traits whose LOD profiles have a correlation '
+        'above this threshold and write the clusters in %s.'
+        % CLUSTER_FILE)
+    parser.add_argument(
+        '--cluster-significant', dest='cluster_significant',
+        action='store_true',
+        help='Only cluster the traits with a LOD above the LOD threshold.')
+    parser.add_argument(
+        '--hotspot-permutations', dest='hotspot_permutations',
+        default=None, type=int,
+        help='Assess the significance of the QTL hotspots with the '
+        'specified number of permutations.')
+    parser.add_argument(
+        '--hotspot-alpha', dest='hotspot_alpha', default=0.05, type=float,
+        help='Significance level of the QTL hotspots (default: 0.05).')
+    parser.add_argument(
+        '--hotspot-window', dest='hotspot_window', default=0, type=float,
+        help='Size, in cM, of the window around each marker in which the '
+        'QTLs of a hotspot are counted (default: 0, only the marker).')
+    parser.add_argument(
+        '--hotspot-seed', dest='hotspot_seed', default=None, type=int,
+        help='Seed of the permutations, to obtain reproducible '
+        'hotspot thresholds.')
+
+    parser.add_argument(
+        '--cache', dest='cache_dir', default=None,
+        help='Folder in which to keep the output of the runs, a run '
+        'with the same input and settings as a previous one is then '
+        'restored from it instead of being computed again.')
+    parser.add_argument(
+        '--cache-size', dest='cache_size', default=None, type=int,
+        help='Maximum size of the cache in MB, the least recently used '
+        'results are removed above it (default: 1024).')
+
+    parser.add_argument(
+        '--database', default=None,
+        help='SQLite database to which to add the QTLs and the number of '
+        'QTLs per marker found by the run, see the MQ2-query command to '
+        'query it.')
+
+    parser.add_argument(
+        '--profile', default=None,
+        help='Record the time and memory spent in each stage of the run '
+        'and write them as JSON in the specified file.')
+
+    parser.add_argument(
+        '--serve', default=None, metavar='[HOST:]PORT',
+        help='Start MQ² as a service accepting jobs over HTTP on the '
+        'specified port of the local machine.')
+    parser.add_argument(
+        '--workers', default=None, type=int,
+        help='Number of worker processes used by the service, defaults '
+        'to the number of CPUs.')
+    parser.add_argument(
+        '--shard-worker', dest='shard_worker', default=None,
+        metavar='[HOST:]PORT',
+        help='Start MQ² as a worker analyzing the shards of traits sent '
+        'by a coordinator on the specified port.')
+    parser.add_argument(
+        '--shard-workers', dest='shard_workers', default=None,
+        metavar='URL,...',
+        help='Split the MapQTL files of the session in shards analyzed by '
+        'the workers at the given comma separated URLs.')
+    parser.add_argument(
+        '--shards', default=None, type=int,
+        help='Number of shards sent to the workers, defaults to the '
+        'number of workers.')
+    parser.add_argument(
+        '--queue-size', dest='queue_size', default=100, type=int,
+        help='Maximum number of jobs queued or running in the service.')
+    parser.add_argument(
+        '--job-ttl', dest='job_ttl', default=None, type=float,
+        help='Time, in seconds, during which the service keeps a finished '
+        'job and its files (default: one day).')
+    parser.add_argument(
+        '--max-jobs', dest='max_jobs', default=None, type=int,
+        help='Maximum number of finished jobs kept by the service, the '
+        'oldest ones are removed above it (default: 1000).')
+
     parser.add_argument(
         '--verbose', action='store_true',
         help="Gives more info about what's going on")
@@ -94,28 +277,91 @@ def _get_arguments():  # pragma: no cover
 
 def cli_main():  # pragma: no cover
     """ Main function when running from CLI. """
+    logging.basicConfig()
     if '--debug' in sys.argv:
         LOG.setLevel(logging.DEBUG)
     elif '--verbose' in sys.argv:
         LOG.setLevel(logging.INFO)
 
     args = _get_arguments()
+    if args.serve:
+        from MQ2.service import serve, JOB_TTL, MAX_JOBS
+        host, port = 'localhost', args.serve
+        if ':' in args.serve:
+            host, port = args.serve.rsplit(':', 1)
+        serve(host=host, port=int(port), workers=args.workers,
+              max_queue=args.queue_size, max_memory=args.max_memory,
+              job_ttl=JOB_TTL if args.job_ttl is None else args.job_ttl,
+              max_jobs=MAX_JOBS if args.max_jobs is None else args.max_jobs)
+        return 0
+    if args.shard_worker:
+        from MQ2.distributed import serve_worker
+        host, port = 'localhost', args.shard_worker
+        if ':' in args.shard_worker:
+            host, port = args.shard_worker.rsplit(':', 1)
+        serve_worker(host=host, port=int(port))
+        return 0
+
     try:
         plugin, folder = get_plugin_and_folder(
             inputzip=args.inputzip,
             inputdir=args.inputdir,
             inputfile=args.inputfile)
         LOG.debug('Plugin: %s -- Folder: %s' % (plugin.name, folder))
+        if args.shard_workers:
+            from MQ2.distributed import run_distributed
+            try:
+                run_distributed(
+                    folder, args.shard_workers.split(','),
+                    session=args.session, lod_threshold=args.lod,
+                    outputfolder=args.outputfolder, nr_shards=args.shards)
+            finally:
+                if is_tmp_folder(folder):
+                    shutil.rmtree(folder)
+            return 0
         run_mq2(
-            plugin, folder, lod_threshold=args.lod, session=args.session)
+            plugin, folder, lod_threshold=args.lod, session=args.session,
+            outputfolder=args.outputfolder, profile=args.profile,
+            incremental=args.incremental, cache_dir=args.cache_dir,
+            cache_size=args.cache_size,
+            hotspot_permutations=args.hotspot_permutations,
+            hotspot_alpha=args.hotspot_alpha,
+            hotspot_window=args.hotspot_window,
+            hotspot_seed=args.hotspot_seed, lod_store=args.lod_store,
+            max_memory=args.max_memory, database=args.database,
+            count_intervals=args.count_intervals,
+            colocalization=args.colocalization, windows=args.windows,
+            sparse=args.sparse, sparse_floor=args.sparse_floor,
+            processes=args.processes, stage_threads=args.stage_threads,
+            outputs=args.outputs,
+            cluster_threshold=args.cluster_threshold,
+            cluster_significant=args.cluster_significant,
+            run_name=args.inputzip or args.inputdir or args.inputfile)
     except MQ2Exception as err:
         print(err)
         return 1
     return 0
 
 
-def get_plugin_and_folder(inputzip=None, inputdir=None, inputfile=None):
-    """ Main function. """
+def load_plugins():
+    """ Return the list of the plugins available.
+    The plugins are only searched for and imported the first time this
+    function is called, the following calls re-use them.
+    """
+    if 'plugins' not in _PLUGINS:
+        _PLUGINS['plugins'] = list(
+            load('MQ2.plugins', subclasses=PluginInterface))
+    return list(_PLUGINS['plugins'])
+
+
+def get_plugin_and_folder(inputzip=None, inputdir=None, inputfile=None,
+                          extract_dir=None):
+    """ Main function.
+
+    :kwarg extract_dir: the folder in which to extract the zip archive,
+        defaults to a new unique temporary folder.
+
+    """
 
     if (inputzip and inputdir) \
             or (inputzip and inputfile) \
@@ -128,7 +374,7 @@ def get_plugin_and_folder(inputzip=None, inputdir=None, inputfile=None):
 
     # retrieve input: file, directory, zip
     if inputzip:
-        tmp_folder = set_tmp_folder()
+        tmp_folder = extract_dir or set_tmp_folder()
         extract_zip(inputzip, tmp_folder)
     elif inputfile:
         tmp_folder = inputfile
@@ -136,7 +382,7 @@ def get_plugin_and_folder(inputzip=None, inputdir=None, inputfile=None):
         tmp_folder = inputdir
 
     # retrieve the plugins
-    plugins = load('MQ2.plugins', subclasses=PluginInterface)
+    plugins = load_plugins()
     LOG.debug('Plugin loaded: %s' % [plugin.name for plugin in plugins])
 
     # keep only the plugins that will work
@@ -164,58 +410,738 @@ def get_plugin_and_folder(inputzip=None, inputdir=None, inputfile=None):
     return (plugin, tmp_folder)
 
 
+# Optional arguments of ``convert_inputfiles`` which were added after the
+# plugin interface was published and which older plugins may not support.
+_OPTIONAL_PLUGIN_ARGS = ['profiler', 'state_file', 'lod_store',
+                         'max_memory', 'sparse']
+
+
+def _convert_inputfiles(plugin, **kwargs):
+    """ Call the ``convert_inputfiles`` method of the plugin with the
+    given arguments, dropping the optional ones the plugin does not
+    support.
+    """
+    params = inspect.signature(plugin.convert_inputfiles).parameters
+    if not any([param.kind == param.VAR_KEYWORD
+                for param in params.values()]):
+        for key in _OPTIONAL_PLUGIN_ARGS:
+            if key in kwargs and key not in params:
+                LOG.debug('Plugin %s does not support the argument %s'
+                          % (plugin.name, key))
+                del(kwargs[key])
+    return plugin.convert_inputfiles(**kwargs)
+
+
+def get_output_files(outputfolder=None):
+    """ Return a dictionary giving the path to each of the files
+    generated by a run of MQ².
+
+    :kwarg outputfolder: the folder in which the files are generated,
+        defaults to the current working directory.
+
+    """
+    files = {}
+    for key, filename in OUTPUT_FILES.items():
+        if outputfolder:
+            filename = os.path.join(outputfolder, filename)
+        files[key] = filename
+    return files
+
+
+def get_output_artifacts(files, outputs):
+    """ Return the set of the artifacts (see :mod:`MQ2.scheduler`)
+    corresponding to the given outputs of a run.
+
+    :arg files: the dictionary giving the path to each output of the
+        run, see :func:`get_run_context`.
+    :arg outputs: the outputs wanted, as a list or a comma separated
+        string of their keys in ``files`` or of their file names.
+
+    """
+    if isinstance(outputs, str):
+        outputs = outputs.split(',')
+    names = {}
+    for key, path in files.items():
+        artifact = key
+        if key == os.path.basename(path):
+            # The files of the windows, all written by the same stage
+            artifact = 'windows'
+        names[key] = names[os.path.basename(path)] = artifact
+        names[artifact] = artifact
+    artifacts = set()
+    for output in outputs:
+        output = output.strip()
+        if output not in names:
+            raise MQ2Exception('Unknown output "%s", the outputs of this '
+                               'run are: %s'
+                               % (output, ', '.join(sorted(names))))
+        artifacts.add(names[output])
+    return artifacts
+
+
 def run_mq2(plugin, folder, lod_threshold=None, session=None,
-            outputfolder=None):
-    """ Run the plugin. """
-
-    qtls_file = 'qtls.csv'
-    matrix_file = 'qtls_matrix.csv'
-    map_file = 'map.csv'
-    map_qtl_file = 'map_with_qtls.csv'
-    qtls_mk_file = 'qtls_with_mk.csv'
-    map_chart_file = 'MapChart.map'
-    if outputfolder:  # pragma: no cover
-        qtls_file = '%s/%s' % (outputfolder, qtls_file)
-        qtls_mk_file = '%s/%s' % (outputfolder, qtls_mk_file)
-        matrix_file = '%s/%s' % (outputfolder, matrix_file)
-        map_file = '%s/%s' % (outputfolder, map_file)
-        map_qtl_file = '%s/%s' % (outputfolder, map_qtl_file)
-        map_chart_file = '%s/%s' % (outputfolder, map_chart_file)
-
-    LOG.debug('Call the plugin to create the map, qtls and matrix files')
+            outputfolder=None, profile=None, cleanup=None,
+            incremental=False, cache_dir=None, cache_size=None,
+            hotspot_permutations=None, hotspot_alpha=0.05, hotspot_window=0,
+            hotspot_seed=None, lod_store=None, max_memory=None,
+            database=None, run_name=None, count_intervals=False,
+            colocalization=False, cluster_threshold=None,
+            cluster_significant=False, windows=None, sparse=False,
+            sparse_floor=None, processes=None, stage_threads=None,
+            outputs=None, progress=None):
+    """ Run the plugin.
+
+    :kwarg outputfolder: the folder in which to write the output files,
+        defaults to the current working directory.
+    :kwarg profile: path to a file in which to write, as JSON, the time
+        and memory spent in each stage of the run as well as the size
+        of the dataset processed.
+    :kwarg cleanup: boolean specifying whether to remove the input folder
+        once the run is finished. By default, only the temporary folders
+        created by MQ² (see :func:`~MQ2.set_tmp_folder`) are removed.
+    :kwarg incremental: boolean specifying whether to save in the output
+        folder the results of the parsing of each input file and re-use
+        those of a previous run for the files which did not change. Only
+        supported by plugins handling several input files (MapQTL).
+    :kwarg cache_dir: the folder of the result cache, see
+        :class:`~MQ2.cache.ResultCache`. If the input and the settings of
+        the run are the same as those of a run in the cache, its output
+        files are restored instead of being generated again.
+    :kwarg cache_size: the maximum size of the cache in MB.
+    :kwarg hotspot_permutations: the number of permutations used to
+        assess the significance of the QTL hotspots, see
+        :mod:`MQ2.hotspot`. By default the significance is not assessed.
+        It cannot be assessed with ``count_intervals``.
+    :kwarg hotspot_alpha: the significance level of the hotspots.
+    :kwarg hotspot_window: the size in cM of the window around each
+        marker in which the QTLs of a hotspot are counted.
+    :kwarg hotspot_seed: the seed of the permutations.
+    :kwarg lod_store: the path of a :class:`~MQ2.lodstore.LODStore` in
+        which to keep the LOD values. The plugins write the values in it
+        and the following stages read it one block of traits at a time
+        instead of loading the whole QTL matrix in memory. The store is
+        kept once the run is finished.
+    :kwarg max_memory: the memory budget, in MB, of the LOD values
+        processed at a time. If specified, the plugins and the stages
+        read and process the traits in chunks sized to fit in it (see
+        :mod:`MQ2.chunked`) instead of loading the whole QTL matrix in
+        memory.
+    :kwarg database: the path to a SQLite database to which to add the
+        results of the run, see :mod:`MQ2.database`.
+    :kwarg run_name: the name of the run in the database, defaults to the
+        input folder or, when this folder is removed once the run is
+        finished, to the name of the input files it contains.
+    :kwarg count_intervals: boolean specifying whether to credit each QTL
+        to all the markers of its LOD2 interval instead of its closest
+        marker only in the map with the number of QTLs per marker, see
+        :func:`~MQ2.add_qtl_to_map.add_qtl_intervals_to_map_list`.
+    :kwarg colocalization: boolean specifying whether to write the pairs
+        of traits with overlapping QTL intervals in
+        :data:`COLOCALIZATION_FILE`, see :mod:`MQ2.colocalization`.
+    :kwarg cluster_threshold: if specified, the traits whose LOD profiles
+        have a correlation above this threshold are grouped and the
+        clusters written in :data:`CLUSTER_FILE`, see
+        :mod:`MQ2.clustering`.
+    :kwarg cluster_significant: boolean specifying whether to only
+        cluster the traits with a LOD above the LOD threshold.
+    :kwarg windows: the resolutions at which to count the QTLs in windows
+        of the linkage groups, as a list of ``(size, step)`` in cM or as a
+        string (see :func:`~MQ2.windows.parse_resolutions`). The counts of
+        each resolution are written in their own file.
+    :kwarg sparse: boolean specifying whether to only keep the LOD values
+        above a floor (see :mod:`MQ2.sparse`), the QTLs are then counted
+        and searched among these values only.
+    :kwarg sparse_floor: the lowest LOD value kept, by default and at most
+        the LOD threshold minus
+        :data:`~MQ2.mapchart.INTERVAL_THRESHOLD`. Implies ``sparse``.
+    :kwarg processes: the number of processes searching the QTLs of the
+        MapChart file. If specified, the LOD values are placed in shared
+        memory (see :mod:`MQ2.shared`) and the traits split between the
+        processes. Not used with ``sparse``, nor when the LOD values do
+        not fit in ``max_memory``.
+    :kwarg stage_threads: the number of threads running the independent
+        stages of the run at the same time (see :mod:`MQ2.scheduler`),
+        defaults to the number of CPUs. With 1, or when profiling, the
+        stages are ran one after the other.
+    :kwarg outputs: the outputs wanted, as a list or a comma separated
+        string of their keys in :data:`OUTPUT_FILES` (or of the optional
+        outputs: ``colocalization``, ``clusters``, ``windows``) or of
+        their file names. Only the stages needed to produce them are ran
+        (see :func:`~MQ2.scheduler.get_required_stages`), the files of the
+        intermediate results they use are written as well. By default all
+        the outputs are produced.
+    :kwarg progress: a callable called with a dictionary describing each
+        event of the run, see :func:`~MQ2.scheduler.run_stages`.
+
+    """
+    profiler = None
+    if profile:
+        profiler = Profiler()
+        profiler.start()
+
+    context = get_run_context(plugin, folder, lod_threshold=lod_threshold,
+                              session=session, outputfolder=outputfolder)
+    context['profiler'] = profiler
+    context['lod_store'] = lod_store
+    if max_memory:
+        context['max_memory'] = get_memory_budget(max_memory)
+    if sparse or sparse_floor is not None:
+        context['sparse'] = {'floor': sparse_floor}
+    if processes:
+        context['processes'] = int(processes)
+    if incremental:
+        context['state_file'] = os.path.join(outputfolder or '', STATE_FILE)
+    stages = STAGES
+    if count_intervals:
+        # The intervals are only known once the flanking markers appended
+        stages = [stage for stage in STAGES if stage[1] is not _map_stage]
+        stages.append(INTERVAL_MAP_STAGE)
+    if windows:
+        if isinstance(windows, str):
+            windows = parse_resolutions(windows)
+        windows = [(float(size), float(step)) for size, step in windows]
+        context['windows'] = windows
+        context['count_intervals'] = bool(count_intervals)
+        for size, step in windows:
+            filename = get_windows_filename(size, step)
+            context['files'][filename] = os.path.join(
+                outputfolder or '', filename)
+        stages = stages + [WINDOWS_STAGE]
+    if colocalization:
+        context['files']['colocalization'] = os.path.join(
+            outputfolder or '', COLOCALIZATION_FILE)
+        stages = stages + [COLOCALIZATION_STAGE]
+    clusters = None
+    if cluster_threshold is not None:
+        clusters = {
+            'threshold': float(cluster_threshold),
+            'significant': bool(cluster_significant),
+        }
+        context['clusters'] = clusters
+        context['files']['clusters'] = os.path.join(
+            outputfolder or '', CLUSTER_FILE)
+        stages = stages + [CLUSTER_STAGE]
+    hotspot = None
+    if hotspot_permutations:
+        if count_intervals:
+            raise MQ2Exception(
+                'The significance of the QTL hotspots cannot be assessed '
+                'when the QTLs are counted on their interval')
+        hotspot = {
+            'permutations': int(hotspot_permutations),
+            'alpha': float(hotspot_alpha),
+            'window': float(hotspot_window or 0),
+            'seed': hotspot_seed,
+        }
+        context['hotspot'] = hotspot
+        stages = stages + [HOTSPOT_STAGE]
+    if outputs:
+        outputs = get_output_artifacts(context['files'], outputs)
+        if database:
+            # The database is filled from these files
+            outputs.update(['qtls_mk', 'map_qtl', 'matrix'])
+        stages = get_required_stages(stages, outputs)
+        outputs = sorted(outputs)
+    if cleanup is None:
+        cleanup = is_tmp_folder(folder)
+    if database and not run_name:
+        run_name = _get_run_name(plugin, folder, cleanup)
+    cache = cache_key = None
+    try:
+        if cache_dir:
+            max_size = DEFAULT_MAX_SIZE
+            if cache_size is not None:
+                max_size = int(cache_size) * 1024 * 1024
+            cache = ResultCache(cache_dir, max_size=max_size)
+            settings = {'interval_threshold': INTERVAL_THRESHOLD,
+                        'hotspot': hotspot,
+                        'count_intervals': bool(count_intervals),
+                        'colocalization': bool(colocalization),
+                        'clusters': clusters,
+                        'windows': windows}
+            if outputs:
+                settings['outputs'] = outputs
+            with measure_stage(profiler, 'Look up the result cache'):
+                cache_key = cache.get_key(
+                    plugin, folder, session=session,
+                    lod_threshold=lod_threshold, settings=settings)
+                if cache.restore(cache_key, context['files']):
+                    stages, cache = [], None
+        run_stages(stages, context, threads=stage_threads,
+                   progress=progress)
+        if cache:
+            with measure_stage(profiler, 'Store the results in the cache'):
+                cache.store(cache_key, context['files'])
+        if database:
+            with measure_stage(profiler, 'Add the results to the database'):
+                add_run(database, context['files'],
+                        name=run_name, plugin=plugin.name,
+                        session=session, lod_threshold=lod_threshold,
+                        count_intervals=count_intervals)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.write(profile)
+
+    if cleanup and folder and os.path.isdir(folder):
+        shutil.rmtree(folder)
+    return 0
+
+
+def _get_run_name(plugin, folder, cleanup):
+    """ Return the name of a run in the database, the input folder or,
+    if it is a temporary folder removed once the run is finished, the
+    name of its input files.
+    """
+    if not cleanup or not os.path.isdir(folder):
+        return folder
+    filenames = sorted([os.path.relpath(filename, folder)
+                        for filename in plugin.get_files(folder)])
+    if not filenames:
+        return datetime.datetime.now().isoformat()
+    if len(filenames) == 1:
+        return filenames[0]
+    return '%s and %s other files' % (filenames[0], len(filenames) - 1)
+
+
+def get_run_context(plugin, folder, lod_threshold=None, session=None,
+                    outputfolder=None):
+    """ Return the dictionary shared by the stages of a run, see
+    :data:`STAGES`.
+    Each stage receives this dictionary and may return a dictionary of
+    new entries to add to it for the following stages.
+    """
+    return {
+        'plugin': plugin,
+        'folder': folder,
+        'lod_threshold': lod_threshold,
+        'session': session,
+        'files': get_output_files(outputfolder),
+        'profiler': None,
+        'state_file': None,
+        'hotspot': None,
+        'clusters': None,
+        'windows': None,
+        'count_intervals': False,
+        'sparse': None,
+        'sparse_lods': None,
+        'zones': None,
+        'qtl_counts': None,
+        'matrix_counted': False,
+        'map_chart_data': None,
+        'catalog': Catalog(),
+        'lod_store': None,
+        'max_memory': None,
+        'processes': None,
+    }
+
+
+@uses(writes=['qtls', 'matrix', 'map', 'lod_store', 'sparse_lods', 'zones',
+              'qtl_counts', 'matrix_counted', 'map_chart_data'])
+def _convert_stage(context):
+    """ Call the plugin to create the map, qtls and matrix files.
+    The traits of the plugins parsing their input one trait at a time are
+    counted and added to the zone map as they are parsed (see
+    :mod:`MQ2.streaming`), unless the LOD values are read a chunk at a
+    time or the conversion is incremental. A plugin may also return the
+    number of QTLs found on each row and the data of the MapChart file
+    (see :meth:`MQ2.plugin_interface.PluginInterface.convert_inputfiles`).
+    """
+    files = context['files']
+    profiler = context['profiler']
+    kwargs = {
+        'session': context['session'],
+        'lod_threshold': context['lod_threshold'],
+        'qtls_file': files['qtls'],
+        'matrix_file': files['matrix'],
+        'map_file': files['map'],
+        'profiler': profiler,
+        'state_file': context['state_file'],
+        'lod_store': context['lod_store'],
+        'max_memory': context['max_memory'],
+    }
+    folder = context['folder']
     if folder and os.path.isdir(folder):
-        plugin.convert_inputfiles(folder=folder, session=session,
-                                  lod_threshold=lod_threshold,
-                                  qtls_file=qtls_file,
-                                  matrix_file=matrix_file,
-                                  map_file=map_file)
+        kwargs['folder'] = folder
     else:
-        plugin.convert_inputfiles(inputfile=folder, session=session,
-                                  lod_threshold=lod_threshold,
-                                  qtls_file=qtls_file,
-                                  matrix_file=matrix_file,
-                                  map_file=map_file)
+        kwargs['inputfile'] = folder
+    lod_store = context['lod_store']
+    if lod_store:
+        remove_store(lod_store)
+    sparse = None
+    if context['sparse']:
+        sparse = SparseLODs(_get_sparse_floor(context))
+        kwargs['sparse'] = sparse
+    output = {'sparse_lods': sparse}
+    plugin = context['plugin']
+    if is_streaming(plugin) and not lod_store \
+            and not context['max_memory'] and not context['state_file']:
+        for key in ['state_file', 'lod_store', 'max_memory']:
+            del(kwargs[key])
+        output['qtl_counts'], output['zones'] = convert_streaming(
+            plugin, **kwargs)
+    else:
+        output.update(_convert_inputfiles(plugin, **kwargs) or {})
+    if lod_store and not os.path.exists('%s.json' % lod_store):
+        # The plugin does not support the store, copy the matrix in it
+        LODStore.from_matrix_file(files['matrix'], lod_store).close()
+    if sparse is not None and not sparse.markers:
+        # The plugin does not fill the sparse matrix, read it from the
+        # matrix file
+        sparse = SparseLODs.from_matrix_file(files['matrix'], sparse.floor)
+        output['sparse_lods'] = sparse
+    if sparse is not None:
+        LOG.info('- %s LOD values of %s kept above %.2f' % (
+            sparse.nr_values, sparse.nr_positions * len(sparse.traits),
+            sparse.floor))
 
-    LOG.debug('Add the number of QTLs found on the matrix')
-    _append_count_to_matrix(matrix_file, lod_threshold)
+    if profiler:
+        (rows, width) = get_matrix_dimensions(files['matrix'])
+        profiler.set_count('rows', rows - 1)
+        if output.get('matrix_counted'):
+            width -= 1
+        profiler.set_count('traits', width - 3)
+        profiler.set_count(
+            'qtls', get_matrix_dimensions(files['qtls'])[0] - 1)
+        profiler.set_count(
+            'markers', get_matrix_dimensions(files['map'])[0] - 1)
+    return output
 
-    LOG.debug('Append the closest marker to the peak')
-    add_marker_to_qtls(qtls_file, map_file, outputfile=qtls_mk_file)
 
-    LOG.debug('Put the number of QTLs found on each marker of the map')
-    add_qtl_to_map(qtls_mk_file, map_file, outputfile=map_qtl_file)
+def _get_sparse_floor(context):
+    """ Return the floor of the sparse matrix of the run, checking that it
+    does not change the QTLs found.
+    """
+    try:
+        default = get_default_floor(context['lod_threshold'],
+                                    INTERVAL_THRESHOLD)
+    except (TypeError, ValueError):
+        raise MQ2Exception('LOD threshold should be a number')
+    floor = context['sparse']['floor']
+    if floor is None:
+        return default
+    if float(floor) > default:
+        raise MQ2Exception('The floor of the sparse matrix should be at '
+                           'most %.2f (the LOD threshold minus %s)'
+                           % (default, INTERVAL_THRESHOLD))
+    return float(floor)
 
-    LOG.debug('Generate the mapchart file')
-    flanking_markers = generate_map_chart_file(
-        matrix_file, lod_threshold, map_chart_file=map_chart_file)
 
-    LOG.debug('Append flanking markers to qtl list')
-    flanking_markers = append_flanking_markers(
-        qtls_mk_file, flanking_markers)
+def _open_lod_source(context, count_column=False):
+    """ Return the object from which to read the LOD values one block of
+    traits at a time: the LOD store of the run or, if a memory budget is
+    set, the QTL matrix file. Returns None if the QTL matrix should be
+    loaded in memory.
+
+    :kwarg count_column: whether the QTL matrix file already contains
+        the number of QTLs found on each row.
+
+    """
+    if context['lod_store']:
+        source = LODStore.open(context['lod_store'])
+    elif context['max_memory']:
+        source = MatrixFile(context['files']['matrix'],
+                            count_column=count_column)
+    else:
+        return None
+    if context['max_memory']:
+        source.block_memory = context['max_memory']
+    return source
+
+
+@uses(reads=['matrix', 'lod_store', 'sparse_lods', 'zones', 'qtl_counts',
+             'matrix_counted'],
+      writes=['matrix', 'zones'])
+def _count_stage(context):
+    """ Add the number of QTLs found on the matrix.
+    The zone map of the LOD values (see :mod:`MQ2.zonemap`) is computed
+    here, if the plugin did not, and kept for the following stages.
+    """
+    if context['matrix_counted']:
+        # The plugin kept the matrix of the previous run, counted
+        return {'zones': context['zones']}
+    if context['qtl_counts'] is not None:
+        # Counted while the plugin parsed the traits
+        _append_counts_to_matrix_file(context['files']['matrix'],
+                                      context['qtl_counts'])
+        return {'zones': context['zones']}
+    sparse = context['sparse_lods']
+    if sparse is not None:
+        zones = context['zones'] or ZoneMap.from_sparse(sparse)
+        _append_counts_to_matrix_file(
+            context['files']['matrix'],
+            sparse.count_qtls(context['lod_threshold'], zones=zones))
+        return {'zones': zones}
+    source = _open_lod_source(context)
+    if source is not None:
+        with source:
+            zones = context['zones'] or source.zones or \
+                ZoneMap.from_markers(source.markers)
+            counts = count_store_qtls(source, context['lod_threshold'],
+                                      zones=zones)
+        _append_counts_to_matrix_file(context['files']['matrix'], counts)
+        return {'zones': zones}
+    return {'zones': _append_count_to_matrix(context['files']['matrix'],
+                                             context['lod_threshold'])}
+
+
+@uses(reads=['qtls', 'map', 'catalog'], writes=['qtls_mk', 'catalog'])
+def _marker_stage(context):
+    """ Append the closest marker to the peak. """
+    files = context['files']
+    add_marker_to_qtls(files['qtls'], files['map'],
+                       outputfile=files['qtls_mk'],
+                       catalog=context['catalog'])
+
+
+@uses(reads=['qtls_mk', 'map', 'catalog'], writes=['map_qtl', 'catalog'])
+def _map_stage(context):
+    """ Put the number of QTLs found on each marker of the map. """
+    files = context['files']
+    add_qtl_to_map(files['qtls_mk'], files['map'],
+                   outputfile=files['map_qtl'], catalog=context['catalog'])
+
+
+@uses(reads=['matrix', 'lod_store', 'sparse_lods', 'zones',
+             'map_chart_data'],
+      writes=['map_chart', 'flanking_markers'])
+def _map_chart_stage(context):
+    """ Generate the mapchart file. """
+    files = context['files']
+    if context['map_chart_data'] is not None:
+        # Found by the plugin while converting the input files
+        return {'flanking_markers': write_map_chart_file(
+            context['map_chart_data'], files['map_chart'])}
+    if context['sparse_lods'] is not None:
+        return {'flanking_markers': generate_map_chart_file(
+            files['matrix'], context['lod_threshold'],
+            map_chart_file=files['map_chart'],
+            sparse=context['sparse_lods'], zones=context['zones'])}
+    source = _open_lod_source(context, count_column=True)
+    processes = context['processes']
+    if processes and context['max_memory']:
+        size = get_shared_size(source.nr_positions, len(source.traits))
+        if size > context['max_memory']:
+            # The shared matrix holds all the LOD values at once
+            LOG.info('The shared LOD matrix (%.1f MB) does not fit in the '
+                     'memory budget, the QTLs of the MapChart file are '
+                     'searched in a single process'
+                     % (size / (1024. * 1024)))
+            processes = None
+    if processes:
+        source = source or MatrixFile(files['matrix'], count_column=True)
+        with source, SharedLODs.from_source(
+                source, zones=context['zones']) as shared:
+            flanking_markers = generate_map_chart_file(
+                files['matrix'], context['lod_threshold'],
+                map_chart_file=files['map_chart'], shared=shared,
+                processes=processes)
+    elif source is not None:
+        with source:
+            flanking_markers = generate_map_chart_file(
+                files['matrix'], context['lod_threshold'],
+                map_chart_file=files['map_chart'], store=source,
+                zones=context['zones'])
+    else:
+        flanking_markers = generate_map_chart_file(
+            files['matrix'], context['lod_threshold'],
+            map_chart_file=files['map_chart'], zones=context['zones'])
+    return {'flanking_markers': flanking_markers}
+
+
+@uses(reads=['qtls_mk', 'flanking_markers'], writes=['qtls_mk'])
+def _flanking_stage(context):
+    """ Append flanking markers to qtl list. """
+    append_flanking_markers(context['files']['qtls_mk'],
+                            context['flanking_markers'])
+
+
+# The stages of a run, in the order they would run one after the other,
+# as (name, function). Independent stages run concurrently, see
+# MQ2.scheduler.
+STAGES = [
+    ('Call the plugin to create the map, qtls and matrix files',
+     _convert_stage),
+    ('Add the number of QTLs found on the matrix', _count_stage),
+    ('Append the closest marker to the peak', _marker_stage),
+    ('Put the number of QTLs found on each marker of the map',
+     _map_stage),
+    ('Generate the mapchart file', _map_chart_stage),
+    ('Append flanking markers to qtl list', _flanking_stage),
+]
+
+
+@uses(reads=['qtls_mk', 'map', 'catalog'], writes=['map_qtl', 'catalog'])
+def _interval_map_stage(context):
+    """ Put the number of QTL intervals covering each marker of the map.
+    """
+    files = context['files']
+    add_qtl_to_map(files['qtls_mk'], files['map'],
+                   outputfile=files['map_qtl'], intervals=True,
+                   catalog=context['catalog'])
+
+
+INTERVAL_MAP_STAGE = (
+    'Put the number of QTL intervals covering each marker of the map',
+    _interval_map_stage)
+
+
+@uses(reads=['qtls_mk', 'map'], writes=['windows'])
+def _windows_stage(context):
+    """ Count the QTLs in windows of the linkage groups. """
+    files = context['files']
+    write_window_files(
+        files['qtls_mk'], files['map'], context['windows'],
+        outputfolder=os.path.dirname(files['map']),
+        intervals=context['count_intervals'])
+
+
+WINDOWS_STAGE = ('Count the QTLs in windows of the linkage groups',
+                 _windows_stage)
+
+
+@uses(reads=['qtls_mk', 'map'], writes=['colocalization'])
+def _colocalization_stage(context):
+    """ List the pairs of traits with overlapping QTL intervals. """
+    files = context['files']
+    write_colocalization_file(files['qtls_mk'], files['map'],
+                              outputfile=files['colocalization'])
 
-    if folder and os.path.isdir(folder) and os.path.exists(folder):
-        shutil.rmtree(folder)
-    return 0
+
+COLOCALIZATION_STAGE = (
+    'List the traits with overlapping QTL intervals', _colocalization_stage)
+
+
+@uses(reads=['matrix', 'lod_store'], writes=['clusters'])
+def _cluster_stage(context):
+    """ Group the traits with correlated LOD profiles. """
+    files = context['files']
+    clusters = context['clusters']
+    lod_threshold = None
+    if clusters['significant']:
+        lod_threshold = context['lod_threshold']
+    source = _open_lod_source(context, count_column=True) or MatrixFile(
+        files['matrix'], count_column=True)
+    with source:
+        write_cluster_file(
+            source, outputfile=files['clusters'],
+            threshold=clusters['threshold'], lod_threshold=lod_threshold)
+
+
+CLUSTER_STAGE = ('Group the traits with correlated LOD profiles',
+                 _cluster_stage)
+
+
+@uses(reads=['map_qtl'], writes=['map_qtl'])
+def _hotspot_stage(context):
+    """ Assess the significance of the QTL hotspots. """
+    hotspot = context['hotspot']
+    add_hotspot_to_map(
+        context['files']['map_qtl'], permutations=hotspot['permutations'],
+        alpha=hotspot['alpha'], window=hotspot['window'],
+        seed=hotspot['seed'])
+
+
+# Optional stage ran after the others when hotspots are assessed.
+HOTSPOT_STAGE = ('Assess the significance of the QTL hotspots',
+                 _hotspot_stage)
+
+
+def add_count_to_matrix(matrix, lod_threshold, zones=None):
+    """ Return the QTL matrix with an extra column at the end containing
+    for each row (marker) the number of QTL found.
+
+    :arg matrix, the QTL matrix as a list of rows, the first row being
+        the headers.
+    :arg threshold, threshold used to determine if a given LOD value is
+        reflective the presence of a QTL.
+    :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the matrix, if
+        specified only the traits above the threshold on the linkage
+        group of a row are looked at.
+
+    """
+    output = []
+    tmp = list(matrix[0])
+    tmp.append('# QTLs')
+    output.append(tmp)
+    if zones is not None:
+        significant = zones.get_significant_traits(lod_threshold,
+                                                   strict=True)
+        groupcnt = 0
+    for cnt, row in enumerate(matrix[1:]):
+        row = list(row)
+        nr_qtl = 0
+        if zones is None:
+            cels = row[3:]
+        else:
+            while cnt >= zones.groups[groupcnt][2]:
+                groupcnt += 1
+            cels = [row[trait + 3] for trait in significant[groupcnt]]
+        for cel in cels:
+            if cel and float(cel) > float(lod_threshold):
+                nr_qtl = nr_qtl + 1
+        row.append(str(nr_qtl))
+        output.append(row)
+    return output
+
+
+def count_store_qtls(store, lod_threshold, zones=None):
+    """ Return, for each position of the QTL matrix kept in the given
+    :class:`~MQ2.lodstore.LODStore`, or any object offering the same
+    reading interface (such as a :class:`~MQ2.chunked.MatrixFile`), the
+    number of LOD values above the threshold. The store is read one block
+    of traits at a time and the counts accumulated over the blocks.
+
+    :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the store, only
+        the zones above the threshold are counted. If it contains all the
+        traits and the store offers a ``get_trait`` method, only the LOD
+        values of these zones are read. Otherwise the traits it does not
+        contain yet are added to it as they are read.
+
+    """
+    lod_threshold = float(lod_threshold)
+    counts = [0] * store.nr_positions
+    if zones is not None and zones.nr_traits >= len(store.traits) \
+            and getattr(store, 'get_trait', None):
+        for trait in range(len(store.traits)):
+            for groupcnt in zones.get_significant_groups(
+                    trait, lod_threshold, strict=True):
+                linkgrp, start, stop = zones.groups[groupcnt]
+                lods = store.get_trait(trait, start, stop)
+                for cnt, lod in enumerate(lods):
+                    if lod > lod_threshold:
+                        counts[start + cnt] += 1
+        return counts
+
+    for offset, traits, profiles in store.iter_blocks():
+        for colcnt, lods in enumerate(profiles):
+            if zones is None:
+                ranges = [(0, len(lods))]
+            else:
+                if offset + colcnt >= zones.nr_traits:
+                    zones.set_trait(offset + colcnt, lods)
+                ranges = [zones.groups[groupcnt][1:] for groupcnt in
+                          zones.get_significant_groups(
+                              offset + colcnt, lod_threshold, strict=True)]
+            for start, stop in ranges:
+                for cnt in range(start, stop):
+                    # NaN, ie: missing values, are never above threshold
+                    if lods[cnt] > lod_threshold:
+                        counts[cnt] += 1
+    return counts
+
+
+def _append_counts_to_matrix_file(qtl_matrixfile, counts):
+    """ Append the given number of QTLs found on each row to the matrix
+    file, as :func:`_append_count_to_matrix` does, one row at a time.
+    """
+    tmp_file = '%s.tmp' % qtl_matrixfile
+    with open(qtl_matrixfile) as stream, open(tmp_file, 'w') as output:
+        for cnt, row in enumerate(stream):
+            row = [cel.strip() for cel in row.strip().split(',')]
+            row.append('# QTLs' if cnt == 0 else str(counts[cnt - 1]))
+            output.write(','.join(row) + '\n')
+    os.replace(tmp_file, qtl_matrixfile)
 
 
 def _append_count_to_matrix(qtl_matrixfile, lod_threshold):
@@ -227,24 +1153,16 @@ def _append_count_to_matrix(qtl_matrixfile, lod_threshold):
     :arg threshold, threshold used to determine if a given LOD value is
         reflective the presence of a QTL.
 
+    Returns the :class:`~MQ2.zonemap.ZoneMap` of the matrix.
+
     """
     if not os.path.exists(qtl_matrixfile):  # pragma: no cover
         raise MQ2Exception('File not found: "%s"' % qtl_matrixfile)
     matrix = read_input_file(qtl_matrixfile, sep=',')
-    tmp = list(matrix[0])
-    tmp.append('# QTLs')
-    matrix[0] = tmp
-    cnt = 1
-    while cnt < len(matrix):
-        row = list(matrix[cnt])
-        nr_qtl = 0
-        for cel in row[3:]:
-            if cel and float(cel) > float(lod_threshold):
-                nr_qtl = nr_qtl + 1
-        row.append(str(nr_qtl))
-        matrix[cnt] = row
-        cnt = cnt + 1
-    write_matrix(qtl_matrixfile, matrix)
+    zones = ZoneMap.from_matrix(matrix)
+    write_matrix(qtl_matrixfile,
+                 add_count_to_matrix(matrix, lod_threshold, zones=zones))
+    return zones
 
 
 if __name__ == "__main__":  # pragma: no cover
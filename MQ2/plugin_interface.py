@@ -48,6 +48,11 @@ class PluginInterface(object):  # pragma: no cover
     name = 'plugin name'
     session_name = 'The name of the session to be displayed on the form'
 
+    # Whether the plugin implements the optional streaming methods
+    # get_map() and iter_traits(), see MQ2.streaming. The input of the
+    # plugins which do not is converted at once by convert_inputfiles().
+    streaming = False
+
     @classmethod
     def is_applicable(cls):
         """ Functions used to check whether the plugin can be used or
@@ -135,7 +140,11 @@ class PluginInterface(object):  # pragma: no cover
                            lod_threshold=None,
                            qtls_file='qtls.csv',
                            matrix_file='qtls_matrix.csv',
-                           map_file='map.csv'):
+                           map_file='map.csv',
+                           profiler=None,
+                           state_file=None,
+                           lod_store=None,
+                           sparse=None):
         """ Convert the input files present in the given folder or
         inputfile.
         This method creates the matrix representation of the QTLs
@@ -163,6 +172,91 @@ class PluginInterface(object):  # pragma: no cover
         :kwarg map_file: a csv file containing the genetic map used
             in this experiment. The map is of structure:
             ``marker, linkage group, position``
+        :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to
+            record the time spent on each input file, or None.
+            Use :func:`~MQ2.profiling.profile_file` around the processing
+            of each file.
+        :kwarg state_file: the path to a file in which plugins handling
+            several input files may save the results of the parsing of
+            each file, so that only the new or modified files are parsed
+            the next time the same session is converted. Plugins which
+            do not support it simply ignore it.
+        :kwarg lod_store: the path of a :class:`~MQ2.lodstore.LODStore`
+            to create and in which to write the LOD values, trait by
+            trait or a chunk of rows at a time, without loading the whole
+            QTL matrix in memory. If a plugin does not create the store,
+            it is created from the QTL matrix file.
+        :kwarg sparse: a :class:`~MQ2.sparse.SparseLODs` to fill, row by
+            row or trait by trait, with the LOD values above its floor.
+            If a plugin does not fill it, it is filled from the QTL
+            matrix file.
+
+        Plugins may return a dictionary with the results they found
+        while converting the input files, which are then not computed
+        again from the QTL matrix:
+
+        - ``qtl_counts``: the number of QTLs found on each row of the
+          QTL matrix, see :func:`MQ2.mq2.add_count_to_matrix`.
+        - ``matrix_counted``: True if the QTL matrix written already
+          contains the number of QTLs found on each row.
+        - ``map_chart_data``: the data of the MapChart file, see
+          :func:`MQ2.mapchart.get_map_chart_data`.
+
+        """
+        pass
+
+    @classmethod
+    def get_map(cls, folder=None, inputfile=None, session=None):
+        """ Optional, return the positions of the QTL matrix of the given
+        session and the genetic map used in the experiment, for plugins
+        setting ``streaming`` to True.
+
+        The method ``get_map`` returns a tuple of three lists:
+
+        - the ``marker, linkage group, position`` of each row of the QTL
+          matrix, the first item being the headers;
+        - the rows of the genetic map, as written in the map file by
+          ``convert_inputfiles``;
+        - the headers of the list of the significant QTLs.
+
+        :kwarg folder: string of the path to the folder containing the
+            files to check. This folder may contain sub-folders.
+        :kwarg inputfile: string of the path to the input file to use
+        :kwarg session: the session identifier used to identify which
+            session to process
+
+        """
+        pass
+
+    @classmethod
+    def iter_traits(cls, folder=None, inputfile=None, session=None,
+                    lod_threshold=None, profiler=None):
+        """ Optional, iterate over the traits of the given session, for
+        plugins setting ``streaming`` to True.
+
+        The method ``iter_traits`` parses the input one trait at a time
+        and yields for each trait a tuple of:
+
+        - the name of the trait;
+        - its LOD values at each row of the QTL matrix (see
+          :meth:`get_map`), as they should be written in the QTL matrix
+          file;
+        - the rows of the significant QTLs found for this trait, as they
+          should be written in the list of the QTLs.
+
+        The following stages of MQ² then process each trait as soon as it
+        is parsed, instead of waiting for the whole input to be
+        converted.
+
+        :kwarg folder: string of the path to the folder containing the
+            files to check. This folder may contain sub-folders.
+        :kwarg inputfile: string of the path to the input file to use
+        :kwarg session: the session identifier used to identify which
+            session to process
+        :kwarg lod_threshold: the LOD threshold to apply to determine if
+            a QTL is significant or not
+        :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to
+            record the time spent on each input file, or None.
 
         """
         pass
@@ -27,11 +27,16 @@
 MQ2 CSV plugin
 """
 
+import heapq
+import itertools
 import os
 import re
 
 from MQ2 import MQ2Exception, read_input_file, write_matrix
+from MQ2.chunked import MatrixFile
+from MQ2.lodstore import LODStore
 from MQ2.plugin_interface import PluginInterface
+from MQ2.profiling import profile_file
 
 
 def is_csv_file(inputfile):
@@ -52,6 +57,53 @@ def is_csv_file(inputfile):
     return inputfile.endswith('.csv') and len(content) >= 4
 
 
+def get_trait_qtls(trait, lods, markers, groups, positions,
+                   lod_threshold):
+    """ Return the list of significant QTLs found for a trait, one per
+    linkage group at most.
+
+    :arg trait: the name of the trait.
+    :arg lods: the LOD values of the trait at each position.
+    :arg markers: the name of the marker at each position.
+    :arg groups: the linkage group of each position.
+    :arg positions: the position of each position on its linkage group.
+    :arg lod_threshold: threshold used to determine if a given LOD value
+        is reflective the presence of a QTL.
+
+    """
+    qtls = []
+    lgroup = None
+    max_lod = None
+    peak = None
+    cnt = 0
+    while cnt < len(lods):
+        if lgroup is None:
+            lgroup = groups[cnt]
+
+        if lgroup == groups[cnt]:
+            if max_lod is None:
+                max_lod = float(lods[cnt])
+            if float(lods[cnt]) > float(max_lod):
+                max_lod = float(lods[cnt])
+                peak = cnt
+        else:
+            if max_lod \
+                    and float(max_lod) > float(lod_threshold) \
+                    and peak is not None:
+                qtl = [trait,            # trait
+                       groups[peak],     # LG
+                       positions[peak],  # pos
+                       markers[peak],    # marker
+                       max_lod,          # LOD value
+                       ]
+                qtls.append(qtl)
+            lgroup = None
+            max_lod = None
+            peak = cnt
+        cnt = cnt + 1
+    return qtls
+
+
 def get_qtls_from_rqtl_data(matrix, lod_threshold):
     """ Retrieve the list of significants QTLs for the given input
     matrix and using the specified LOD threshold.
@@ -67,39 +119,152 @@ def get_qtls_from_rqtl_data(matrix, lod_threshold):
     # row 0: markers
     # row 1: chr
     # row 2: pos
+    markers, groups, positions = [row[1:] for row in t_matrix[:3]]
     for row in t_matrix[3:]:
+        qtls.extend(get_trait_qtls(row[0], row[1:], markers, groups,
+                                   positions, lod_threshold))
+    return qtls
+
+
+def get_qtls_from_store(store, lod_threshold):
+    """ Retrieve the list of significants QTLs for the QTL matrix kept in
+    the given :class:`~MQ2.lodstore.LODStore`, or any object offering the
+    same reading interface (such as a :class:`~MQ2.chunked.MatrixFile`),
+    see :func:`get_qtls_from_rqtl_data`. The store is read one block of
+    traits at a time. If the :class:`~MQ2.zonemap.ZoneMap` of the store is
+    known, only the traits above the threshold are read and searched.
+    """
+    qtls = [['Trait', 'Linkage Group', 'Position', 'Exact marker', 'LOD']]
+    markers, groups, positions = [list(column)
+                                  for column in zip(*store.markers)] \
+        or [[], [], []]
+    zones = getattr(store, 'zones', None)
+    if zones is not None:
+        for cnt, trait in enumerate(store.traits):
+            if zones.is_significant(cnt, lod_threshold, strict=True):
+                qtls.extend(get_trait_qtls(
+                    trait, store.get_trait(cnt), markers, groups,
+                    positions, lod_threshold))
+        return qtls
+    for offset, traits, profiles in store.iter_blocks():
+        for trait, lods in zip(traits, profiles):
+            qtls.extend(get_trait_qtls(trait, lods, markers, groups,
+                                       positions, lod_threshold))
+    return qtls
+
+
+def get_qtls_from_sparse(sparse, lod_threshold):
+    """ Retrieve the list of significants QTLs for the QTL matrix kept in
+    the given :class:`~MQ2.sparse.SparseLODs`, see
+    :func:`get_qtls_from_rqtl_data`.
+
+    The search of :func:`get_trait_qtls` only changes its state on the
+    rows whose LOD value is kept (the others being below the threshold)
+    and on the first two rows of each linkage group, so only these rows
+    are visited.
+    """
+    qtls = [['Trait', 'Linkage Group', 'Position', 'Exact marker', 'LOD']]
+    markers, groups, positions = [list(column)
+                                  for column in zip(*sparse.markers)] \
+        or [[], [], []]
+    lod_threshold = float(lod_threshold)
+    boundaries = set([0])
+    for linkgrp, start, stop in sparse.get_groups():
+        boundaries.update([start, start + 1])
+    boundaries = sorted([cnt for cnt in boundaries if cnt < len(markers)])
+    below = float('-inf')
+
+    for trait, indexes, values in sparse.iter_traits():
+        lods = dict(zip(indexes, values))
         lgroup = None
         max_lod = None
         peak = None
-        cnt = 1
-        while cnt < len(row):
+        for cnt, rows in itertools.groupby(
+                heapq.merge(indexes, boundaries)):
+            lod = lods.get(cnt, below)
             if lgroup is None:
-                lgroup = t_matrix[1][cnt]
+                lgroup = groups[cnt]
 
-            if lgroup == t_matrix[1][cnt]:
+            if lgroup == groups[cnt]:
                 if max_lod is None:
-                    max_lod = float(row[cnt])
-                if float(row[cnt]) > float(max_lod):
-                    max_lod = float(row[cnt])
+                    max_lod = lod
+                if lod > max_lod:
+                    max_lod = lod
                     peak = cnt
             else:
                 if max_lod \
-                        and float(max_lod) > float(lod_threshold) \
-                        and peak:
-                    qtl = [row[0],             # trait
-                           t_matrix[1][peak],  # LG
-                           t_matrix[2][peak],  # pos
-                           t_matrix[0][peak],  # marker
-                           max_lod,            # LOD value
-                           ]
-                    qtls.append(qtl)
+                        and max_lod > lod_threshold \
+                        and peak is not None:
+                    qtls.append([trait, groups[peak], positions[peak],
+                                 markers[peak], max_lod])
                 lgroup = None
                 max_lod = None
                 peak = cnt
-            cnt = cnt + 1
     return qtls
 
 
+def _clean_row(row):
+    """ Return the cells of a row of the input file, as they are read by
+    :func:`MQ2.read_input_file` with ``noquote`` and written by
+    :func:`MQ2.write_matrix`.
+    """
+    return [cel.strip() for cel in row.strip().replace('"', '').split(',')]
+
+
+def _copy_input_file(inputfile, matrix_file, map_file, store=None,
+                     chunk_size=1000, sparse=None):
+    """ Write the QTL matrix and map files reading the input file one row
+    at a time and, if a :class:`~MQ2.lodstore.LODStore` is given, copy
+    the LOD values in it a chunk of rows at a time. If a
+    :class:`~MQ2.sparse.SparseLODs` is given, the LOD values above its
+    floor are added to it.
+    """
+    map_stream = open(map_file, 'w')
+    matrix_stream = open(matrix_file, 'w')
+    try:
+        map_stream.write('Locus,Group,Position\n')
+        rows = []
+        start = 0
+        with open(inputfile) as stream:
+            for cnt, row in enumerate(stream):
+                row = _clean_row(row)
+                matrix_stream.write(','.join(row) + '\n')
+                if row[0] and not re.match(r'c\d+\.loc[\d\.]+', row[0]):
+                    map_stream.write(','.join(row[:3]) + '\n')
+                if sparse is not None:
+                    if cnt == 0:
+                        sparse.set_traits(row[3:], headers=row[:3])
+                    else:
+                        sparse.add_row(row[:3], row[3:])
+                if cnt == 0 or store is None:
+                    continue
+                rows.append(row[3:])
+                if len(rows) == chunk_size:
+                    store.set_rows(start, rows)
+                    start += len(rows)
+                    rows = []
+        if store is not None:
+            store.set_rows(start, rows)
+            store.flush()
+    finally:
+        map_stream.close()
+        matrix_stream.close()
+
+
+def _convert_to_store(inputfile, store_path, matrix_file, map_file):
+    """ Copy the QTL matrix of the input file in a new
+    :class:`~MQ2.lodstore.LODStore` and write the QTL matrix and map
+    files, see :func:`_copy_input_file`. Returns the store.
+    """
+    with open(inputfile) as stream:
+        headers = _clean_row(stream.readline())
+        markers = [_clean_row(row)[:3] for row in stream]
+    store = LODStore.create(store_path, markers, headers[3:],
+                            headers=headers[:3])
+    _copy_input_file(inputfile, matrix_file, map_file, store=store)
+    return store
+
+
 def get_map_matrix(inputfile):
     """ Return the matrix representation of the genetic map.
 
@@ -108,6 +273,17 @@ def get_map_matrix(inputfile):
 
     """
     matrix = read_input_file(inputfile, sep=',', noquote=True)
+    return get_map_from_matrix(matrix)
+
+
+def get_map_from_matrix(matrix):
+    """ Return the matrix representation of the genetic map contained in
+    the given QTL matrix, ie: its rows without the pseudo-markers added
+    by R/qtl.
+
+    :arg matrix: the QTL matrix as a list of rows.
+
+    """
     output = [['Locus', 'Group', 'Position']]
     for row in matrix:
         if row[0] and not re.match(r'c\d+\.loc[\d\.]+', row[0]):
@@ -122,6 +298,10 @@ class CSVPlugin(PluginInterface):
 
     name = 'CSV plugin'
     session_name = None
+    # The file is written row by row, its traits (columns) can only be
+    # parsed one at a time by transposing the whole file: it is converted
+    # at once, see convert_inputfiles.
+    streaming = False
 
     @classmethod
     def is_applicable(cls):
@@ -161,6 +341,86 @@ class CSVPlugin(PluginInterface):
                     filelist.append(filename)
         return filelist
 
+    @classmethod
+    def _get_inputfile(cls, folder=None, inputfile=None):
+        """ Return the input file to convert, checking that there is one
+        and only one.
+        """
+        if folder is None and inputfile is None:
+            raise MQ2Exception('You must specify either a folder or an '
+                               'input file')
+
+        if folder is not None:  # pragma: no cover
+            if not os.path.isdir(folder):
+                raise MQ2Exception('The specified folder is actually '
+                                   'not a folder')
+            else:
+                inputfiles = cls.get_files(folder)
+
+        if inputfile is not None:  # pragma: no cover
+            if os.path.isdir(inputfile):
+                raise MQ2Exception('The specified input file is actually '
+                                   'a folder')
+            else:
+                inputfiles = [inputfile]
+
+        if len(inputfiles) == 0:  # pragma: no cover
+            raise MQ2Exception('No files correspond to this plugin')
+
+        if len(inputfiles) > 1:  # pragma: no cover
+            raise MQ2Exception(
+                'This plugin can only process one file at a time')
+
+        return inputfiles[0]
+
+    @classmethod
+    def get_map(cls, folder=None, inputfile=None, session=None):
+        """ Return the positions of the QTL matrix, the genetic map and
+        the headers of the list of QTLs.
+        See :meth:`MQ2.plugin_interface.PluginInterface.get_map`.
+
+        :kwarg folder: the path to the folder containing the files to
+            check. This folder may contain sub-folders.
+        :kwarg inputfile: the path to the input file to use
+        :kwarg session: the session identifier used to identify which
+            session to process
+
+        """
+        inputfile = cls._get_inputfile(folder, inputfile)
+        matrix = read_input_file(inputfile, sep=',', noquote=True)
+        return ([row[:3] for row in matrix], get_map_from_matrix(matrix),
+                ['Trait', 'Linkage Group', 'Position', 'Exact marker',
+                 'LOD'])
+
+    @classmethod
+    def iter_traits(cls, folder=None, inputfile=None, session=None,
+                    lod_threshold=None, profiler=None):
+        """ Iterate over the traits (columns) of the input file.
+        See :meth:`MQ2.plugin_interface.PluginInterface.iter_traits`.
+
+        :kwarg folder: the path to the folder containing the files to
+            check. This folder may contain sub-folders.
+        :kwarg inputfile: the path to the input file to use
+        :kwarg session: the session identifier used to identify which
+            session to process
+        :kwarg lod_threshold: the LOD threshold to apply to determine if
+            a QTL is significant or not
+        :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to
+            record the time spent on each input file, or None.
+
+        """
+        inputfile = cls._get_inputfile(folder, inputfile)
+        with profile_file(profiler, inputfile):
+            # The file is written row by row, its columns are only known
+            # once it is read
+            columns = list(zip(*read_input_file(inputfile, sep=',',
+                                                noquote=True)))
+        markers, groups, positions = [column[1:] for column in columns[:3]]
+        for column in columns[3:]:
+            yield column[0], list(column[1:]), get_trait_qtls(
+                column[0], column[1:], markers, groups, positions,
+                lod_threshold)
+
     @classmethod
     def convert_inputfiles(cls,
                            folder=None,
@@ -169,7 +429,11 @@ class CSVPlugin(PluginInterface):
                            lod_threshold=None,
                            qtls_file='qtls.csv',
                            matrix_file='qtls_matrix.csv',
-                           map_file='map.csv'):
+                           map_file='map.csv',
+                           profiler=None,
+                           lod_store=None,
+                           max_memory=None,
+                           sparse=None):
         """ Convert the input files present in the given folder or
         inputfile.
         This method creates the matrix representation of the QTLs
@@ -196,50 +460,63 @@ class CSVPlugin(PluginInterface):
         :kwarg map_file: a csv file containing the genetic map used
             in this experiment. The map is of structure:
                marker, linkage group, position
+        :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to
+            record the time spent on each input file, or None.
+        :kwarg lod_store: the path of a :class:`~MQ2.lodstore.LODStore`
+            in which to copy the LOD values. The input file is then read
+            a chunk of rows at a time instead of being loaded in memory.
+        :kwarg max_memory: the memory, in bytes, available to a chunk of
+            traits. If specified, the input file is read one chunk of
+            traits at a time (see :class:`~MQ2.chunked.MatrixFile`)
+            instead of being loaded in memory.
+        :kwarg sparse: a :class:`~MQ2.sparse.SparseLODs` to fill with the
+            LOD values above its floor. The input file is then read one
+            row at a time and the QTLs searched in the sparse matrix.
 
         """
-        if folder is None and inputfile is None:
-            raise MQ2Exception('You must specify either a folder or an '
-                               'input file')
-
-        if folder is not None:  # pragma: no cover
-            if not os.path.isdir(folder):
-                raise MQ2Exception('The specified folder is actually '
-                                   'not a folder')
-            else:
-                inputfiles = cls.get_files(folder)
-
-        if inputfile is not None:  # pragma: no cover
-            if os.path.isdir(inputfile):
-                raise MQ2Exception('The specified input file is actually '
-                                   'a folder')
-            else:
-                inputfiles = [inputfile]
-
-        if len(inputfiles) == 0:  # pragma: no cover
-            raise MQ2Exception('No files correspond to this plugin')
-
-        if len(inputfiles) > 1:  # pragma: no cover
-            raise MQ2Exception(
-                'This plugin can only process one file at a time')
+        inputfile = cls._get_inputfile(folder, inputfile)
 
         try:
             lod_threshold = float(lod_threshold)
         except ValueError:
             raise MQ2Exception('LOD threshold should be a number')
 
-        inputfile = inputfiles[0]
-
-        # QTL matrix and QTL files
-        qtls = []
-        matrix = read_input_file(inputfile, sep=',', noquote=True)
-        qtls.extend(get_qtls_from_rqtl_data(matrix, lod_threshold))
-        # format QTLs and write down the selection
-        write_matrix(qtls_file, qtls)
-
-        # Write down the QTL matrix
-        write_matrix(matrix_file, matrix)
-
-        # Map matrix
-        map_matrix = get_map_matrix(inputfile)
-        write_matrix(map_file, map_matrix)
+        if sparse is not None and not lod_store:
+            with profile_file(profiler, inputfile):
+                _copy_input_file(inputfile, matrix_file, map_file,
+                                 sparse=sparse)
+                write_matrix(qtls_file,
+                             get_qtls_from_sparse(sparse, lod_threshold))
+            return
+
+        if lod_store:
+            with profile_file(profiler, inputfile):
+                with _convert_to_store(inputfile, lod_store, matrix_file,
+                                       map_file) as store:
+                    write_matrix(qtls_file,
+                                 get_qtls_from_store(store, lod_threshold))
+            return
+
+        if max_memory:
+            with profile_file(profiler, inputfile):
+                _copy_input_file(inputfile, matrix_file, map_file)
+                with MatrixFile(inputfile, noquote=True,
+                                block_memory=max_memory) as source:
+                    write_matrix(qtls_file,
+                                 get_qtls_from_store(source, lod_threshold))
+            return
+
+        with profile_file(profiler, inputfile):
+            # QTL matrix and QTL files
+            qtls = []
+            matrix = read_input_file(inputfile, sep=',', noquote=True)
+            qtls.extend(get_qtls_from_rqtl_data(matrix, lod_threshold))
+            # format QTLs and write down the selection
+            write_matrix(qtls_file, qtls)
+
+            # Write down the QTL matrix
+            write_matrix(matrix_file, matrix)
+
+            # Map matrix
+            map_matrix = get_map_matrix(inputfile)
+            write_matrix(map_file, map_matrix)
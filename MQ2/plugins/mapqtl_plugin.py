@@ -27,84 +27,49 @@
 MQ2 CSV plugin
 """
 
+import hashlib
+import json
+import logging
 import os
 
-from MQ2 import (MQ2Exception, MQ2NoSessionException,
+from MQ2 import (__version__, MQ2Exception, MQ2NoSessionException,
                  MQ2NoSuchSessionException, MQ2NoMatrixException,
-                 read_input_file, write_matrix)
+                 write_matrix)
+from MQ2.lodstore import LODStore
+from MQ2.mapchart import (get_map_chart_data_from_qtls,
+                          get_trait_map_chart_qtls)
 from MQ2.plugin_interface import PluginInterface
+from MQ2.profiling import profile_file
+from MQ2.qtl import QTL
+from MQ2.zonemap import ZoneMap, get_groups
 
 
-def get_qtls_matrix(qtl_matrix, matrix, inputfile):
-    """Extract for each position the LOD value obtained and save it in a
-    matrix.
-    This assumes that the first 4 columns are identical accross all mqo
-    files (ie: the Group, Position and Locus are the same). This
-    assumption should hold true if the files were generated from the
-    same map.
+LOG = logging.getLogger('MQ2')
 
-    :arg qtl_matrix, the matrix in which to save the output.
-    :arg matrix, the MapQTL file read in memory.
-    :arg inputfile, name of the inputfile in which the QTLs have been
-        found.
-
-    """
-    trait_name = inputfile.split(')_', 1)[1].split('.mqo')[0]
-    matrix = list(zip(*matrix))
-    if matrix[4][0] != 'LOD':
-        raise MQ2Exception(
-            'The file "%s" is not supported by MQ2. It may contain an '
-            'analysis which does not return LOD values '
-            '(such as Kruskal-Wallis or permutation test).' % inputfile)
-
-    if not qtl_matrix:
-        qtl_matrix = matrix[:4]
-    else:
-        if matrix[:4] != qtl_matrix[:4]:
-            raise MQ2NoMatrixException(
-                'The map used in the file "%s" does not'
-                ' correspond to the map used in at least one other file.'
-                % inputfile)
-    tmp = list(matrix[4])
-    tmp[0] = trait_name
-    qtl_matrix.append(tmp)
-    return qtl_matrix
+# Version of the format of the state saved by an incremental conversion
+STATE_FORMAT = 2
 
 
-def get_map_matrix(inputfile):
-    """ Return the matrix representation of the genetic map.
-
-    :arg inputfile: the path to the input file from which to retrieve the
-        genetic map.
-
+def get_trait_name(inputfile):
+    """ Return the name of the trait analyzed in the given MapQTL file.
     """
-    matrix = read_input_file(inputfile)
-    output = []
-    for row in matrix:
-        if row[3]:
-            output.append([row[3], row[1], row[2]])
-    return output
-
-
-def get_qtls_from_mapqtl_data(matrix, threshold, inputfile):
-    """Extract the QTLs found by MapQTL reading its file.
-    This assume that there is only one QTL per linkage group.
+    return inputfile.split(')_', 1)[1].split('.mqo')[0]
 
-    :arg matrix, the MapQTL file read in memory
-    :arg threshold, threshold used to determine if a given LOD value is
-        reflective the presence of a QTL.
-    :arg inputfile, name of the inputfile in which the QTLs have been
-        found
 
+def _find_peaks(rows, threshold, trait_name):
+    """ Return the peak of each linkage group whose LOD value is above the
+    threshold, given the rows of a MapQTL file (without the headers), as
+    the QTLs of the trait. This assume that there is only one QTL per
+    linkage group.
     """
-    trait_name = inputfile.split(')_', 1)[1].split('.mqo')[0]
+    threshold = float(threshold)
     qtls = []
     qtl = None
-    for entry in matrix[1:]:
+    for entry in rows:
         if qtl is None:
             qtl = entry
         if qtl[1] != entry[1]:
-            if float(qtl[4]) > float(threshold):
+            if float(qtl[4]) > threshold:
                 qtl[0] = trait_name
                 qtls.append(qtl)
             qtl = entry
@@ -115,7 +80,7 @@ def get_qtls_from_mapqtl_data(matrix, threshold, inputfile):
         if float(entry[4]) > float(qtl[4]):
             qtl = entry
 
-    if float(qtl[4]) > float(threshold):
+    if qtl is not None and float(qtl[4]) > threshold:
         qtl[0] = trait_name
         if qtl not in qtls:
             qtls.append(qtl)
@@ -123,6 +88,495 @@ def get_qtls_from_mapqtl_data(matrix, threshold, inputfile):
     return qtls
 
 
+def get_qtls_from_mapqtl_data(matrix, threshold, inputfile):
+    """Extract the QTLs found by MapQTL reading its file.
+    This assume that there is only one QTL per linkage group.
+
+    :arg matrix, the MapQTL file read in memory
+    :arg threshold, threshold used to determine if a given LOD value is
+        reflective the presence of a QTL.
+    :arg inputfile, name of the inputfile in which the QTLs have been
+        found
+
+    """
+    return _find_peaks(matrix[1:], threshold, get_trait_name(inputfile))
+
+
+def _get_map_line(row):
+    """ Return the number, group, position and locus of a row of a MapQTL
+    file as they are added to the fingerprint of its map.
+    """
+    return ('\t'.join(row[:4]) + '\n').encode('utf-8')
+
+
+def get_map_fingerprint(rows):
+    """ Return the fingerprint of the map used in a MapQTL file: the SHA1
+    checksum of the number, group, position and locus columns of its
+    rows, see :func:`parse_mapqtl_file`.
+
+    :arg rows: the rows of the MapQTL file, the headers included.
+
+    """
+    checksum = hashlib.sha1()
+    for row in rows:
+        checksum.update(_get_map_line(row))
+    return checksum.hexdigest()
+
+
+def parse_mapqtl_file(inputfile, lod_threshold, keep_map=False):
+    """ Parse a MapQTL file in a single pass over its rows, without
+    loading it in memory nor transposing it.
+    While reading each row, the LOD column is checked, the LOD value
+    extracted, the peak of the linkage group updated as
+    :func:`get_qtls_from_mapqtl_data` does and the row added to the
+    fingerprint of the map (see :func:`get_map_fingerprint`).
+    Raises a :class:`MQ2.MQ2Exception` if a row is truncated before its
+    LOD value.
+
+    Returns a tuple of: the headers of the file, the LOD values at each
+    row, the significant QTLs found, the fingerprint of the map and, if
+    ``keep_map`` is True, the number, group, position and locus of each
+    row (the headers included), None otherwise.
+
+    :arg inputfile: the path to the MapQTL file.
+    :arg lod_threshold: threshold used to determine if a given LOD value
+        is reflective the presence of a QTL.
+    :kwarg keep_map: whether to return the map of the file.
+
+    """
+    checksum = hashlib.sha1()
+    lods = []
+    rows = [] if keep_map else None
+
+    def iter_rows(stream):
+        """ Iterate over the rows of the file, recording their LOD value
+        and map while they are read.
+        """
+        for cnt, row in enumerate(stream):
+            entry = row.strip().split('\t')
+            if len(entry) < 5:
+                raise MQ2Exception(
+                    'The row %s of the file "%s" is truncated, it has %s '
+                    'columns instead of %s.'
+                    % (cnt + 2, inputfile, len(entry), len(headers)))
+            checksum.update(_get_map_line(entry))
+            if keep_map:
+                rows.append(entry[:4])
+            lods.append(entry[4])
+            yield entry
+
+    with open(inputfile, 'r') as stream:
+        headers = stream.readline().strip().split('\t')
+        if len(headers) < 5 or headers[4] != 'LOD':
+            raise MQ2Exception(
+                'The file "%s" is not supported by MQ2. It may contain an '
+                'analysis which does not return LOD values '
+                '(such as Kruskal-Wallis or permutation test).' % inputfile)
+        checksum.update(_get_map_line(headers))
+        if keep_map:
+            rows.append(headers[:4])
+        qtls = _find_peaks(iter_rows(stream), lod_threshold,
+                           get_trait_name(inputfile))
+    return headers, lods, qtls, checksum.hexdigest(), rows
+
+
+def _iter_matrix_rows(map_rows, traits, columns):
+    """ Iterate over the rows of the QTL matrix, the first being the
+    headers, given the map of the MapQTL files (see
+    :func:`parse_mapqtl_file`) and the LOD values of each trait.
+    """
+    yield [map_rows[0][3], map_rows[0][1], map_rows[0][2]] + traits
+    for cnt, row in enumerate(map_rows[1:]):
+        yield [row[3], row[1], row[2]] + [column[cnt] for column in columns]
+
+
+def _get_file_hash(filename):
+    """ Return the SHA1 checksum of the content of the given file. """
+    checksum = hashlib.sha1()
+    with open(filename, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def get_results_folder(state_file):
+    """ Return the folder, next to the state file of an incremental
+    conversion, in which the results of each input file are saved.
+    """
+    return '%s_files' % os.path.splitext(state_file)[0]
+
+
+def _get_results_file(state_file, relpath):
+    """ Return the file in which the results of the input file of the
+    given path, relative to the input folder, are saved.
+    """
+    return os.path.join(get_results_folder(state_file), '%s.json'
+                        % hashlib.sha1(relpath.encode('utf-8')).hexdigest())
+
+
+def _read_json(filename):
+    """ Return the data saved as JSON in the given file, None if it does
+    not exist or cannot be read.
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename) as stream:
+            return json.load(stream)
+    except (IOError, ValueError) as err:  # pragma: no cover
+        LOG.info('Could not read %s' % filename)
+        LOG.debug('Error: %s' % err)
+        return None
+
+
+def _write_json(filename, data):
+    """ Save the data as JSON in the given file, replacing it at once. """
+    tmp_file = '%s.%s.tmp' % (filename, os.getpid())
+    with open(tmp_file, 'w') as stream:
+        json.dump(data, stream)
+    os.replace(tmp_file, filename)
+
+
+def load_session_state(state_file, session, lod_threshold):
+    """ Return the state saved by a previous incremental conversion of the
+    same session with the same LOD threshold and the same version of MQ²,
+    or an empty state if there is none.
+
+    The state associates to each input file (path relative to the input
+    folder) its modification time, size and checksum, the results of the
+    file being saved in its own file (see :func:`get_results_folder` and
+    :func:`get_trait_results`). It also contains the fingerprint of the
+    map shared by all the files and the traits of the QTL matrix written.
+
+    :arg state_file: the path to the file containing the state.
+    :arg session: the session identifier processed.
+    :arg lod_threshold: the LOD threshold used.
+
+    """
+    empty = {'version': __version__, 'format': STATE_FORMAT,
+             'session': str(session), 'lod_threshold': lod_threshold,
+             'fingerprint': None, 'traits': [], 'files': {}}
+    if not state_file:
+        return empty
+    state = _read_json(state_file)
+    if state is None:
+        return empty
+    for key in ['version', 'format', 'session', 'lod_threshold']:
+        if state.get(key) != empty[key]:
+            LOG.info('Session state in %s is outdated, ignoring it'
+                     % state_file)
+            return empty
+    return state
+
+
+def save_session_state(state_file, state):
+    """ Save the state of the conversion of a session in the given file,
+    see :func:`load_session_state`.
+    """
+    _write_json(state_file, state)
+
+
+def get_trait_results(markers, trait, lods, lod_threshold):
+    """ Return the results of a trait needed to count the QTLs on the
+    rows of the QTL matrix and to write the MapChart file without reading
+    its LOD values again: the index of the rows at which it is counted
+    (see :func:`MQ2.mq2.add_count_to_matrix`) and its QTLs found on each
+    linkage group, as ``[linkage group index, first row above threshold,
+    QTL as a dictionary]`` (see
+    :func:`MQ2.mapchart.get_trait_map_chart_qtls`).
+
+    :arg markers: the list of ``marker, linkage group, position`` of
+        each row of the QTL matrix.
+    :arg trait: the name of the trait.
+    :arg lods: the LOD values of the trait at each row, as read.
+    :arg lod_threshold: the LOD threshold.
+
+    """
+    lod_threshold = float(lod_threshold)
+    values = [_to_float(lod) for lod in lods]
+    zones = ZoneMap.from_markers(markers)
+    zones.add_trait(values)
+    rows = []
+    for groupcnt in zones.get_significant_groups(0, lod_threshold,
+                                                 strict=True):
+        linkgrp, start, stop = zones.groups[groupcnt]
+        # NaN, ie: missing values, are never above threshold
+        rows.extend([cnt for cnt in range(start, stop)
+                     if values[cnt] > lod_threshold])
+    found = []
+    for groupcnt, qtls_found in enumerate(get_trait_map_chart_qtls(
+            markers, trait, values, lod_threshold, zones=zones)):
+        for first, index, qtl in qtls_found:
+            found.append([groupcnt, first, qtl.to_dict()])
+    return rows, found
+
+
+def _to_float(value):
+    """ Return the LOD value of a cell as a float, NaN if it is missing.
+    """
+    value = value.strip()
+    if not value:
+        return float('nan')
+    return float(value)
+
+
+class _StaleMatrix(Exception):
+    """ Raised when the QTL matrix written by a previous conversion does
+    not correspond to the state saved.
+    """
+
+
+def _get_matrix_traits(matrix_file):
+    """ Return the traits of the given QTL matrix file and whether it
+    contains the number of QTLs found on each row, None and False if
+    the file does not exist.
+    """
+    if not os.path.exists(matrix_file):
+        return None, False
+    with open(matrix_file) as stream:
+        headers = [cel.strip() for cel in stream.readline().split(',')]
+    if headers[-1] == '# QTLs':
+        return headers[3:-1], True
+    return headers[3:], False
+
+
+def _iter_merged_rows(stream, markers, traits, previous, lods):
+    """ Iterate over the rows of the QTL matrix of the given traits, the
+    LOD values of the traits parsed (given by their index in ``lods``)
+    being added to those of the other traits read, row by row, from the
+    stream of the previous QTL matrix file, see
+    :func:`_write_merged_matrix`.
+    """
+    columns = []
+    for cnt, trait in enumerate(traits):
+        if cnt in lods:
+            columns.append(lods[cnt])
+        else:
+            columns.append(3 + previous[trait])
+    yield markers[0] + traits
+    for rowcnt, marker in enumerate(markers[1:]):
+        row = None
+        if stream is not None:
+            row = [cel.strip() for cel in stream.readline().split(',')]
+            if row[:3] != marker:
+                raise _StaleMatrix()
+        try:
+            yield marker + [
+                row[column] if isinstance(column, int) else column[rowcnt]
+                for column in columns]
+        except IndexError:
+            raise _StaleMatrix()
+    if stream is not None and stream.readline().strip():
+        raise _StaleMatrix()
+
+
+def _write_merged_matrix(matrix_file, markers, traits, previous, lods):
+    """ Write the QTL matrix of the given traits, the LOD values of the
+    traits which were not parsed again being read from the previous QTL
+    matrix file, one row at a time.
+    Raises :class:`_StaleMatrix` if the rows of the previous QTL matrix
+    do not correspond to the markers.
+
+    :arg matrix_file: the QTL matrix file, previous and new.
+    :arg markers: the ``marker, linkage group, position`` of each row of
+        the QTL matrix, the first one being the headers.
+    :arg traits: the traits of the new QTL matrix.
+    :arg previous: a dictionary giving the index of each trait of the
+        previous QTL matrix.
+    :arg lods: a dictionary giving the LOD values of the traits parsed
+        again, by their index in ``traits``.
+
+    """
+    tmp_file = '%s.%s.tmp' % (matrix_file, os.getpid())
+    stream = None
+    if len(lods) < len(traits):
+        stream = open(matrix_file)
+        stream.readline()
+    try:
+        write_matrix(tmp_file, _iter_merged_rows(
+            stream, markers, traits, previous, lods))
+    except _StaleMatrix:
+        os.unlink(tmp_file)
+        raise
+    finally:
+        if stream is not None:
+            stream.close()
+    os.replace(tmp_file, matrix_file)
+
+
+def convert_incremental(inputfiles, folder, session, lod_threshold,
+                        state_file, qtls_file='qtls.csv',
+                        matrix_file='qtls_matrix.csv', map_file='map.csv',
+                        profiler=None, keep_counts=True, use_state=True):
+    """ Convert the input files of a session, only parsing the files
+    which were added or modified since the state of the session was
+    saved (see :func:`load_session_state`).
+
+    For the other files, the QTLs found, the rows at which they are
+    counted and the QTLs of the MapChart file are read from their
+    results (see :func:`get_trait_results`) and their LOD values from
+    the QTL matrix file previously written, which is merged, row by row,
+    with the LOD values of the files parsed. The map file is only
+    written again if the map changed and, if no file changed, the QTL
+    matrix and QTL files are kept as they are.
+
+    Returns a dictionary with the number of QTLs found on each row
+    (``qtl_counts``), or ``matrix_counted`` if the QTL matrix was kept
+    with its counts, and the data of the MapChart file
+    (``map_chart_data``, see :func:`MQ2.mapchart.get_map_chart_data`).
+
+    :arg inputfiles: the sorted list of the input files of the session.
+    :arg folder: the folder containing the input files.
+    :arg session: the session identifier.
+    :arg lod_threshold: the LOD threshold, as a float.
+    :arg state_file: the path to the file containing the state.
+    :kwarg qtls_file: the file in which to write the significant QTLs.
+    :kwarg matrix_file: the file in which to write the QTL matrix.
+    :kwarg map_file: the file in which to write the genetic map.
+    :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to record
+        the time spent on each input file, or None.
+    :kwarg keep_counts: whether the QTL matrix may be kept with the
+        number of QTLs found on each row if no file changed.
+    :kwarg use_state: whether to re-use the results of the previous
+        conversion, if False all the files are parsed.
+
+    """
+    if not inputfiles:
+        raise MQ2Exception('No files correspond to this plugin')
+    state = load_session_state(state_file, session, lod_threshold)
+    results_folder = get_results_folder(state_file)
+    if not os.path.isdir(results_folder):
+        os.makedirs(results_folder)
+
+    cached = {}
+    previous, counted = _get_matrix_traits(matrix_file)
+    markers = None
+    if use_state and previous == state['traits'] \
+            and len(set(previous)) == len(previous):
+        markers = _read_json(os.path.join(results_folder, 'map.json'))
+        if markers is not None:
+            cached = state['files']
+    previous = dict([(trait, cnt) for cnt, trait in enumerate(previous or [])])
+    map_fingerprint = state['fingerprint']
+
+    entries = {}
+    results = []
+    lods = {}
+    fingerprint = None
+    for cnt, filename in enumerate(inputfiles):
+        relpath = os.path.relpath(filename, folder)
+        trait = get_trait_name(filename)
+        results_file = _get_results_file(state_file, relpath)
+        entry = _get_cached_file(cached, folder, filename)
+        result = None
+        if entry is not None and trait in previous:
+            result = _read_json(results_file)
+        if result is not None:
+            file_fingerprint = state['fingerprint']
+        else:
+            with profile_file(profiler, filename):
+                headers, lods[cnt], qtls, file_fingerprint, rows = \
+                    parse_mapqtl_file(filename, lod_threshold,
+                                      keep_map=True)
+                if markers is None or file_fingerprint != map_fingerprint:
+                    markers = [[row[3], row[1], row[2]] for row in rows]
+                    map_fingerprint = file_fingerprint
+                counts, found = get_trait_results(
+                    [[cel.strip() for cel in row] for row in markers[1:]],
+                    trait, lods[cnt], lod_threshold)
+            result = {'trait': trait, 'headers': headers, 'qtls': qtls,
+                      'counts': counts, 'found': found}
+            _write_json(results_file, result)
+            stat = os.stat(filename)
+            entry = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                     'sha1': _get_file_hash(filename)}
+        if fingerprint is None:
+            fingerprint = file_fingerprint
+        elif file_fingerprint != fingerprint:
+            raise MQ2NoMatrixException(
+                'The map used in the file "%s" does not'
+                ' correspond to the map used in at least one'
+                ' other file.' % filename)
+        entries[relpath] = entry
+        results.append(result)
+    for relpath in set(state['files']) - set(entries):
+        results_file = _get_results_file(state_file, relpath)
+        if os.path.exists(results_file):
+            os.unlink(results_file)
+
+    traits = [result['trait'] for result in results]
+    changed = bool(lods) or traits != state['traits'] \
+        or set(entries) != set(cached)
+    if fingerprint != state['fingerprint'] or not os.path.exists(map_file):
+        write_matrix(map_file, [row for row in markers if row[0]])
+    if fingerprint != state['fingerprint'] \
+            or not os.path.exists(os.path.join(results_folder, 'map.json')):
+        _write_json(os.path.join(results_folder, 'map.json'), markers)
+    if changed or not os.path.exists(qtls_file):
+        headers = list(results[-1]['headers'])
+        headers[0] = 'Trait name'
+        write_matrix(qtls_file, [headers] + [
+            qtl for result in results for qtl in result['qtls']])
+
+    # Locus, group and position of each row
+    markers = [[cel.strip() for cel in row] for row in markers]
+    output = {}
+    if not changed and counted and keep_counts:
+        LOG.info('No input file changed, QTL matrix %s kept' % matrix_file)
+        output['matrix_counted'] = True
+    else:
+        try:
+            _write_merged_matrix(matrix_file, markers, traits, previous,
+                                 lods)
+        except _StaleMatrix:
+            LOG.info('The QTL matrix %s does not correspond to the state '
+                     'of the session, parsing all the files again'
+                     % matrix_file)
+            return convert_incremental(
+                inputfiles, folder, session, lod_threshold, state_file,
+                qtls_file=qtls_file, matrix_file=matrix_file,
+                map_file=map_file, profiler=profiler,
+                keep_counts=keep_counts, use_state=False)
+        qtl_counts = [0] * (len(markers) - 1)
+        for result in results:
+            for row in result['counts']:
+                qtl_counts[row] += 1
+        output['qtl_counts'] = qtl_counts
+
+    found = [[] for group in get_groups(markers[1:])[:-1]]
+    for index, result in enumerate(results):
+        for groupcnt, first, qtl in result['found']:
+            found[groupcnt].append((first, index, QTL.from_dict(qtl)))
+    output['map_chart_data'] = get_map_chart_data_from_qtls(
+        markers[1:], found)
+
+    new_state = dict(state, fingerprint=fingerprint, traits=traits,
+                     files=entries)
+    if new_state != state:
+        save_session_state(state_file, new_state)
+    return output
+
+
+def _get_cached_file(cached_files, folder, filename):
+    """ Return the entry of the state corresponding to the given file if
+    the file did not change since the state was saved, None otherwise.
+    The modification time and size are checked first, the checksum is
+    only computed if they differ (for example when the files are
+    extracted again from the same archive).
+    """
+    entry = cached_files.get(os.path.relpath(filename, folder))
+    if entry is None:
+        return None
+    stat = os.stat(filename)
+    if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+        return entry
+    if entry['size'] == stat.st_size \
+            and entry['sha1'] == _get_file_hash(filename):
+        entry['mtime'] = stat.st_mtime
+        return entry
+    return None
+
+
 class MapQTLPlugin(PluginInterface):
     """ Plugin to extract QTLs from MapQTL output files.
 
@@ -130,6 +584,7 @@ class MapQTLPlugin(PluginInterface):
 
     name = 'MapQTL plugin'
     session_name = 'MapQTL session'
+    streaming = True
 
     @classmethod
     def is_applicable(cls):
@@ -201,6 +656,103 @@ class MapQTLPlugin(PluginInterface):
                         sessions.append(session)
         return sessions
 
+    @classmethod
+    def _get_session_files(cls, folder=None, inputfile=None, session=None):
+        """ Return the sorted list of the input files of the given
+        session, checking that the session exists.
+        """
+        if folder is None and inputfile is None:
+            raise MQ2Exception('You must specify either a folder or an '
+                               'input file')
+
+        sessions = cls.get_session_identifiers(folder)
+        if session is None:
+            raise MQ2NoSessionException(
+                'The MapQTL plugin requires a session identifier to '
+                'identify the session to process.'
+                'Sessions are: %s' % ','.join(sessions))
+        elif str(session) not in sessions:
+            raise MQ2NoSuchSessionException(
+                'The MapQTL session provided (%s) could not be found in the '
+                'dataset. '
+                'Sessions are: %s' % (session, ','.join(sessions)))
+
+        if folder is not None:
+            if not os.path.isdir(folder):  # pragma: no cover
+                raise MQ2Exception('The specified folder is actually '
+                                   'not a folder')
+            else:
+                inputfiles = cls.get_files(folder, session_id=session)
+
+        if inputfile is not None:  # pragma: no cover
+            if os.path.isdir(inputfile):
+                raise MQ2Exception('The specified input file is actually '
+                                   'a folder')
+            else:
+                inputfiles = [inputfile]
+
+        inputfiles.sort()
+        return inputfiles
+
+    @classmethod
+    def get_map(cls, folder=None, inputfile=None, session=None):
+        """ Return the positions of the QTL matrix of the given session,
+        its genetic map and the headers of its list of QTLs, read from
+        its first input file.
+        See :meth:`MQ2.plugin_interface.PluginInterface.get_map`.
+
+        :kwarg folder: the path to the folder containing the files to
+            check. This folder may contain sub-folders.
+        :kwarg inputfile: the path to the input file to use
+        :kwarg session: the session identifier used to identify which
+            session to process
+
+        """
+        inputfiles = cls._get_session_files(folder, inputfile, session)
+        if not inputfiles:
+            raise MQ2Exception('No files correspond to this plugin')
+        with open(inputfiles[0], 'r') as stream:
+            headers = stream.readline().strip().split('\t')
+            positions = [[headers[3], headers[1], headers[2]]]
+            for row in stream:
+                row = row.strip().split('\t', 4)
+                positions.append([row[3], row[1], row[2]])
+        headers[0] = 'Trait name'
+        return positions, [row for row in positions if row[0]], headers
+
+    @classmethod
+    def iter_traits(cls, folder=None, inputfile=None, session=None,
+                    lod_threshold=None, profiler=None):
+        """ Iterate over the traits of the given session, parsing one
+        input file at a time.
+        See :meth:`MQ2.plugin_interface.PluginInterface.iter_traits`.
+
+        :kwarg folder: the path to the folder containing the files to
+            check. This folder may contain sub-folders.
+        :kwarg inputfile: the path to the input file to use
+        :kwarg session: the session identifier used to identify which
+            session to process
+        :kwarg lod_threshold: the LOD threshold to apply to determine if
+            a QTL is significant or not
+        :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to
+            record the time spent on each input file, or None.
+
+        """
+        inputfiles = cls._get_session_files(folder, inputfile, session)
+        fingerprint = None
+        for filename in inputfiles:
+            with profile_file(profiler, filename):
+                headers, lods, qtls, file_fingerprint, rows = \
+                    parse_mapqtl_file(filename, lod_threshold)
+            if fingerprint is None:
+                fingerprint = file_fingerprint
+            elif file_fingerprint != fingerprint:
+                raise MQ2NoMatrixException(
+                    'The map used in the file "%s" does not'
+                    ' correspond to the map used in at least one other'
+                    ' file.' % filename)
+            yield get_trait_name(filename), lods, qtls
+
     @classmethod
     def convert_inputfiles(cls,
                            folder=None,
@@ -209,7 +761,11 @@ class MapQTLPlugin(PluginInterface):
                            lod_threshold=None,
                            qtls_file='qtls.csv',
                            matrix_file='qtls_matrix.csv',
-                           map_file='map.csv'):
+                           map_file='map.csv',
+                           profiler=None,
+                           state_file=None,
+                           lod_store=None,
+                           sparse=None):
         """ Convert the input files present in the given folder or
         inputfile.
         This method creates the matrix representation of the QTLs
@@ -236,69 +792,92 @@ class MapQTLPlugin(PluginInterface):
         :kwarg map_file: a csv file containing the genetic map used
             in this experiment. The map is of structure:
                marker, linkage group, position
+        :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to
+            record the time spent on each input file, or None.
+        :kwarg state_file: a JSON file in which the state of the
+            conversion is saved, the results of each input file being
+            saved next to it. When the session is converted again, only
+            the new or modified files are parsed, see
+            :func:`convert_incremental`. The LOD values are then neither
+            written in ``lod_store`` nor in ``sparse``.
+        :kwarg lod_store: the path of a :class:`~MQ2.lodstore.LODStore`
+            in which to write the LOD values of each trait as soon as
+            its file is parsed, instead of keeping them in memory.
+        :kwarg sparse: a :class:`~MQ2.sparse.SparseLODs` to fill with the
+            LOD values of each trait above its floor.
 
         """
-        if folder is None and inputfile is None:
-            raise MQ2Exception('You must specify either a folder or an '
-                               'input file')
-
-        sessions = cls.get_session_identifiers(folder)
-        if session is None:
-            raise MQ2NoSessionException(
-                'The MapQTL plugin requires a session identifier to '
-                'identify the session to process.'
-                'Sessions are: %s' % ','.join(sessions))
-        elif str(session) not in sessions:
-            raise MQ2NoSuchSessionException(
-                'The MapQTL session provided (%s) could not be found in the '
-                'dataset. '
-                'Sessions are: %s' % (session, ','.join(sessions)))
-
-        if folder is not None:
-            if not os.path.isdir(folder):  # pragma: no cover
-                raise MQ2Exception('The specified folder is actually '
-                                   'not a folder')
-            else:
-                inputfiles = cls.get_files(folder, session_id=session)
-
-        if inputfile is not None:  # pragma: no cover
-            if os.path.isdir(inputfile):
-                raise MQ2Exception('The specified input file is actually '
-                                   'a folder')
-            else:
-                inputfiles = [inputfile]
+        inputfiles = cls._get_session_files(folder, inputfile, session)
 
         try:
             lod_threshold = float(lod_threshold)
         except ValueError:
             raise MQ2Exception('LOD threshold should be a number')
 
-        inputfiles.sort()
+        if state_file and folder is not None:
+            return convert_incremental(
+                inputfiles, folder, session, lod_threshold, state_file,
+                qtls_file=qtls_file, matrix_file=matrix_file,
+                map_file=map_file, profiler=profiler,
+                keep_counts=not lod_store and sparse is None)
 
         # QTL matrix and QTL files
-        qtl_matrix = []
+        map_rows = None
+        fingerprint = None
+        traits = []
+        columns = []
         qtls = []
-        filename = None
-        for filename in inputfiles:
-            matrix = read_input_file(filename)
-            headers = matrix[0]
-            qtl_matrix = get_qtls_matrix(qtl_matrix, matrix, filename)
-            qtls.extend(get_qtls_from_mapqtl_data(matrix, lod_threshold,
-                        filename))
+        store = None
+        for filecnt, filename in enumerate(inputfiles):
+            trait = get_trait_name(filename)
+            with profile_file(profiler, filename):
+                headers, lods, file_qtls, file_fingerprint, rows = \
+                    parse_mapqtl_file(filename, lod_threshold,
+                                      keep_map=map_rows is None)
+                map_rows = map_rows or rows
+                qtls.extend(file_qtls)
+                if fingerprint is None:
+                    fingerprint = file_fingerprint
+                elif file_fingerprint != fingerprint:
+                    raise MQ2NoMatrixException(
+                        'The map used in the file "%s" does not'
+                        ' correspond to the map used in at least one'
+                        ' other file.' % filename)
+                # Locus, group and position of each row
+                if sparse is not None:
+                    if not sparse.markers:
+                        sparse.set_markers(
+                            [[row[3], row[1], row[2]]
+                             for row in map_rows[1:]],
+                            headers=[map_rows[0][3], map_rows[0][1],
+                                     map_rows[0][2]])
+                    sparse.add_trait(trait, lods)
+                if lod_store:
+                    if store is None:
+                        store = LODStore.create(
+                            lod_store, [[row[3], row[1], row[2]]
+                                        for row in map_rows[1:]],
+                            [get_trait_name(name) for name in inputfiles],
+                            headers=[map_rows[0][3], map_rows[0][1],
+                                     map_rows[0][2]])
+                    store.set_trait(filecnt, lods)
+                else:
+                    traits.append(trait)
+                    columns.append(lods)
         # format QTLs and write down the selection
         headers[0] = 'Trait name'
         qtls.insert(0, headers)
         write_matrix(qtls_file, qtls)
 
         # Write down the QTL matrix
-        del(qtl_matrix[0])
-        # Reorganize a couple of columns
-        qtl_matrix.insert(0, qtl_matrix[2])
-        del(qtl_matrix[3])
-        # write output
-        qtl_matrix = list(zip(*qtl_matrix))
-        write_matrix(matrix_file, qtl_matrix)
+        if store is not None:
+            store.write_matrix_file(matrix_file)
+            store.close()
+        else:
+            write_matrix(matrix_file,
+                         _iter_matrix_rows(map_rows, traits, columns))
 
         # Map matrix
-        map_matrix = get_map_matrix(inputfiles[0])
+        map_matrix = [[row[3], row[1], row[2]] for row in map_rows
+                      if row[3]]
         write_matrix(map_file, map_matrix)
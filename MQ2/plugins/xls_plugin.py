@@ -27,6 +27,7 @@
 MQ2 Excel plugin
 """
 
+import array
 import os
 import re
 
@@ -45,7 +46,10 @@ except ImportError:  # pragma: no cover
 
 from MQ2 import (MQ2Exception, MQ2NoSessionException,
                  MQ2NoSuchSessionException, write_matrix)
+from MQ2.lodstore import NAN, get_block_size
 from MQ2.plugin_interface import PluginInterface
+from MQ2.plugins.csv_plugin import get_qtls_from_store, get_trait_qtls
+from MQ2.profiling import profile_file
 
 
 def is_excel_file(inputfile):
@@ -87,6 +91,76 @@ def read_excel_file(inputfile, sheet_name):
     return output
 
 
+class ExcelSheet(object):
+    """ An excel sheet containing a QTL matrix, read one chunk of traits
+    (columns) at a time. It offers the same reading interface as a
+    :class:`~MQ2.chunked.MatrixFile`.
+    The sheet itself is loaded in memory by xlrd, but the matrix is
+    neither copied as a list of rows nor transposed.
+    """
+
+    def __init__(self, inputfile, sheet_name, block_memory=None):
+        """ Constructor.
+
+        :arg inputfile: excel document to read
+        :arg sheet_name: the name of the excel sheet to read
+        :kwarg block_memory: the memory, in bytes, used by a chunk of
+            traits returned by :meth:`iter_blocks`.
+
+        """
+        self.workbook = xlrd.open_workbook(inputfile, on_demand=True)
+        if sheet_name not in self.workbook.sheet_names():
+            raise MQ2Exception('Invalid session identifier provided')
+        self.sheet = self.workbook.sheet_by_name(sheet_name)
+        self.block_memory = block_memory
+        headers = self.sheet.row_values(0)
+        self.headers = headers[:3]
+        self.traits = headers[3:]
+        self.markers = [list(row) for row in zip(
+            *[self.sheet.col_values(col, 1) for col in range(3)])]
+        self.nr_positions = len(self.markers)
+
+    def iter_rows(self):
+        """ Iterate over the rows of the sheet. """
+        for row in range(self.sheet.nrows):
+            yield self.sheet.row_values(row)
+
+    def get_values(self, trait):
+        """ Return the LOD values of a trait as they are in the sheet. """
+        return self.sheet.col_values(trait + 3, 1)
+
+    def get_block_size(self, memory=None):
+        """ Return the number of traits of a chunk using at most the given
+        memory, in bytes (by default :attr:`block_memory`).
+        """
+        return get_block_size(self.nr_positions,
+                              memory or self.block_memory)
+
+    def iter_blocks(self, block_size=None):
+        """ Iterate over the chunks of traits of the sheet, see
+        :meth:`MQ2.chunked.MatrixFile.iter_blocks`.
+        """
+        block_size = block_size or self.get_block_size()
+        for start in range(0, len(self.traits), block_size):
+            stop = min(start + block_size, len(self.traits))
+            columns = []
+            for col in range(start + 3, stop + 3):
+                columns.append(array.array('d', [
+                    NAN if str(cel).strip() == '' else float(cel)
+                    for cel in self.sheet.col_values(col, 1)]))
+            yield start, self.traits[start:stop], columns
+
+    def close(self):
+        """ Release the resources of the workbook. """
+        self.workbook.release_resources()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def get_qtls_from_rqtl_data(matrix, lod_threshold):
     """ Retrieve the list of significants QTLs for the given input
     matrix and using the specified LOD threshold.
@@ -159,6 +233,7 @@ class XslPlugin(PluginInterface):
 
     name = 'Excel plugin'
     session_name = 'Excel sheet'
+    streaming = True
 
     @classmethod
     def is_applicable(cls):
@@ -240,41 +315,9 @@ class XslPlugin(PluginInterface):
         return sessions
 
     @classmethod
-    def convert_inputfiles(cls,
-                           folder=None,
-                           inputfile=None,
-                           session=None,
-                           lod_threshold=None,
-                           qtls_file='qtls.csv',
-                           matrix_file='qtls_matrix.csv',
-                           map_file='map.csv'):
-        """ Convert the input files present in the given folder or
-        inputfile.
-        This method creates the matrix representation of the QTLs
-        results providing for each marker position the LOD value found
-        for each trait as well as a representation of the genetic map
-        used in the experiment.
-        The genetic map should be cleared of any markers added by the
-        QTL mapping software.
-
-        :kwarg folder: the path to the folder containing the files to
-            check. This folder may contain sub-folders.
-        :kwarg inputfile: the path to the input file to use
-        :kwarg session: the session identifier used to identify which
-            session to process
-        :kwarg lod_threshold: the LOD threshold to apply to determine if
-            a QTL is significant or not
-        :kwarg qtls_file: a csv file containing the list of all the
-            significant QTLs found in the analysis.
-            The matrix is of type:
-               trait, linkage group, position, Marker, LOD other columns
-        :kwarg matrix_file: a csv file containing a matrix representation
-            of the QTL data. This matrix is of type:
-               marker, linkage group, position, trait1 lod, trait2, lod
-        :kwarg map_file: a csv file containing the genetic map used
-            in this experiment. The map is of structure:
-               marker, linkage group, position
-
+    def _get_inputfile(cls, folder=None, inputfile=None, session=None):
+        """ Return the input file to convert, checking that there is only
+        one and that it contains the given sheet.
         """
         if folder is None and inputfile is None:
             raise MQ2Exception('You must specify either a folder or an '
@@ -312,23 +355,139 @@ class XslPlugin(PluginInterface):
             raise MQ2Exception(
                 'This plugin can only process one file at a time')
 
+        return inputfiles[0]
+
+    @classmethod
+    def get_map(cls, folder=None, inputfile=None, session=None):
+        """ Return the positions of the QTL matrix, the genetic map and
+        the headers of the list of QTLs.
+        See :meth:`MQ2.plugin_interface.PluginInterface.get_map`.
+
+        :kwarg folder: the path to the folder containing the files to
+            check. This folder may contain sub-folders.
+        :kwarg inputfile: the path to the input file to use
+        :kwarg session: the session identifier used to identify which
+            session to process
+
+        """
+        inputfile = cls._get_inputfile(folder, inputfile, session)
+        with ExcelSheet(inputfile, session) as sheet:
+            positions = [sheet.headers] + sheet.markers
+        map_matrix = [['Locus', 'Group', 'Position']]
+        for row in positions:
+            if row[0] and not re.match(r'c\d+\.loc[\d\.]+', row[0]):
+                map_matrix.append(list(row))
+        return (positions, map_matrix,
+                ['Trait', 'Linkage Group', 'Position', 'Exact marker',
+                 'LOD'])
+
+    @classmethod
+    def iter_traits(cls, folder=None, inputfile=None, session=None,
+                    lod_threshold=None, profiler=None):
+        """ Iterate over the traits (columns) of the sheet, without
+        copying nor transposing the sheet.
+        See :meth:`MQ2.plugin_interface.PluginInterface.iter_traits`.
+
+        :kwarg folder: the path to the folder containing the files to
+            check. This folder may contain sub-folders.
+        :kwarg inputfile: the path to the input file to use
+        :kwarg session: the session identifier used to identify which
+            session to process
+        :kwarg lod_threshold: the LOD threshold to apply to determine if
+            a QTL is significant or not
+        :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to
+            record the time spent on each input file, or None.
+
+        """
+        inputfile = cls._get_inputfile(folder, inputfile, session)
+        with profile_file(profiler, inputfile):
+            sheet = ExcelSheet(inputfile, session)
+        with sheet:
+            markers, groups, positions = [
+                list(column) for column in zip(*sheet.markers)] \
+                or [[], [], []]
+            for cnt, trait in enumerate(sheet.traits):
+                lods = sheet.get_values(cnt)
+                yield trait, lods, get_trait_qtls(
+                    trait, lods, markers, groups, positions, lod_threshold)
+
+    @classmethod
+    def convert_inputfiles(cls,
+                           folder=None,
+                           inputfile=None,
+                           session=None,
+                           lod_threshold=None,
+                           qtls_file='qtls.csv',
+                           matrix_file='qtls_matrix.csv',
+                           map_file='map.csv',
+                           profiler=None,
+                           max_memory=None):
+        """ Convert the input files present in the given folder or
+        inputfile.
+        This method creates the matrix representation of the QTLs
+        results providing for each marker position the LOD value found
+        for each trait as well as a representation of the genetic map
+        used in the experiment.
+        The genetic map should be cleared of any markers added by the
+        QTL mapping software.
+
+        :kwarg folder: the path to the folder containing the files to
+            check. This folder may contain sub-folders.
+        :kwarg inputfile: the path to the input file to use
+        :kwarg session: the session identifier used to identify which
+            session to process
+        :kwarg lod_threshold: the LOD threshold to apply to determine if
+            a QTL is significant or not
+        :kwarg qtls_file: a csv file containing the list of all the
+            significant QTLs found in the analysis.
+            The matrix is of type:
+               trait, linkage group, position, Marker, LOD other columns
+        :kwarg matrix_file: a csv file containing a matrix representation
+            of the QTL data. This matrix is of type:
+               marker, linkage group, position, trait1 lod, trait2, lod
+        :kwarg map_file: a csv file containing the genetic map used
+            in this experiment. The map is of structure:
+               marker, linkage group, position
+        :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to
+            record the time spent on each input file, or None.
+        :kwarg max_memory: the memory, in bytes, available to a chunk of
+            traits. If specified, the sheet is read one chunk of traits
+            at a time instead of being copied and transposed in memory.
+
+        """
+        inputfile = cls._get_inputfile(folder, inputfile, session)
+
         try:
             lod_threshold = float(lod_threshold)
         except ValueError:
             raise MQ2Exception('LOD threshold should be a number')
 
-        inputfile = inputfiles[0]
-
-        # QTL matrix and QTL files
-        qtls = []
-        matrix = read_excel_file(inputfile, sheet_name=session)
-        qtls.extend(get_qtls_from_rqtl_data(matrix, lod_threshold))
-        # format QTLs and write down the selection
-        write_matrix(qtls_file, qtls)
-
-        # Write down the QTL matrix
-        write_matrix(matrix_file, matrix)
-
-        # Map matrix
-        map_matrix = get_map_matrix(inputfile, session)
-        write_matrix(map_file, map_matrix)
+        if max_memory:
+            with profile_file(profiler, inputfile):
+                with ExcelSheet(inputfile, session,
+                                block_memory=max_memory) as sheet:
+                    write_matrix(qtls_file,
+                                 get_qtls_from_store(sheet, lod_threshold))
+                    write_matrix(matrix_file, sheet.iter_rows())
+                    map_matrix = [['Locus', 'Group', 'Position']]
+                    for row in sheet.iter_rows():
+                        if row[0] and not re.match(
+                                r'c\d+\.loc[\d\.]+', row[0]):
+                            map_matrix.append([row[0], row[1], row[2]])
+                    write_matrix(map_file, map_matrix)
+            return
+
+        with profile_file(profiler, inputfile):
+            # QTL matrix and QTL files
+            qtls = []
+            matrix = read_excel_file(inputfile, sheet_name=session)
+            qtls.extend(get_qtls_from_rqtl_data(matrix, lod_threshold))
+            # format QTLs and write down the selection
+            write_matrix(qtls_file, qtls)
+
+            # Write down the QTL matrix
+            write_matrix(matrix_file, matrix)
+
+            # Map matrix
+            map_matrix = get_map_matrix(inputfile, session)
+            write_matrix(map_file, map_matrix)
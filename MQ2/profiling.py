@@ -0,0 +1,195 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 profiling, records the time and memory spent in each stage of a run.
+"""
+
+import contextlib
+import json
+import logging
+import time
+import tracemalloc
+
+try:  # pragma: no cover
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on Windows
+    resource = None
+
+from MQ2 import __version__
+
+
+LOG = logging.getLogger('MQ2')
+
+
+def _get_max_rss():
+    """ Return the maximum resident set size of the process in kilobytes
+    or None if it cannot be retrieved on this platform.
+    """
+    if resource is None:  # pragma: no cover
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Profiler(object):
+    """ Collects the wall time, CPU time and peak memory of the stages
+    of a MQ² run, the time spent on each input file by the plugin and
+    the size of the dataset processed.
+
+    """
+
+    def __init__(self, trace_memory=True):
+        """ Constructor.
+
+        :kwarg trace_memory: boolean specifying whether to record the
+            peak memory allocated by python in each stage using
+            tracemalloc. This slows the run down a little.
+
+        """
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.files = []
+        self.counts = {}
+        self._started_tracing = False
+        # Peak memory of each measurement in progress, the innermost last,
+        # before the last reset of the tracemalloc peak.
+        self._peaks = []
+        self._start = time.perf_counter()
+
+    def start(self):
+        """ Start tracing the memory allocations if requested. """
+        self._start = time.perf_counter()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        """ Stop tracing the memory allocations if we started it. """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextlib.contextmanager
+    def _measure(self, name, store):
+        """ Measure the code run in the context and append the
+        measurements to the given list.
+        The measurements may be nested (the files in a stage), the peak of
+        tracemalloc is then reset for the inner one and the peak of the
+        outer one is the highest of its own and of the inner one.
+        """
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1],
+                                      tracemalloc.get_traced_memory()[1])
+            self._peaks.append(0)
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            # The start time (since the start of the profiler) places the
+            # measurement in the run.
+            entry = {
+                'name': name,
+                'start_time': wall - self._start,
+                'wall_time': time.perf_counter() - wall,
+                'cpu_time': time.process_time() - cpu,
+                'peak_memory': None,
+                'max_rss': _get_max_rss(),
+            }
+            if tracing:
+                peak = self._peaks.pop()
+                if tracemalloc.is_tracing():
+                    peak = max(peak, tracemalloc.get_traced_memory()[1])
+                entry['peak_memory'] = peak
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+            store.append(entry)
+            LOG.debug('%s took %.3fs' % (name, entry['wall_time']))
+
+    def stage(self, name):
+        """ Context manager measuring one stage of the run.
+
+        :arg name: the name of the stage as it will appear in the report.
+
+        """
+        return self._measure(name, self.stages)
+
+    def file(self, filename):
+        """ Context manager measuring the processing of one input file
+        by a plugin.
+
+        :arg filename: the path to the file processed.
+
+        """
+        return self._measure(filename, self.files)
+
+    def set_count(self, name, value):
+        """ Record the size of some element of the dataset (rows, traits,
+        QTLs...).
+        """
+        self.counts[name] = value
+
+    def to_dict(self):
+        """ Return the report as a dictionary. """
+        return {
+            'version': __version__,
+            'stages': self.stages,
+            'files': self.files,
+            'counts': self.counts,
+            'total_wall_time': sum(
+                [stage['wall_time'] for stage in self.stages]),
+            'total_cpu_time': sum(
+                [stage['cpu_time'] for stage in self.stages]),
+        }
+
+    def write(self, outputfile):
+        """ Write the report as JSON in the specified file.
+
+        :arg outputfile: the path to the file in which to write the
+            report.
+
+        """
+        with open(outputfile, 'w') as stream:
+            json.dump(self.to_dict(), stream, indent=2, sort_keys=True)
+        LOG.info('Wrote profiling report in file %s' % outputfile)
+
+
+def profile_file(profiler, filename):
+    """ Return a context manager measuring the processing of the given
+    file if a profiler is provided, a context manager doing nothing
+    otherwise.
+    This is the helper plugins should use around each input file.
+
+    :arg profiler: a :class:`Profiler` or None.
+    :arg filename: the path to the file processed.
+
+    """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.file(filename)
@@ -25,27 +25,86 @@
 
 """
 MQ2, a QTL object that can be used by the plugin and is used by the
-    MapChart code.
+    MapChart code, and a QTLSet container storing QTLs column-wise.
 """
 
+import itertools
+from array import array
+
+from MQ2 import write_matrix
+
+
+def parse_position(value):
+    """ Return the given position or LOD value as a float together with
+    the number of decimals it was written with, so that it can be
+    written back exactly as it was read.
+    The number of decimals is None if the value was not a string or was
+    not written in decimal notation.
+
+    :arg value: the value to parse, a string or a number.
+
+    """
+    if not isinstance(value, str):
+        return float(value), None
+    value = value.strip()
+    decimals = None
+    if 'e' not in value.lower():
+        decimals = 0
+        if '.' in value:
+            decimals = len(value.split('.', 1)[1])
+    return float(value), decimals
+
+
+def format_position(value, decimals=None):
+    """ Return the string representation of a position or LOD value.
+
+    :arg value: the float to format.
+    :kwarg decimals: the number of decimals to write, if None the value
+        is written with at most 6 decimals and without trailing zeros.
+
+    """
+    if decimals is None or decimals < 0:
+        output = ('%f' % value).rstrip('0').rstrip('.')
+        return output or '0'
+    return '%.*f' % (decimals, value)
+
 
 class QTL(object):
     """ This object represents the QTL information extracted from the
     qtl matrix and needed for the MapChart output.
 
+    Positions and LOD are stored as floats, the number of decimals of
+    each position is kept in ``decimals`` to write them back unchanged.
+
     """
 
+    __slots__ = ('trait', 'linkage_group', 'start_mk', 'start_position',
+                 'peak_mk', 'peak_start_position', 'peak_stop_position',
+                 'stop_position', 'stop_mk', 'peak_lod', 'decimals')
+
     def __init__(self):
         """ Default constructor for the QTL object. """
         self.trait = ''
+        self.linkage_group = None
         self.start_mk = 'NA'
-        self.start_position = ''
+        self.start_position = 0.0
         self.peak_mk = None
-        self.peak_start_position = ''
-        self.peak_stop_position = ''
-        self.stop_position = ''
+        self.peak_start_position = 0.0
+        self.peak_stop_position = 0.0
+        self.stop_position = 0.0
         self.stop_mk = 'NA'
-        self.peak_lod = 0
+        self.peak_lod = 0.0
+        self.decimals = (None, None, None, None)
+
+    def set_positions(self, start, peak, stop):
+        """ Set the start, peak and stop positions of the QTL from the
+        values (strings or numbers) found in the QTL matrix.
+        """
+        self.start_position, start_dec = parse_position(start)
+        self.peak_start_position, peak_dec = parse_position(peak)
+        self.peak_stop_position = self.peak_start_position
+        self.stop_position, stop_dec = parse_position(stop)
+        self.decimals = (start_dec, peak_dec, peak_dec, stop_dec)
 
     def to_string(self):
         """ Return the string as it should be presented in a MapChart
@@ -53,16 +112,221 @@ class QTL(object):
 
         """
         return '%s   %s %s %s %s' % (
-            self.trait, self.start_position, self.peak_start_position,
-            self.peak_stop_position, self.stop_position)
+            self.trait,
+            format_position(self.start_position, self.decimals[0]),
+            format_position(self.peak_start_position, self.decimals[1]),
+            format_position(self.peak_stop_position, self.decimals[2]),
+            format_position(self.stop_position, self.decimals[3]))
 
     def get_flanking_markers(self):
         """ Return the list of the flanking marker correctly ordered. """
         return [self.start_mk, self.stop_mk]
 
+    @classmethod
+    def from_dict(cls, info):
+        """ Return the QTL saved with :meth:`to_dict`. """
+        qtl = cls()
+        for attr in cls.__slots__:
+            setattr(qtl, attr, info[attr])
+        qtl.decimals = tuple(qtl.decimals)
+        return qtl
+
+    def to_dict(self):
+        """ Return the QTL as a dictionary which can be saved as JSON. """
+        return dict([(attr, getattr(self, attr))
+                     for attr in self.__slots__])
+
     def __repr__(self):  # pragma: no cover
         """ String representation of the QTL object. """
         return 'QTL<trait: %s, start:%s, peak:%s - %s, stop:%s>' % (
             self.trait,
             self.start_position, self.peak_start_position,
             self.peak_stop_position, self.stop_position)
+
+
+def _group_key(linkage_group):
+    """ Key used to sort linkage groups, numerically when possible. """
+    try:
+        return (0, int(linkage_group), '')
+    except (TypeError, ValueError):
+        return (1, 0, '%s' % linkage_group)
+
+
+class QTLSet(object):
+    """ A list of QTLs stored column-wise: one list per textual attribute
+    and one array of floats per numerical attribute of :class:`QTL`.
+
+    Filtering, sorting and grouping work on whole columns and return new
+    QTLSet, :class:`QTL` objects are only created when iterating.
+
+    """
+
+    _text_columns = ('trait', 'linkage_group', 'start_mk', 'peak_mk',
+                     'stop_mk')
+    _float_columns = ('start_position', 'peak_position', 'stop_position',
+                      'peak_lod')
+
+    def __init__(self, qtls=None):
+        """ Constructor.
+
+        :kwarg qtls: an iterable of :class:`QTL` to store.
+
+        """
+        for column in self._text_columns:
+            setattr(self, column, [])
+        for column in self._float_columns:
+            setattr(self, column, array('d'))
+        # Number of decimals of the start, peak and stop positions,
+        # -1 when unknown.
+        self.decimals = array('b')
+        if qtls:
+            self.extend(qtls)
+
+    def __len__(self):
+        return len(self.trait)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        """ Return the QTL at the given index as a :class:`QTL`. """
+        qtl = QTL()
+        qtl.trait = self.trait[index]
+        qtl.linkage_group = self.linkage_group[index]
+        qtl.start_mk = self.start_mk[index]
+        qtl.peak_mk = self.peak_mk[index]
+        qtl.stop_mk = self.stop_mk[index]
+        qtl.start_position = self.start_position[index]
+        qtl.peak_start_position = self.peak_position[index]
+        qtl.peak_stop_position = self.peak_position[index]
+        qtl.stop_position = self.stop_position[index]
+        qtl.peak_lod = self.peak_lod[index]
+        decimals = [None if dec < 0 else dec
+                    for dec in self.decimals[index * 3:index * 3 + 3]]
+        qtl.decimals = (decimals[0], decimals[1], decimals[1], decimals[2])
+        return qtl
+
+    def append(self, qtl):
+        """ Add a :class:`QTL` at the end of the set. """
+        for column in self._text_columns:
+            getattr(self, column).append(getattr(qtl, column))
+        self.start_position.append(qtl.start_position)
+        self.peak_position.append(qtl.peak_start_position)
+        self.stop_position.append(qtl.stop_position)
+        self.peak_lod.append(qtl.peak_lod)
+        for index in (0, 1, 3):
+            dec = qtl.decimals[index]
+            self.decimals.append(-1 if dec is None else dec)
+
+    def extend(self, qtls):
+        """ Add all the given :class:`QTL` at the end of the set. """
+        for qtl in qtls:
+            self.append(qtl)
+
+    def take(self, indexes):
+        """ Return a new QTLSet containing the QTLs at the given indexes,
+        in this order.
+        """
+        output = QTLSet()
+        for column in self._text_columns:
+            values = getattr(self, column)
+            setattr(output, column, [values[index] for index in indexes])
+        for column in self._float_columns:
+            values = getattr(self, column)
+            setattr(output, column,
+                    array('d', [values[index] for index in indexes]))
+        decimals = self.decimals
+        output.decimals = array('b', itertools.chain.from_iterable(
+            [decimals[index * 3:index * 3 + 3] for index in indexes]))
+        return output
+
+    def filter(self, min_lod=None, linkage_group=None, trait=None):
+        """ Return a new QTLSet with only the QTLs matching all the given
+        criteria.
+
+        :kwarg min_lod: keep the QTLs whose peak LOD is at least this.
+        :kwarg linkage_group: keep the QTLs on this linkage group.
+        :kwarg trait: keep the QTLs of this trait.
+
+        """
+        mask = [True] * len(self)
+        if min_lod is not None:
+            min_lod = float(min_lod)
+            mask = [keep and lod >= min_lod
+                    for keep, lod in zip(mask, self.peak_lod)]
+        if linkage_group is not None:
+            linkage_group = '%s' % linkage_group
+            mask = [keep and lgroup == linkage_group
+                    for keep, lgroup in zip(mask, self.linkage_group)]
+        if trait is not None:
+            mask = [keep and name == trait
+                    for keep, name in zip(mask, self.trait)]
+        return self.take(
+            list(itertools.compress(range(len(self)), mask)))
+
+    def sort(self):
+        """ Return a new QTLSet with the QTLs sorted by linkage group and
+        peak position.
+        """
+        keys = [_group_key(lgroup) for lgroup in self.linkage_group]
+        indexes = sorted(
+            range(len(self)),
+            key=lambda index: (keys[index], self.peak_position[index]))
+        return self.take(indexes)
+
+    def group_by(self, column='linkage_group'):
+        """ Return a dictionary associating each value of the given
+        column (``trait`` or ``linkage_group``) to the QTLSet of the QTLs
+        having this value.
+        """
+        indexes = {}
+        for index, value in enumerate(getattr(self, column)):
+            indexes.setdefault(value, []).append(index)
+        return dict([(value, self.take(idx))
+                     for value, idx in indexes.items()])
+
+    def get_flanking_markers(self):
+        """ Return a dictionary associating the peak marker of each QTL
+        to its flanking markers.
+        """
+        return dict([(peak, [start, stop]) for peak, start, stop in zip(
+            self.peak_mk, self.start_mk, self.stop_mk)])
+
+    def _format_positions(self, column, offset):
+        """ Return the given position column formatted as strings. """
+        decimals = self.decimals
+        return [format_position(value, decimals[index * 3 + offset])
+                for index, value in enumerate(getattr(self, column))]
+
+    def to_map_chart(self):
+        """ Return the lines describing the QTLs in a MapChart input
+        file.
+        """
+        peaks = self._format_positions('peak_position', 1)
+        return ['%s   %s %s %s %s \n' % row for row in zip(
+            self.trait, self._format_positions('start_position', 0),
+            peaks, peaks, self._format_positions('stop_position', 2))]
+
+    def to_rows(self):
+        """ Return the QTLs as a list of rows, the first one being the
+        headers.
+        """
+        output = [['Trait', 'Linkage group', 'Start marker',
+                   'Start position', 'Peak marker', 'Peak position',
+                   'Stop position', 'Stop marker', 'LOD']]
+        output.extend([list(row) for row in zip(
+            self.trait, self.linkage_group, self.start_mk,
+            self._format_positions('start_position', 0), self.peak_mk,
+            self._format_positions('peak_position', 1),
+            self._format_positions('stop_position', 2), self.stop_mk,
+            [format_position(lod) for lod in self.peak_lod])])
+        return output
+
+    def to_csv(self, outputfile):
+        """ Write the QTLs in the given CSV file. """
+        write_matrix(outputfile, self.to_rows())
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the QTLSet object. """
+        return 'QTLSet<%s QTLs>' % len(self)
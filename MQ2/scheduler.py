@@ -0,0 +1,206 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 stage scheduler, runs the independent stages of a run concurrently.
+
+Each stage of a run declares, with :func:`uses`, the artifacts it reads
+and those it writes: the output files of the run (by their key in
+``context['files']``) and the entries of the context of the run. The
+stages are given in the order in which they would run one after the
+other, a stage then depends on the earlier stages writing an artifact it
+reads or writes and on those reading an artifact it writes. A stage
+which does not declare its artifacts depends on all the stages before it
+and all the stages after it depend on it.
+
+:func:`run_stages` starts each stage in a pool of threads as soon as the
+stages it depends on are finished, so that independent branches (such as
+the search of the QTLs of the MapChart file and the placement of the
+QTLs on the map) overlap, while the output is the same as when the
+stages are ran one after the other.
+"""
+
+import concurrent.futures
+import contextlib
+import logging
+import os
+
+
+LOG = logging.getLogger('MQ2')
+
+
+def uses(reads=(), writes=()):
+    """ Return a decorator declaring the artifacts the decorated stage
+    reads and writes, see the documentation of the module.
+
+    :kwarg reads: the names of the artifacts the stage reads.
+    :kwarg writes: the names of the artifacts the stage writes or
+        modifies.
+
+    """
+    def decorator(function):
+        function.reads = frozenset(reads)
+        function.writes = frozenset(writes)
+        return function
+    return decorator
+
+
+def get_stage_dependencies(stages):
+    """ Return, for each stage, the set of the index of the stages which
+    should be finished before it starts.
+
+    :arg stages: the list of the stages as ``(name, function)``, in the
+        order in which they would run one after the other.
+
+    """
+    dependencies = []
+    for cnt, (name, function) in enumerate(stages):
+        reads = getattr(function, 'reads', None)
+        writes = getattr(function, 'writes', None)
+        before = set()
+        for prevcnt, (prev_name, previous) in enumerate(stages[:cnt]):
+            prev_reads = getattr(previous, 'reads', None)
+            prev_writes = getattr(previous, 'writes', None)
+            if reads is None or prev_reads is None \
+                    or prev_writes & (reads | writes) \
+                    or prev_reads & writes:
+                before.add(prevcnt)
+        dependencies.append(before)
+    return dependencies
+
+
+def get_required_stages(stages, artifacts):
+    """ Return the stages which should run to produce the given artifacts,
+    in the order in which they are given.
+    Going back from the last stage, a stage is required if it writes an
+    artifact demanded, the artifacts it reads and writes are then
+    demanded from the stages before it. A stage which does not declare
+    its artifacts is always required and demands every artifact.
+
+    :arg stages: the list of the stages as ``(name, function)``, in the
+        order in which they would run one after the other.
+    :arg artifacts: the names of the artifacts wanted.
+
+    """
+    demanded = set(artifacts)
+    everything = False
+    required = []
+    for name, function in reversed(stages):
+        reads = getattr(function, 'reads', None)
+        writes = getattr(function, 'writes', None)
+        if reads is None:
+            everything = True
+        elif not everything and not writes & demanded:
+            LOG.debug('Skipped: %s' % name)
+            continue
+        else:
+            demanded.update(reads | writes)
+        required.append((name, function))
+    required.reverse()
+    return required
+
+
+def measure_stage(profiler, name):
+    """ Return a context manager measuring the given stage if profiling
+    was requested.
+    """
+    LOG.debug(name)
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+
+def _run_stage(stages, index, context, progress=None):
+    """ Run the stage of the given index, measured with the profiler of
+    the context, and return its output. The progress callback, if any, is
+    called when it starts and once it is done.
+    """
+    name, function = stages[index]
+    event = {'stage': name, 'index': index, 'total': len(stages),
+             'status': 'started'}
+    if progress is not None:
+        progress(event)
+    with measure_stage(context['profiler'], name):
+        output = function(context)
+    if progress is not None:
+        progress(dict(event, status='done'))
+    return output
+
+
+def run_stages(stages, context, threads=None, progress=None):
+    """ Run the given stages of a run, each stage receiving the context of
+    the run and returning a dictionary of new entries to add to it (or
+    None). The stages are measured with the profiler of the context.
+
+    :arg stages: the list of the stages as ``(name, function)``, in the
+        order in which they would run one after the other.
+    :arg context: the context of the run, see
+        :func:`~MQ2.mq2.get_run_context`.
+    :kwarg threads: the number of threads running the stages, defaults
+        to the number of CPUs. With a single thread the stages are ran
+        one after the other in the current thread. The stages are always
+        ran one after the other when profiling since the CPU time and the
+        peak memory measured are those of the whole process.
+    :kwarg progress: a callable called, in the thread running the stage,
+        with a dictionary describing each event of the run: ``stage`` (its
+        name), ``index`` and ``total`` (position of the stage in the run)
+        and ``status`` (``started`` or ``done``). An error raised by the
+        callback fails the stage.
+
+    If a stage fails, no other stage is started, the stages running are
+    waited for and the error is raised.
+
+    """
+    profiler = context['profiler']
+    threads = min(threads or os.cpu_count() or 1, len(stages))
+    if profiler is not None and threads > 1:
+        LOG.debug('Profiling, running the stages one after the other')
+        threads = 1
+    if threads <= 1:
+        for index in range(len(stages)):
+            context.update(
+                _run_stage(stages, index, context, progress) or {})
+        return
+
+    dependencies = get_stage_dependencies(stages)
+    done = set()
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        while len(done) < len(stages):
+            started = set(running.values())
+            for index in range(len(stages)):
+                if index not in done and index not in started \
+                        and dependencies[index] <= done:
+                    running[executor.submit(
+                        _run_stage, stages, index, context,
+                        progress)] = index
+            finished = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+            for future in finished:
+                index = running.pop(future)
+                # Raises the error of the stage, if any, the executor then
+                # waits for the stages running before leaving
+                context.update(future.result() or {})
+                done.add(index)
@@ -0,0 +1,551 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 service, a long-running local HTTP/JSON server running MQ² jobs on a
+    pool of warm worker processes.
+
+The service exposes the following end-points:
+
+- ``GET /status``: version of MQ² and number of jobs pending.
+- ``GET /sessions?path=<path>``: the plugin and the sessions available
+  in the given zip archive, folder or file.
+- ``POST /sessions``: same as above for the zip archive sent as body.
+- ``POST /jobs``: submit a job, either as a JSON object
+  ``{"zipfile"|"dir"|"file": <path>, "lod": <lod>, "session": <session>}``
+  or as a zip archive sent as body with ``lod`` and ``session`` given in
+  the query string.
+- ``GET /jobs/<id>[?wait=<seconds>]``: the status of the job, optionally
+  waiting for it to finish.
+- ``GET /jobs/<id>/results/<filename>``: stream one of the output files.
+- ``DELETE /jobs/<id>``: remove the job and its files.
+
+The finished jobs are kept until they are removed, for at most
+:data:`JOB_TTL` seconds and at most :data:`MAX_JOBS` of them, the oldest
+ones being removed, with their files, above this number.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from MQ2 import (__version__, MQ2Exception, MQ2QueueFullException,
+                 extract_zip)
+from MQ2.mq2 import (OUTPUT_FILES, load_plugins, get_plugin_and_folder,
+                     run_mq2)
+from MQ2.workspace import Workspace
+
+
+LOG = logging.getLogger('MQ2')
+
+# Size of the chunks in which the result files are sent back
+CHUNK_SIZE = 64 * 1024
+
+# Time, in seconds, during which a finished job and its files are kept
+JOB_TTL = 24 * 3600
+
+# Maximum number of finished jobs kept
+MAX_JOBS = 1000
+
+
+def _init_worker():
+    """ Import the plugins in the worker process as soon as it starts so
+    that jobs do not pay for it.
+    """
+    load_plugins()
+
+
+def _warm_up():
+    """ No-op task used to start the worker processes in advance. """
+    return os.getpid()
+
+
+def run_job(workspace_path, lod_threshold, session, inputzip=None,
+            inputdir=None, inputfile=None, max_memory=None):
+    """ Run a single MQ² job, this function is executed in a worker
+    process.
+
+    :arg workspace_path: the path to the workspace of the job, the input
+        archive is extracted in its ``input`` folder and the outputs are
+        written in its ``output`` folder.
+    :arg lod_threshold: the LOD threshold to use.
+    :arg session: the session to analyze, if any.
+    :kwarg inputzip: the path to the zip archive to analyze.
+    :kwarg inputdir: the path to the folder to analyze.
+    :kwarg inputfile: the path to the file to analyze.
+    :kwarg max_memory: the memory budget of the job, in MB, see
+        :func:`MQ2.mq2.run_mq2`.
+
+    """
+    plugin, folder = get_plugin_and_folder(
+        inputzip=inputzip, inputdir=inputdir, inputfile=inputfile,
+        extract_dir=os.path.join(workspace_path, 'input'))
+    run_mq2(plugin, folder, lod_threshold=lod_threshold, session=session,
+            outputfolder=os.path.join(workspace_path, 'output'),
+            cleanup=False, max_memory=max_memory)
+    return plugin.name
+
+
+class Job(object):
+    """ A MQ² job submitted to the service. """
+
+    def __init__(self, job_id, workspace, future):
+        """ Constructor.
+
+        :arg job_id: the unique identifier of the job.
+        :arg workspace: the :class:`~MQ2.workspace.Workspace` of the job.
+        :arg future: the future returned by the executor for this job.
+
+        """
+        self.job_id = job_id
+        self.workspace = workspace
+        self.future = future
+        # Time at which the job finished, None while it is not finished
+        self.finished = None
+        future.add_done_callback(self._set_finished)
+
+    def _set_finished(self, future):
+        """ Record the time at which the job finished. """
+        self.finished = time.time()
+
+    @property
+    def status(self):
+        """ Return the status of the job: queued, running, done or
+        failed.
+        """
+        if not self.future.done():
+            if self.future.running():
+                return 'running'
+            return 'queued'
+        if self.future.cancelled() or self.future.exception():
+            return 'failed'
+        return 'done'
+
+    def to_dict(self):
+        """ Return the information about the job as a dictionary. """
+        output = {
+            'id': self.job_id,
+            'status': self.status,
+            'plugin': None,
+            'error': None,
+            'results': [],
+        }
+        if output['status'] == 'done':
+            output['plugin'] = self.future.result()
+            output['results'] = sorted(
+                [filename for filename in OUTPUT_FILES.values()
+                 if os.path.exists(os.path.join(
+                     self.workspace.output_dir, filename))])
+        elif output['status'] == 'failed' and not self.future.cancelled():
+            output['error'] = '%s' % self.future.exception()
+        return output
+
+
+class MQ2Service(object):
+    """ Run MQ² jobs on a pool of worker processes started in advance
+    and keep track of them until they are removed.
+    """
+
+    def __init__(self, workers=None, max_queue=100, basedir=None,
+                 max_memory=None, job_ttl=JOB_TTL, max_jobs=MAX_JOBS):
+        """ Constructor, starts the worker processes.
+
+        :kwarg workers: the number of worker processes, defaults to the
+            number of CPUs.
+        :kwarg max_queue: the maximum number of jobs queued or running
+            at the same time.
+        :kwarg basedir: the folder in which the workspace of each job is
+            created, defaults to the system temporary folder.
+        :kwarg max_memory: the memory budget, in MB, shared by the jobs
+            running at the same time. Each job gets an equal share of it,
+            see :func:`MQ2.mq2.run_mq2`.
+        :kwarg job_ttl: the time, in seconds, during which a finished job
+            and its files are kept, None to keep them until removed.
+        :kwarg max_jobs: the maximum number of finished jobs kept, None
+            for no limit.
+
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.job_memory = None
+        if max_memory:
+            self.job_memory = float(max_memory) / self.workers
+        self.max_queue = max_queue
+        self.basedir = basedir
+        self.job_ttl = job_ttl
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self._sessions = {}
+        self._lock = threading.RLock()
+        load_plugins()
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker)
+        concurrent.futures.wait(
+            [self.executor.submit(_warm_up) for cnt in range(self.workers)])
+        LOG.info('MQ2 service started with %s workers' % self.workers)
+
+    def expire_jobs(self):
+        """ Remove, with their files, the finished jobs kept for longer
+        than the time to live of the jobs and, above the maximum number
+        of finished jobs kept, the oldest ones.
+        Returns the identifier of the jobs removed.
+        """
+        now = time.time()
+        with self._lock:
+            for job in self.jobs.values():
+                if job.finished is None and job.future.done():
+                    # Its callback did not run yet
+                    job.finished = now
+            finished = sorted(
+                [job for job in self.jobs.values()
+                 if job.finished is not None],
+                key=lambda job: job.finished)
+            expired = []
+            if self.job_ttl is not None:
+                expired = [job for job in finished
+                           if now - job.finished >= self.job_ttl]
+            if self.max_jobs is not None:
+                kept = finished[len(expired):]
+                expired.extend(kept[:max(len(kept) - self.max_jobs, 0)])
+            for job in expired:
+                del(self.jobs[job.job_id])
+        for job in expired:
+            LOG.info('Job %s expired' % job.job_id)
+            job.workspace.cleanup()
+        return [job.job_id for job in expired]
+
+    def pending(self):
+        """ Return the number of jobs queued or running. """
+        with self._lock:
+            return len([job for job in self.jobs.values()
+                        if not job.future.done()])
+
+    def submit(self, lod_threshold=3, session=None, inputzip=None,
+               inputdir=None, inputfile=None, upload=None):
+        """ Submit a new job to the service and return it.
+
+        :kwarg lod_threshold: the LOD threshold to use.
+        :kwarg session: the session to analyze, if any.
+        :kwarg inputzip: the path to the zip archive to analyze.
+        :kwarg inputdir: the path to the folder to analyze.
+        :kwarg inputfile: the path to the file to analyze.
+        :kwarg upload: the content of a zip archive to analyze.
+
+        """
+        self.expire_jobs()
+        with self._lock:
+            if self.pending() >= self.max_queue:
+                raise MQ2QueueFullException(
+                    'The queue is full, try again later.')
+            workspace = Workspace(basedir=self.basedir)
+            if upload is not None:
+                inputzip = os.path.join(workspace.path, 'upload.zip')
+                with open(inputzip, 'wb') as stream:
+                    stream.write(upload)
+            job_id = uuid.uuid4().hex
+            future = self.executor.submit(
+                run_job, workspace.path, lod_threshold, session,
+                inputzip=inputzip, inputdir=inputdir, inputfile=inputfile,
+                max_memory=self.job_memory)
+            job = Job(job_id, workspace, future)
+            self.jobs[job_id] = job
+        LOG.info('Job %s submitted' % job_id)
+        return job
+
+    def get_job(self, job_id):
+        """ Return the job corresponding to the given identifier or None.
+        """
+        self.expire_jobs()
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def delete_job(self, job_id):
+        """ Cancel if possible and remove the job and its files.
+        Returns whether the job existed.
+        """
+        with self._lock:
+            job = self.jobs.pop(job_id, None)
+        if job is None:
+            return False
+        job.future.cancel()
+        if job.future.done():
+            job.workspace.cleanup()
+        else:
+            job.future.add_done_callback(
+                lambda future: job.workspace.cleanup())
+        return True
+
+    def get_sessions(self, path=None, upload=None):
+        """ Return the name of the plugin able to process the given input
+        and the list of sessions it contains.
+        The results for a given path are kept as long as the file is not
+        modified.
+
+        :kwarg path: the path to a zip archive, a folder or a file.
+        :kwarg upload: the content of a zip archive.
+
+        """
+        key = None
+        if path is not None:
+            if not os.path.exists(path):
+                raise MQ2Exception('No such file or folder: %s' % path)
+            stat = os.stat(path)
+            key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+            with self._lock:
+                if key in self._sessions:
+                    return self._sessions[key]
+
+        with Workspace(basedir=self.basedir) as workspace:
+            if upload is not None:
+                path = os.path.join(workspace.path, 'upload.zip')
+                with open(path, 'wb') as stream:
+                    stream.write(upload)
+            kwargs = {}
+            if os.path.isdir(path):
+                kwargs['folder'] = path
+                plugin, folder = get_plugin_and_folder(inputdir=path)
+            elif _is_archive(path):
+                kwargs['folder'] = workspace.input_dir
+                extract_zip(path, workspace.input_dir)
+                plugin, folder = get_plugin_and_folder(
+                    inputdir=workspace.input_dir)
+            else:
+                kwargs['inputfile'] = path
+                plugin, folder = get_plugin_and_folder(inputfile=path)
+            sessions = plugin.get_session_identifiers(**kwargs) or []
+            output = (plugin.name, sessions)
+
+        if key is not None:
+            with self._lock:
+                self._sessions[key] = output
+        return output
+
+    def shutdown(self):
+        """ Stop the worker processes and remove the files of all the
+        jobs.
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            jobs = list(self.jobs.values())
+            self.jobs = {}
+        for job in jobs:
+            job.workspace.cleanup()
+        LOG.info('MQ2 service stopped')
+
+
+def _is_archive(path):
+    """ Return whether the given file is an archive MQ² can extract. """
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+class MQ2RequestHandler(BaseHTTPRequestHandler):
+    """ Handles the HTTP requests sent to the MQ² service, the service
+    itself is available as ``self.server.service``.
+    """
+
+    server_version = 'MQ2/%s' % __version__
+
+    def log_message(self, format, *args):  # pragma: no cover
+        LOG.info('%s - %s' % (self.address_string(), format % args))
+
+    def _send_json(self, data, code=200):
+        """ Send back the provided data as JSON. """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message):
+        """ Send back an error message as JSON. """
+        self._send_json({'error': message}, code=code)
+
+    def _read_body(self):
+        """ Return the body of the request. """
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def _route(self):
+        """ Return the parts of the path of the request and its query
+        arguments.
+        """
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = dict([(key, values[-1])
+                      for key, values in parse_qs(url.query).items()])
+        return parts, query
+
+    def _call(self, function, *args, **kwargs):
+        """ Call the provided function and send back the errors it raises.
+        """
+        try:
+            return True, function(*args, **kwargs)
+        except MQ2QueueFullException as err:
+            self._send_error(503, '%s' % err)
+        except MQ2Exception as err:
+            self._send_error(400, '%s' % err)
+        return False, None
+
+    def do_GET(self):
+        """ Handle the GET requests. """
+        service = self.server.service
+        parts, query = self._route()
+        if parts == ['status']:
+            self._send_json({'version': __version__,
+                             'workers': service.workers,
+                             'pending': service.pending(),
+                             'max_queue': service.max_queue})
+        elif parts == ['sessions']:
+            if 'path' not in query:
+                return self._send_error(400, 'No path provided')
+            success, output = self._call(
+                service.get_sessions, path=query['path'])
+            if success:
+                self._send_json(
+                    {'plugin': output[0], 'sessions': output[1]})
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = service.get_job(parts[1])
+            if job is None:
+                return self._send_error(404, 'No such job')
+            if 'wait' in query:
+                try:
+                    concurrent.futures.wait(
+                        [job.future], timeout=float(query['wait']))
+                except ValueError:
+                    return self._send_error(400, 'Invalid wait value')
+            self._send_json(job.to_dict())
+        elif len(parts) == 4 and parts[0] == 'jobs' \
+                and parts[2] == 'results':
+            self._send_result(service.get_job(parts[1]), parts[3])
+        else:
+            self._send_error(404, 'Not found')
+
+    def _send_result(self, job, filename):
+        """ Stream back one of the output files of the job. """
+        if job is None:
+            return self._send_error(404, 'No such job')
+        if job.status != 'done':
+            return self._send_error(409, 'Job not finished')
+        if filename not in OUTPUT_FILES.values():
+            return self._send_error(404, 'No such result')
+        path = os.path.join(job.workspace.output_dir, filename)
+        if not os.path.exists(path):  # pragma: no cover
+            return self._send_error(404, 'No such result')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as stream:
+            shutil.copyfileobj(stream, self.wfile, CHUNK_SIZE)
+
+    def do_POST(self):
+        """ Handle the POST requests. """
+        service = self.server.service
+        parts, query = self._route()
+        content_type = self.headers.get('Content-Type', '')
+        if parts == ['sessions']:
+            success, output = self._call(
+                service.get_sessions, upload=self._read_body())
+            if success:
+                self._send_json(
+                    {'plugin': output[0], 'sessions': output[1]})
+        elif parts == ['jobs']:
+            kwargs = {}
+            if content_type.startswith('application/json'):
+                try:
+                    data = json.loads(self._read_body().decode('utf-8'))
+                except ValueError:
+                    return self._send_error(400, 'Invalid JSON')
+                kwargs['inputzip'] = data.get('zipfile')
+                kwargs['inputdir'] = data.get('dir')
+                kwargs['inputfile'] = data.get('file')
+            else:
+                data = query
+                kwargs['upload'] = self._read_body()
+            kwargs['lod_threshold'] = data.get('lod', 3)
+            kwargs['session'] = data.get('session')
+            success, job = self._call(service.submit, **kwargs)
+            if success:
+                self._send_json(job.to_dict(), code=202)
+        else:
+            self._send_error(404, 'Not found')
+
+    def do_DELETE(self):
+        """ Handle the DELETE requests. """
+        parts, query = self._route()
+        if len(parts) == 2 and parts[0] == 'jobs' \
+                and self.server.service.delete_job(parts[1]):
+            self._send_json({'id': parts[1], 'status': 'deleted'})
+        else:
+            self._send_error(404, 'No such job')
+
+
+def make_server(service, host='localhost', port=0):
+    """ Return the HTTP server serving the given service, use port 0 to
+    let the system pick a free port (available as
+    ``server.server_address[1]``).
+    """
+    server = ThreadingHTTPServer((host, port), MQ2RequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(host='localhost', port=8080, workers=None, max_queue=100,
+          max_memory=None, job_ttl=JOB_TTL, max_jobs=MAX_JOBS):
+    """ Start the MQ² service and serve requests until interrupted.
+
+    :kwarg host: the interface on which to listen.
+    :kwarg port: the port on which to listen.
+    :kwarg workers: the number of worker processes.
+    :kwarg max_queue: the maximum number of jobs queued or running.
+    :kwarg max_memory: the memory budget, in MB, shared by the workers.
+    :kwarg job_ttl: the time, in seconds, during which a finished job is
+        kept.
+    :kwarg max_jobs: the maximum number of finished jobs kept.
+
+    """
+    service = MQ2Service(workers=workers, max_queue=max_queue,
+                         max_memory=max_memory, job_ttl=job_ttl,
+                         max_jobs=max_jobs)
+    server = make_server(service, host=host, port=port)
+    LOG.info('Serving on http://%s:%s/' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:  # pragma: no cover
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
@@ -0,0 +1,314 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 shared LOD matrix, places the LOD values of a QTL matrix and its
+    genetic map in shared memory so that worker processes can read them
+    without copying them.
+
+The matrix is kept in a single :mod:`multiprocessing.shared_memory`
+block:
+
+- the length of the description of the matrix, as a 64 bits integer;
+- the description, as JSON: the :class:`~MQ2.catalog.Catalog` of the
+  markers and linkage groups, the position of each row, the traits, the
+  headers and the :class:`~MQ2.zonemap.ZoneMap` of the matrix;
+- the code of the marker and of the linkage group of each row, as 64 bits
+  integers;
+- the LOD values, as 64 bits floats, trait after trait as in a
+  :class:`~MQ2.lodstore.LODStore`.
+
+The process creating the matrix owns it: the block is removed when it
+closes the matrix, including when leaving its context on an error. The
+workers attach to the block by its name and read the values in place, a
+:class:`SharedLODs` offering the same reading interface as a
+:class:`~MQ2.lodstore.LODStore`.
+"""
+
+import array
+import json
+import logging
+import struct
+
+from multiprocessing import shared_memory
+
+from MQ2 import MQ2Exception
+from MQ2.catalog import Catalog
+from MQ2.lodstore import BLOCK_MEMORY, ITEM_SIZE, get_block_size
+from MQ2.zonemap import ZoneMap
+
+
+LOG = logging.getLogger('MQ2')
+
+# Format of the length of the description at the start of the block
+_HEADER = struct.Struct('q')
+
+
+def _align(size):
+    """ Return the given size rounded up to a multiple of the size of the
+    values.
+    """
+    return -(-size // ITEM_SIZE) * ITEM_SIZE
+
+
+def _close_block(block, unlink=False):
+    """ Detach from the given shared memory block and, if asked, remove
+    it.
+    """
+    try:
+        block.close()
+    except BufferError:
+        # Views on the block are still referenced, the memory is unmapped
+        # once they are garbage collected.
+        LOG.debug('Views on the shared LOD matrix %s still in use'
+                  % block.name)
+    if unlink:
+        block.unlink()
+
+
+def get_shared_size(nr_positions, nr_traits):
+    """ Return, in bytes, the memory used by the codes of the markers and
+    linkage groups and by the LOD values of a shared matrix of the given
+    dimensions, its description not included.
+    """
+    return nr_positions * ITEM_SIZE * (2 + nr_traits)
+
+
+class SharedLODs(object):
+    """ A QTL matrix in shared memory, see the documentation of the
+    module.
+
+    Use :meth:`create` or :meth:`from_source` to create a new matrix and
+    :meth:`attach` to read, from another process, a matrix created by
+    its :attr:`name`. Shared matrices can be used as context managers,
+    the matrix is closed when leaving the context.
+
+    :attr name: the name of the shared memory block.
+    :attr catalog: the :class:`~MQ2.catalog.Catalog` of the markers and
+        linkage groups of the matrix.
+    :attr markers: the list of ``marker, linkage group, position`` of
+        each position (row) of the matrix.
+    :attr traits: the list of the traits (columns) of the matrix.
+    :attr headers: the headers of the marker columns of the matrix.
+    :attr zones: the :class:`~MQ2.zonemap.ZoneMap` of the matrix, if
+        known when it was created.
+    :attr block_memory: the memory, in bytes, used by a block of traits
+        returned by :meth:`iter_blocks`.
+
+    """
+
+    def __init__(self, block, owner=False):
+        """ Constructor, use :meth:`create` or :meth:`attach` instead. """
+        self._block = block
+        self.owner = owner
+        self.name = block.name
+        self.block_memory = BLOCK_MEMORY
+        size = _HEADER.unpack_from(block.buf, 0)[0]
+        info = json.loads(
+            bytes(block.buf[_HEADER.size:_HEADER.size + size]).decode(
+                'utf-8'))
+        self.catalog = Catalog.from_dict(info['catalog'])
+        self.traits = info['traits']
+        self.headers = info['headers']
+        self.zones = None
+        if info['zones']:
+            self.zones = ZoneMap.from_dict(info['zones'])
+        self.nr_positions = len(info['positions'])
+
+        offset = _align(_HEADER.size + size)
+        length = self.nr_positions * ITEM_SIZE
+        with block.buf[offset:offset + length].cast('q') as codes, \
+                block.buf[offset + length:offset + 2 * length].cast(
+                    'q') as groups:
+            self.markers = [
+                [self.catalog.markers[code], self.catalog.groups[group],
+                 position]
+                for code, group, position in zip(
+                    codes, groups, info['positions'])]
+        offset += 2 * length
+        self._values = block.buf[
+            offset:offset + length * len(self.traits)].cast('d')
+
+    @classmethod
+    def create(cls, markers, traits, headers=('Locus', 'Group', 'Position'),
+               zones=None, catalog=None):
+        """ Create a new matrix in shared memory, of the size required by
+        the given markers and traits, its LOD values being 0.
+
+        :arg markers: the list of ``marker, linkage group, position`` of
+            each position of the matrix.
+        :arg traits: the list of the traits of the matrix.
+        :kwarg headers: the headers of the marker columns.
+        :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the matrix.
+        :kwarg catalog: the :class:`~MQ2.catalog.Catalog` in which to
+            encode the markers and linkage groups, a new one is used if
+            not specified.
+
+        """
+        catalog = catalog or Catalog()
+        codes, groups, positions = catalog.encode_map(markers)
+        info = json.dumps({
+            'catalog': catalog.to_dict(),
+            'positions': [row[2] for row in markers],
+            'traits': list(traits),
+            'headers': list(headers),
+            'zones': zones.to_dict() if zones is not None else None,
+        }).encode('utf-8')
+        offset = _align(_HEADER.size + len(info))
+        length = len(markers) * ITEM_SIZE
+        size = offset + get_shared_size(len(markers), len(traits))
+
+        block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            LOG.debug('Creating a shared LOD matrix of %s positions x %s '
+                      'traits in %s' % (len(markers), len(traits),
+                                        block.name))
+            _HEADER.pack_into(block.buf, 0, len(info))
+            block.buf[_HEADER.size:_HEADER.size + len(info)] = info
+            for array_cnt, values in enumerate([codes, groups]):
+                start = offset + array_cnt * length
+                with block.buf[start:start + length].cast('q') as view:
+                    view[:] = array.array('q', values)
+            return cls(block, owner=True)
+        except Exception:
+            _close_block(block, unlink=True)
+            raise
+
+    @classmethod
+    def from_source(cls, source, zones=None, catalog=None):
+        """ Return a new shared matrix containing the LOD values of a
+        :class:`~MQ2.lodstore.LODStore`, or any object offering the same
+        reading interface (such as a :class:`~MQ2.chunked.MatrixFile`),
+        copied one block of traits at a time.
+
+        :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the source,
+            defaults to the one of the source. If neither is known, it is
+            computed from the source.
+        :kwarg catalog: the :class:`~MQ2.catalog.Catalog` in which to
+            encode the markers and linkage groups.
+
+        """
+        zones = zones or getattr(source, 'zones', None)
+        if zones is None:
+            zones = ZoneMap.from_source(source)
+        shared = cls.create(source.markers, source.traits,
+                            headers=source.headers, zones=zones,
+                            catalog=catalog)
+        try:
+            for offset, traits, profiles in source.iter_blocks():
+                for cnt, lods in enumerate(profiles):
+                    shared.set_trait(offset + cnt, lods)
+        except Exception:
+            shared.close()
+            raise
+        return shared
+
+    @classmethod
+    def attach(cls, name):
+        """ Attach, from another process, to the matrix in the shared
+        memory block of the given name.
+        """
+        try:
+            block = shared_memory.SharedMemory(name=name)
+        except (OSError, ValueError) as err:
+            raise MQ2Exception('Could not attach to the shared LOD matrix '
+                               '%s: %s' % (name, err))
+        try:
+            return cls(block)
+        except Exception:
+            _close_block(block)
+            raise
+
+    def _get_offset(self, trait, position=0):
+        """ Return the index in the values of the given position of the
+        given trait.
+        """
+        return trait * self.nr_positions + position
+
+    def set_trait(self, trait, values):
+        """ Write the LOD values of a trait, as floats (NaN being a missing
+        value), at each position.
+        """
+        offset = self._get_offset(trait)
+        self._values[offset:offset + self.nr_positions] = array.array(
+            'd', values)
+
+    def get_trait(self, trait, start=0, stop=None):
+        """ Return the LOD values of a trait, as a read-only view on the
+        shared memory valid until the matrix is closed.
+
+        :arg trait: the index of the trait.
+        :kwarg start: the index of the first position to return.
+        :kwarg stop: the index of the position after the last one to
+            return, defaults to the number of positions.
+
+        """
+        if stop is None:
+            stop = self.nr_positions
+        return self._values[self._get_offset(trait, start):
+                            self._get_offset(trait, stop)].toreadonly()
+
+    def get_block_size(self, memory=None):
+        """ Return the number of traits of a block using at most the given
+        memory, in bytes (by default :attr:`block_memory`).
+        """
+        return get_block_size(self.nr_positions,
+                              memory or self.block_memory)
+
+    def iter_blocks(self, block_size=None):
+        """ Iterate over the blocks of traits of the matrix, yielding for
+        each block the index of its first trait, the name of its traits
+        and their LOD values, see :meth:`get_trait`.
+
+        :kwarg block_size: the number of traits per block, defaults to
+            the number of traits fitting in :attr:`block_memory`.
+
+        """
+        block_size = block_size or self.get_block_size()
+        for start in range(0, len(self.traits), block_size):
+            stop = min(start + block_size, len(self.traits))
+            yield (start, self.traits[start:stop],
+                   [self.get_trait(trait) for trait in range(start, stop)])
+
+    def close(self):
+        """ Detach from the shared memory block and, if this process owns
+        the matrix, remove the block.
+        """
+        if self._block is None:
+            return
+        self._values.release()
+        _close_block(self._block, unlink=self.owner)
+        self._block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the SharedLODs object. """
+        return 'SharedLODs<%s: %s positions x %s traits>' % (
+            self.name, self.nr_positions, len(self.traits))
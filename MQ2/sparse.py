@@ -0,0 +1,253 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 sparse LOD matrix, keeps only the LOD values above a floor so that
+    the memory and the time used by the stages are proportional to the
+    signal and not to the size of the QTL matrix.
+
+The values are kept by trait (as a compressed sparse row matrix whose
+rows are the traits): for each trait the sorted indexes of the positions
+whose LOD is at least the floor and their LOD values. Missing values are
+kept as NaN so that they are handled as in the dense matrix.
+
+A QTL is only called on a LOD above the LOD threshold and its interval
+only extends over the LOD values at most
+:data:`MQ2.mapchart.INTERVAL_THRESHOLD` below its peak. With a floor of
+at most ``lod_threshold - INTERVAL_THRESHOLD`` (see
+:func:`get_default_floor`), the values which are not kept never change
+the QTLs, their intervals nor the counts, and the output is the same as
+with the dense matrix.
+"""
+
+import array
+import bisect
+import logging
+import math
+
+from MQ2 import MQ2Exception
+from MQ2.zonemap import get_groups
+
+
+LOG = logging.getLogger('MQ2')
+
+NAN = float('nan')
+
+
+def get_default_floor(lod_threshold, interval_threshold):
+    """ Return the highest floor giving the same output as the dense
+    matrix for the given LOD threshold and LOD drop of the QTL intervals.
+    """
+    return float(lod_threshold) - float(interval_threshold)
+
+
+def _to_float(value):
+    """ Return the given LOD value as a float, NaN if it is missing. """
+    if value is None:
+        return NAN
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return NAN
+    return float(value)
+
+
+class SparseLODs(object):
+    """ The LOD values of a QTL matrix above a floor, see the documentation
+    of the module.
+
+    The matrix is filled either row by row (see :meth:`set_traits` and
+    :meth:`add_row`) or trait by trait (see :meth:`set_markers` and
+    :meth:`add_trait`).
+
+    :attr floor: the lowest LOD value kept.
+    :attr markers: the list of ``marker, linkage group, position`` of
+        each position (row) of the matrix.
+    :attr traits: the list of the traits of the matrix.
+    :attr indexes: for each trait, the array of the indexes of the
+        positions kept, in increasing order.
+    :attr values: for each trait, the array of the LOD values kept.
+
+    """
+
+    def __init__(self, floor):
+        """ Constructor.
+
+        :arg floor: the lowest LOD value kept.
+
+        """
+        self.floor = float(floor)
+        self.markers = []
+        self.traits = []
+        self.headers = ['Locus', 'Group', 'Position']
+        self.indexes = []
+        self.values = []
+
+    @property
+    def nr_positions(self):
+        """ The number of positions (rows) of the matrix. """
+        return len(self.markers)
+
+    @property
+    def nr_values(self):
+        """ The number of LOD values kept. """
+        return sum([len(values) for values in self.values])
+
+    def _keep(self, value):
+        """ Return whether the given LOD value is kept. """
+        return value >= self.floor or math.isnan(value)
+
+    def set_traits(self, traits, headers=None):
+        """ Set the traits of a matrix filled row by row.
+
+        :arg traits: the names of the traits.
+        :kwarg headers: the headers of the marker columns.
+
+        """
+        self.traits = list(traits)
+        if headers:
+            self.headers = list(headers)
+        self.indexes = [array.array('l') for trait in self.traits]
+        self.values = [array.array('d') for trait in self.traits]
+
+    def add_row(self, marker, values):
+        """ Add a position to a matrix filled row by row.
+
+        :arg marker: the ``marker, linkage group, position`` of the row.
+        :arg values: the LOD value of each trait, as numbers or strings,
+            an empty string or None being a missing value.
+
+        """
+        position = len(self.markers)
+        self.markers.append(list(marker))
+        for cnt, value in enumerate(values):
+            value = _to_float(value)
+            if self._keep(value):
+                self.indexes[cnt].append(position)
+                self.values[cnt].append(value)
+
+    def set_markers(self, markers, headers=None):
+        """ Set the positions of a matrix filled trait by trait.
+
+        :arg markers: the list of ``marker, linkage group, position`` of
+            each position.
+        :kwarg headers: the headers of the marker columns.
+
+        """
+        self.markers = [list(marker) for marker in markers]
+        if headers:
+            self.headers = list(headers)
+
+    def add_trait(self, trait, values):
+        """ Add a trait to a matrix filled trait by trait.
+
+        :arg trait: the name of the trait.
+        :arg values: the LOD value at each position.
+
+        """
+        if len(values) != self.nr_positions:
+            raise MQ2Exception('The trait %s has %s LOD values for %s '
+                               'positions' % (trait, len(values),
+                                              self.nr_positions))
+        indexes = array.array('l')
+        kept = array.array('d')
+        for cnt, value in enumerate(values):
+            value = _to_float(value)
+            if self._keep(value):
+                indexes.append(cnt)
+                kept.append(value)
+        self.traits.append(trait)
+        self.indexes.append(indexes)
+        self.values.append(kept)
+
+    @classmethod
+    def from_matrix_file(cls, matrix_file, floor, count_column=False):
+        """ Return the sparse matrix of a QTL matrix file, as written by
+        the plugins, reading it one row at a time.
+
+        :arg matrix_file: the path to the QTL matrix file.
+        :arg floor: the lowest LOD value kept.
+        :kwarg count_column: whether the last column of the file is the
+            number of QTLs of each row and not a trait.
+
+        """
+        sparse = cls(floor)
+        with open(matrix_file) as stream:
+            headers = [cel.strip() for cel in
+                       stream.readline().strip().split(',')]
+            traits = headers[3:-1] if count_column else headers[3:]
+            sparse.set_traits(traits, headers=headers[:3])
+            for row in stream:
+                row = [cel.strip() for cel in row.strip().split(',')]
+                values = row[3:3 + len(traits)]
+                values.extend([''] * (len(traits) - len(values)))
+                sparse.add_row(row[:3], values)
+        return sparse
+
+    def iter_traits(self):
+        """ Iterate over the traits, yielding for each trait its name, the
+        indexes of the positions kept and their LOD values.
+        """
+        for trait, indexes, values in zip(
+                self.traits, self.indexes, self.values):
+            yield trait, indexes, values
+
+    def get_groups(self):
+        """ Return the list of the consecutive rows of the same linkage
+        group, as ``[linkage group, first row, row after the last]``.
+        """
+        return get_groups(self.markers)
+
+    def count_qtls(self, lod_threshold, zones=None):
+        """ Return, for each position, the number of LOD values above the
+        threshold, as :func:`MQ2.mq2.count_store_qtls`.
+
+        :kwarg zones: the :class:`~MQ2.zonemap.ZoneMap` of the matrix, if
+            specified only the zones above the threshold are counted.
+
+        """
+        lod_threshold = float(lod_threshold)
+        counts = [0] * self.nr_positions
+        for trait, (indexes, values) in enumerate(
+                zip(self.indexes, self.values)):
+            if zones is None:
+                ranges = [(0, len(indexes))]
+            else:
+                ranges = [
+                    (bisect.bisect_left(indexes, zones.groups[groupcnt][1]),
+                     bisect.bisect_left(indexes, zones.groups[groupcnt][2]))
+                    for groupcnt in zones.get_significant_groups(
+                        trait, lod_threshold, strict=True)]
+            for start, stop in ranges:
+                for cnt in range(start, stop):
+                    # NaN, ie: missing values, are never above threshold
+                    if values[cnt] > lod_threshold:
+                        counts[indexes[cnt]] += 1
+        return counts
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the SparseLODs object. """
+        return 'SparseLODs<%s positions x %s traits, %s values>' % (
+            self.nr_positions, len(self.traits), self.nr_values)
@@ -0,0 +1,157 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 streaming conversion, processes the traits of the plugins supporting
+    it as soon as they are parsed.
+
+The plugins setting ``streaming`` (see
+:class:`~MQ2.plugin_interface.PluginInterface`) give the positions of the
+QTL matrix and the genetic map once, with ``get_map``, and then parse
+their input one trait at a time with ``iter_traits``, reporting the LOD
+values of the trait and the QTLs found for it.
+:func:`convert_streaming` writes the QTLs of each trait as soon as it is
+parsed and, in the same pass over its LOD values, adds the trait to the
+:class:`~MQ2.zonemap.ZoneMap` of the run and counts the LOD values above
+the threshold on each row. The count of the QTLs on the matrix then only
+has to append these counts to the QTL matrix file instead of reading it
+again.
+
+The LOD values of each trait are not kept in memory but written, as soon
+as the trait is parsed, in a temporary data file laid out as a
+:class:`~MQ2.lodstore.LODStore`, from which the QTL matrix file is then
+written a chunk of rows at a time.
+
+The input of the other plugins is converted at once by their
+``convert_inputfiles`` method, as before, see :func:`is_streaming`.
+"""
+
+import logging
+import os
+
+from MQ2 import MQ2Exception, MQ2NoMatrixException, write_matrix
+from MQ2.lodstore import ITEM_SIZE, LODStore, to_values
+from MQ2.zonemap import ZoneMap
+
+
+LOG = logging.getLogger('MQ2')
+
+
+def _format_row(row):
+    """ Return the given row as a line of a CSV file, as written by
+    :func:`MQ2.write_matrix`.
+    """
+    return ','.join([str(cel).strip() for cel in row]) + '\n'
+
+
+def is_streaming(plugin):
+    """ Return whether the given plugin parses its input one trait at a
+    time, plugins not declaring it are converted at once by their
+    ``convert_inputfiles`` method.
+    """
+    return bool(getattr(plugin, 'streaming', False))
+
+
+def convert_streaming(plugin, folder=None, inputfile=None, session=None,
+                      lod_threshold=None, qtls_file='qtls.csv',
+                      matrix_file='qtls_matrix.csv', map_file='map.csv',
+                      profiler=None, sparse=None):
+    """ Convert the input of a streaming plugin in the QTL, QTL matrix and
+    map files, see the documentation of the module.
+    Returns the number of LOD values above the threshold on each row of
+    the QTL matrix and the :class:`~MQ2.zonemap.ZoneMap` of the matrix.
+
+    :arg plugin: the plugin to use, see :func:`is_streaming`.
+    :kwarg folder: the path to the folder containing the input files.
+    :kwarg inputfile: the path to the input file to use.
+    :kwarg session: the session identifier to process.
+    :kwarg lod_threshold: the LOD threshold to apply to determine if a
+        QTL is significant or not.
+    :kwarg qtls_file: the file in which to write the significant QTLs.
+    :kwarg matrix_file: the file in which to write the QTL matrix.
+    :kwarg map_file: the file in which to write the genetic map.
+    :kwarg profiler: a :class:`~MQ2.profiling.Profiler` used to record
+        the time spent on each input file, or None.
+    :kwarg sparse: a :class:`~MQ2.sparse.SparseLODs` to fill with the LOD
+        values of each trait above its floor.
+
+    """
+    try:
+        threshold = float(lod_threshold)
+    except (TypeError, ValueError):
+        raise MQ2Exception('LOD threshold should be a number')
+
+    positions, map_matrix, headers = plugin.get_map(
+        folder=folder, inputfile=inputfile, session=session)
+    write_matrix(map_file, map_matrix)
+    # The markers as they are read back from the QTL matrix file
+    markers = [[str(cel).strip() for cel in row] for row in positions[1:]]
+    zones = ZoneMap.from_markers(markers)
+    counts = [0] * len(markers)
+    if sparse is not None:
+        sparse.set_markers(markers, headers=positions[0])
+
+    traits = []
+    decimals = []
+    data_file = '%s.%s.lods' % (matrix_file, os.getpid())
+    try:
+        with open(qtls_file, 'w') as stream, open(data_file, 'wb') as data:
+            stream.write(_format_row(headers))
+            for trait, lods, qtls in plugin.iter_traits(
+                    folder=folder, inputfile=inputfile, session=session,
+                    lod_threshold=lod_threshold, profiler=profiler):
+                if len(lods) != len(markers):
+                    raise MQ2NoMatrixException(
+                        'The trait %s has %s LOD values for the %s '
+                        'positions of the map'
+                        % (trait, len(lods), len(markers)))
+                for qtl in qtls:
+                    stream.write(_format_row(qtl))
+                values, trait_decimals = to_values(lods)
+                values.tofile(data)
+                zones.add_trait(values)
+                for groupcnt in zones.get_significant_groups(
+                        len(traits), threshold, strict=True):
+                    linkgrp, start, stop = zones.groups[groupcnt]
+                    for cnt in range(start, stop):
+                        # NaN, ie: missing values, are never above
+                        # threshold
+                        if values[cnt] > threshold:
+                            counts[cnt] += 1
+                if sparse is not None:
+                    sparse.add_trait(trait, values)
+                traits.append(trait)
+                decimals.append(trait_decimals)
+            # An empty data file cannot be mapped
+            data.truncate(max(data.tell(), ITEM_SIZE))
+        LOG.info('Wrote QTLs in file %s' % qtls_file)
+
+        with LODStore.from_data_file(data_file, markers, traits, decimals,
+                                     headers=positions[0]) as store:
+            store.write_matrix_file(matrix_file)
+    finally:
+        if os.path.exists(data_file):
+            os.unlink(data_file)
+    return counts, zones
@@ -0,0 +1,211 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 windowed QTL histograms, counts the QTLs found in sliding windows of
+    the linkage groups at several resolutions.
+
+A resolution is a window size and a step, both in cM: the windows of a
+linkage group start at every multiple of the step from its first marker to
+its last one. The positions of the QTLs of each linkage group are sorted
+once, the number of QTLs in a window is then the difference of the number
+of QTLs before its end and before its start, found by bisection (or
+vectorized with numpy when it is installed). All the resolutions are thus
+computed from the same sorted positions.
+"""
+
+import bisect
+import logging
+import math
+import os
+
+try:  # pragma: no cover
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from MQ2 import MQ2Exception, read_input_file, write_matrix
+
+
+LOG = logging.getLogger('MQ2')
+
+# Headers of the windows files
+WINDOW_HEADERS = ['Linkage Group', 'Window start', 'Window end', '# QTLs']
+
+
+def parse_resolutions(resolutions):
+    """ Return the list of ``(size, step)`` resolutions described by the
+    given string: comma separated window sizes, in cM, each optionally
+    followed by ``:`` and its step (by default the step is the size, the
+    windows do not overlap). For example ``1,5:1,10:2``.
+    """
+    output = []
+    for resolution in resolutions.split(','):
+        resolution = resolution.strip()
+        if not resolution:
+            continue
+        size, step = (resolution.split(':', 1) + [None])[:2]
+        try:
+            size = float(size)
+            step = float(step) if step else size
+        except ValueError:
+            raise MQ2Exception('Invalid window resolution: "%s"'
+                               % resolution)
+        if size <= 0 or step <= 0:
+            raise MQ2Exception('The window size and step should be '
+                               'positive: "%s"' % resolution)
+        output.append((size, step))
+    return output
+
+
+def get_windows_filename(size, step):
+    """ Return the name of the file of the windows of the given resolution.
+    """
+    if size == step:
+        return 'qtl_windows_%gcM.csv' % size
+    return 'qtl_windows_%gcM_step_%gcM.csv' % (size, step)
+
+
+def _count_before(positions, bounds, right=False):
+    """ Return, for each bound, the number of sorted positions before it,
+    or up to it if ``right`` is true.
+    """
+    if numpy is not None:
+        side = 'right' if right else 'left'
+        return numpy.searchsorted(
+            numpy.array(positions, dtype=float), numpy.array(bounds),
+            side=side).tolist()
+    function = bisect.bisect_right if right else bisect.bisect_left
+    return [function(positions, bound) for bound in bounds]
+
+
+def _get_group_windows(first, last, size, step):
+    """ Return the ``(start, end)`` windows of a linkage group going from
+    ``first`` to ``last`` cM.
+    """
+    start = math.floor(first / step) * step
+    nr_windows = int(math.floor((last - start) / step)) + 1
+    return [(start + cnt * step, start + cnt * step + size)
+            for cnt in range(nr_windows)]
+
+
+def get_window_counts(qtl_list, genetic_map, resolutions, intervals=False):
+    """ Return, for each resolution, the table of the number of QTLs found
+    in each window, the first row being the headers (see
+    :data:`WINDOW_HEADERS`). A window includes its start and excludes its
+    end.
+
+    :arg qtl_list: the list of QTLs, the first row being the headers, the
+        second and third columns the linkage group and the position of
+        each QTL and, if ``intervals`` is true, the last two columns the
+        markers at the start and end of its LOD2 interval.
+    :arg genetic_map: the genetic map, the first row being the headers.
+    :arg resolutions: the list of ``(size, step)`` of the windows, see
+        :func:`parse_resolutions`.
+    :kwarg intervals: whether to count the QTLs whose LOD2 interval
+        overlaps the window instead of those whose peak is in it. The QTLs
+        without interval are counted on their peak.
+
+    """
+    extents = {}
+    positions = {}
+    groups = []
+    for row in genetic_map[1:]:
+        try:
+            position = float(row[2])
+        except (IndexError, ValueError):
+            continue
+        positions.setdefault((row[0], row[1]), position)
+        if row[1] not in extents:
+            groups.append(row[1])
+            extents[row[1]] = [position, position]
+        extents[row[1]] = [min(extents[row[1]][0], position),
+                           max(extents[row[1]][1], position)]
+
+    starts = dict([(group, []) for group in groups])
+    ends = dict([(group, []) for group in groups])
+    for qtl in qtl_list[1:]:
+        if qtl[1] not in starts:
+            continue
+        try:
+            start = end = float(qtl[2])
+        except ValueError:
+            continue
+        if intervals:
+            bounds = [positions.get((qtl[-2], qtl[1])),
+                      positions.get((qtl[-1], qtl[1]))]
+            if None not in bounds:
+                start, end = min(bounds + [start]), max(bounds + [end])
+        starts[qtl[1]].append(start)
+        ends[qtl[1]].append(end)
+    for group in groups:
+        starts[group].sort()
+        ends[group].sort()
+
+    output = []
+    for size, step in resolutions:
+        table = [list(WINDOW_HEADERS)]
+        for group in groups:
+            windows = _get_group_windows(
+                extents[group][0], extents[group][1], size, step)
+            # QTLs starting before the end of the window minus those
+            # ending before its start
+            started = _count_before(
+                starts[group], [window[1] for window in windows])
+            ended = _count_before(
+                ends[group], [window[0] for window in windows])
+            for window, before, after in zip(windows, started, ended):
+                table.append([group, '%.3f' % window[0],
+                              '%.3f' % window[1], str(before - after)])
+        output.append(table)
+    return output
+
+
+def write_window_files(qtlfile, mapfile, resolutions, outputfolder=None,
+                       intervals=False):
+    """ Write the number of QTLs found in the windows of each resolution
+    in its own file, see :func:`get_window_counts` and
+    :func:`get_windows_filename`. Returns the list of the files written.
+
+    :arg qtlfile: the list of QTLs with their closest and flanking
+        markers.
+    :arg mapfile: the genetic map with all the markers.
+    :arg resolutions: the list of ``(size, step)`` of the windows.
+    :kwarg outputfolder: the folder in which to write the files.
+
+    """
+    qtl_list = read_input_file(qtlfile, ',')
+    genetic_map = read_input_file(mapfile, ',')
+    tables = get_window_counts(qtl_list, genetic_map, resolutions,
+                               intervals=intervals)
+    filenames = []
+    for (size, step), table in zip(resolutions, tables):
+        filename = os.path.join(outputfolder or '',
+                                get_windows_filename(size, step))
+        write_matrix(filename, table)
+        filenames.append(filename)
+        LOG.info('- QTLs counted in %s windows of %s cM in %s'
+                 % (len(table) - 1, size, filename))
+    return filenames
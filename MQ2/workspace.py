@@ -0,0 +1,93 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 workspace, a private folder in which a single run extracts its input
+    and writes its output so that several runs can safely execute in
+    parallel, in threads or in processes.
+"""
+
+import logging
+import os
+import shutil
+
+from MQ2 import set_tmp_folder
+from MQ2.mq2 import get_output_files
+
+
+LOG = logging.getLogger('MQ2')
+
+
+class Workspace(object):
+    """ A unique temporary folder containing an ``input`` folder in which
+    the input archive is extracted and an ``output`` folder in which
+    the output files are written.
+
+    It can be used as a context manager, in which case the folder is
+    removed when leaving the context::
+
+        with Workspace() as workspace:
+            plugin, folder = get_plugin_and_folder(
+                inputzip='data.zip', extract_dir=workspace.input_dir)
+            run_mq2(plugin, folder, lod_threshold=3,
+                    outputfolder=workspace.output_dir)
+
+    """
+
+    def __init__(self, basedir=None):
+        """ Constructor, creates the folders of the workspace.
+
+        :kwarg basedir: the folder in which to create the workspace,
+            defaults to the system temporary folder.
+
+        """
+        self.path = set_tmp_folder(basedir=basedir)
+        self.input_dir = os.path.join(self.path, 'input')
+        self.output_dir = os.path.join(self.path, 'output')
+        os.mkdir(self.input_dir)
+        os.mkdir(self.output_dir)
+        LOG.debug('Workspace created in %s' % self.path)
+
+    def get_output_files(self):
+        """ Return a dictionary giving the path to each of the files
+        generated by a run in this workspace.
+        """
+        return get_output_files(self.output_dir)
+
+    def cleanup(self):
+        """ Remove the workspace and everything it contains. """
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+            LOG.debug('Workspace %s removed' % self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the Workspace object. """
+        return 'Workspace<%s>' % self.path
@@ -0,0 +1,279 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+"""
+
+"""
+MQ2 zone maps, summarize the QTL matrix by its highest LOD value on each
+    linkage group of each trait.
+
+A zone is the block of consecutive rows of a linkage group for a trait.
+For each zone the zone map keeps the highest LOD value and the index of
+the row where it is found (the last one if several rows share it), missing
+values being ignored. A zone whose highest LOD value is below the LOD
+threshold cannot contain a QTL, the stages of MQ² use the zone map to skip
+these zones without reading their LOD values, so that the cost of a
+search is proportional to the number of significant zones.
+
+The zone map is computed once, while the LOD values are written (see
+:class:`~MQ2.lodstore.LODStore`) or read by the first stage of the run,
+and can be saved as JSON with :meth:`ZoneMap.to_dict`.
+"""
+
+import array
+import bisect
+import logging
+
+
+LOG = logging.getLogger('MQ2')
+
+# Highest LOD value of a zone without any LOD value
+NO_LOD = float('-inf')
+
+
+def get_groups(markers):
+    """ Return the list of the consecutive rows of the same linkage group,
+    as ``[linkage group, first row, row after the last]``.
+
+    :arg markers: the list of ``marker, linkage group, position`` of each
+        row of the QTL matrix.
+
+    """
+    groups = []
+    for cnt, row in enumerate(markers):
+        if not groups or groups[-1][0] != row[1]:
+            groups.append([row[1], cnt, cnt + 1])
+        else:
+            groups[-1][2] = cnt + 1
+    return groups
+
+
+def get_profile_zones(lods, groups):
+    """ Return the highest LOD value of each linkage group of a LOD profile
+    and the index of its row, -1 if the linkage group has no LOD value.
+
+    :arg lods: the LOD value of the trait at each row, as floats, NaN
+        being a missing value.
+    :arg groups: the linkage groups, see :func:`get_groups`.
+
+    """
+    maxima = array.array('d')
+    peaks = array.array('l')
+    for linkgrp, start, stop in groups:
+        max_lod = NO_LOD
+        peak = -1
+        for cnt in range(start, stop):
+            # NaN, ie: missing values, are never above the maximum
+            if lods[cnt] >= max_lod:
+                max_lod = lods[cnt]
+                peak = cnt
+        maxima.append(max_lod)
+        peaks.append(peak)
+    return maxima, peaks
+
+
+class ZoneMap(object):
+    """ The highest LOD value of each trait on each linkage group, see the
+    documentation of the module.
+
+    :attr groups: the linkage groups of the QTL matrix, see
+        :func:`get_groups`.
+    :attr maxima: for each trait, the array of the highest LOD value on
+        each linkage group.
+    :attr peaks: for each trait, the array of the index of the row of the
+        highest LOD value on each linkage group, -1 if there is none.
+
+    """
+
+    def __init__(self, groups):
+        """ Constructor.
+
+        :arg groups: the linkage groups, see :func:`get_groups`.
+
+        """
+        self.groups = [list(group) for group in groups]
+        self.maxima = []
+        self.peaks = []
+
+    @classmethod
+    def from_markers(cls, markers):
+        """ Return an empty zone map for a QTL matrix with the given
+        markers.
+        """
+        return cls(get_groups(markers))
+
+    @classmethod
+    def from_source(cls, source):
+        """ Return the zone map of the LOD values of a
+        :class:`~MQ2.lodstore.LODStore`, or any object offering the same
+        reading interface, reading it one block of traits at a time.
+        """
+        zones = cls.from_markers(source.markers)
+        for offset, traits, profiles in source.iter_blocks():
+            for lods in profiles:
+                zones.add_trait(lods)
+        return zones
+
+    @classmethod
+    def from_sparse(cls, sparse):
+        """ Return the zone map of a :class:`~MQ2.sparse.SparseLODs`. The
+        highest LOD values of the zones are exact when they are at least
+        the floor of the sparse matrix, the others are :data:`NO_LOD`.
+        """
+        zones = cls.from_markers(sparse.markers)
+        for trait, indexes, values in sparse.iter_traits():
+            maxima = array.array('d')
+            peaks = array.array('l')
+            for linkgrp, start, stop in zones.groups:
+                max_lod = NO_LOD
+                peak = -1
+                for cnt in range(bisect.bisect_left(indexes, start),
+                                 bisect.bisect_left(indexes, stop)):
+                    if values[cnt] >= max_lod:
+                        max_lod = values[cnt]
+                        peak = indexes[cnt]
+                maxima.append(max_lod)
+                peaks.append(peak)
+            zones.maxima.append(maxima)
+            zones.peaks.append(peaks)
+        return zones
+
+    @classmethod
+    def from_matrix(cls, qtl_matrix, count_column=False):
+        """ Return the zone map of a QTL matrix loaded in memory.
+
+        :arg qtl_matrix: the QTL matrix as a list of rows, the first row
+            being the headers.
+        :kwarg count_column: whether the last column of the matrix is the
+            number of QTLs of each row and not a trait.
+
+        """
+        zones = cls.from_markers([row[:3] for row in qtl_matrix[1:]])
+        nr_traits = len(qtl_matrix[0]) - 3
+        if count_column:
+            nr_traits -= 1
+        for colcnt in range(3, 3 + nr_traits):
+            zones.add_trait([_to_float(row[colcnt])
+                             for row in qtl_matrix[1:]])
+        return zones
+
+    @classmethod
+    def from_dict(cls, info):
+        """ Return the zone map saved with :meth:`to_dict`. """
+        zones = cls(info['groups'])
+        zones.maxima = [array.array('d', maxima)
+                        for maxima in info['maxima']]
+        zones.peaks = [array.array('l', peaks) for peaks in info['peaks']]
+        return zones
+
+    def to_dict(self):
+        """ Return the zone map as a dictionary which can be saved as JSON.
+        """
+        return {
+            'groups': self.groups,
+            'maxima': [maxima.tolist() for maxima in self.maxima],
+            'peaks': [peaks.tolist() for peaks in self.peaks],
+        }
+
+    @property
+    def nr_traits(self):
+        """ The number of traits of the zone map. """
+        return len(self.maxima)
+
+    def add_trait(self, lods):
+        """ Add the zones of the next trait given its LOD values at each
+        row, see :func:`get_profile_zones`.
+        """
+        self.set_trait(self.nr_traits, lods)
+
+    def set_trait(self, trait, lods):
+        """ Set the zones of a trait given its LOD values at each row, see
+        :func:`get_profile_zones`.
+
+        :arg trait: the index of the trait.
+        :arg lods: the LOD values of the trait, as floats.
+
+        """
+        while self.nr_traits <= trait:
+            self.maxima.append(array.array('d', [NO_LOD] * len(self.groups)))
+            self.peaks.append(array.array('l', [-1] * len(self.groups)))
+        self.maxima[trait], self.peaks[trait] = get_profile_zones(
+            lods, self.groups)
+
+    def get_zones(self, trait):
+        """ Return the highest LOD value of each linkage group of a trait
+        and the index of its row.
+        """
+        return self.maxima[trait], self.peaks[trait]
+
+    def get_significant_groups(self, trait, lod_threshold, strict=False):
+        """ Return the index of the linkage groups of a trait on which its
+        LOD reaches the threshold.
+
+        :arg trait: the index of the trait.
+        :arg lod_threshold: the LOD threshold.
+        :kwarg strict: whether the LOD should be above the threshold
+            instead of at least the threshold.
+
+        """
+        lod_threshold = float(lod_threshold)
+        if strict:
+            return [cnt for cnt, max_lod in enumerate(self.maxima[trait])
+                    if max_lod > lod_threshold]
+        return [cnt for cnt, max_lod in enumerate(self.maxima[trait])
+                if max_lod >= lod_threshold]
+
+    def is_significant(self, trait, lod_threshold, strict=False):
+        """ Return whether the LOD of a trait reaches the threshold on any
+        of the linkage groups, see :meth:`get_significant_groups`.
+        """
+        max_lod = max(self.maxima[trait]) if self.groups else NO_LOD
+        if strict:
+            return max_lod > float(lod_threshold)
+        return max_lod >= float(lod_threshold)
+
+    def get_significant_traits(self, lod_threshold, strict=False):
+        """ Return, for each linkage group, the index of the traits whose
+        LOD reaches the threshold on it, see
+        :meth:`get_significant_groups`.
+        """
+        output = [[] for group in self.groups]
+        for trait in range(self.nr_traits):
+            for groupcnt in self.get_significant_groups(
+                    trait, lod_threshold, strict=strict):
+                output[groupcnt].append(trait)
+        return output
+
+    def __repr__(self):  # pragma: no cover
+        """ String representation of the ZoneMap object. """
+        return 'ZoneMap<%s traits x %s linkage groups>' % (
+            self.nr_traits, len(self.groups))
+
+
+def _to_float(value):
+    """ Return the LOD value of a cell as a float, NaN if it is missing.
+    """
+    value = value.strip()
+    if not value:
+        return float('nan')
+    return float(value)
@@ -17,11 +17,13 @@ setup(
     license='GPLv3+',
     url='https://github.com/PBR/MQ2/',
     packages=['MQ2', 'MQ2.plugins'],
+    python_requires='>=3.9',
     install_requires=['straight.plugin', 'xlrd'],
     test_suite='nose.collector',
     entry_points={
         'console_scripts': [
-            'MQ2 = MQ2.mq2:cli_main'
+            'MQ2 = MQ2.mq2:cli_main',
+            'MQ2-query = MQ2.database:cli_main',
 		]
     },
     classifiers=[
@@ -32,9 +34,11 @@ setup(
           'Operating System :: MacOS :: MacOS X',
           'Operating System :: Microsoft :: Windows',
           'Operating System :: POSIX',
-          'Programming Language :: Python :: 2.6',
-          'Programming Language :: Python :: 2.7',
           'Programming Language :: Python :: 3',
+          'Programming Language :: Python :: 3 :: Only',
+          'Programming Language :: Python :: 3.9',
+          'Programming Language :: Python :: 3.10',
+          'Programming Language :: Python :: 3.11',
           'Topic :: Software Development :: Libraries',
           'Topic :: Scientific/Engineering :: Bio-Informatics',
           ],
@@ -29,6 +29,7 @@
 import os
 import shutil
 import sys
+import threading
 import unittest
 
 from datetime import date
@@ -37,8 +38,24 @@ sys.path.insert(0, os.path.abspath('../'))
 
 import MQ2
 import MQ2.mq2 as mq2
-from MQ2.add_marker_to_qtls import add_marker_to_qtls
-from MQ2.add_qtl_to_map import add_qtl_to_map
+from MQ2.add_marker_to_qtls import add_marker_to_qtls, add_marker_to_qtl_list
+from MQ2.add_qtl_to_map import (add_qtl_to_map, add_qtl_to_map_list,
+                                add_qtl_intervals_to_map_list)
+from MQ2.catalog import Catalog
+from MQ2.clustering import get_trait_clusters
+from MQ2.colocalization import get_colocalization
+from MQ2.hotspot import (add_hotspot_significance, get_marker_weights,
+                         get_windows)
+from MQ2.lodstore import LODStore
+from MQ2.profiling import Profiler
+from MQ2.windows import get_window_counts, parse_resolutions
+from MQ2.qtl import QTL, QTLSet
+from MQ2.scheduler import (get_required_stages, get_stage_dependencies,
+                           run_stages, uses)
+from MQ2.shared import SharedLODs
+from MQ2.streaming import convert_streaming, is_streaming
+from MQ2.workspace import Workspace
+from MQ2.zonemap import ZoneMap
 
 
 TEST_INPUT_PASSED = os.path.join(
@@ -189,6 +206,516 @@ class MQ2tests(unittest.TestCase):
             mq2.get_plugin_and_folder,
             inputzip=TEST_INPUT_FAILED)
 
+    def test_set_tmp_folder_unique(self):
+        """ Test that set_tmp_folder returns a new folder at each call.
+        """
+        folders = [MQ2.set_tmp_folder() for cnt in range(20)]
+        self.assertEqual(len(set(folders)), 20)
+        for folder in folders:
+            self.assertTrue(os.path.isdir(folder))
+            self.assertTrue(MQ2.is_tmp_folder(folder))
+            shutil.rmtree(folder)
+        self.assertFalse(MQ2.is_tmp_folder(TEST_FOLDER))
+
+    def test_run_mq2_keeps_input_dir(self):
+        """ Test that run_mq2 does not remove an input folder it did not
+        create.
+        """
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            self.assertEqual(folder, workspace.input_dir)
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir)
+            self.assertTrue(os.path.isdir(folder))
+            for filename in workspace.get_output_files().values():
+                self.assertTrue(os.path.exists(filename))
+        self.assertFalse(os.path.exists(workspace.path))
+
+    def test_run_mq2_parallel(self):
+        """ Test running several runs of MQ2 in parallel threads. """
+        outputs = {}
+
+        def run(cnt):
+            with Workspace() as workspace:
+                plugin, folder = mq2.get_plugin_and_folder(
+                    inputzip=TEST_INPUT_PASSED,
+                    extract_dir=workspace.input_dir)
+                mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                            outputfolder=workspace.output_dir)
+                outputs[cnt] = read_file(
+                    workspace.get_output_files()['map_chart'])
+
+        threads = [threading.Thread(target=run, args=(cnt,))
+                   for cnt in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = read_file(
+            os.path.join(TEST_FOLDER, 'mapqtl', 'MapChart.exp'))
+        self.assertEqual(len(outputs), 4)
+        for output in outputs.values():
+            self.assertEqual(output, expected)
+        self.assertFalse(os.path.exists('MapChart.map'))
+
+    def test_profiler_nested(self):
+        """ Test that measuring a file in a stage keeps the peak memory of
+        the stage.
+        """
+        profiler = Profiler()
+        profiler.start()
+        try:
+            with profiler.stage('stage'):
+                data = bytearray(4 * 1024 * 1024)
+                del data
+                with profiler.file('file'):
+                    pass
+        finally:
+            profiler.stop()
+        self.assertTrue(
+            profiler.stages[0]['peak_memory'] >= 4 * 1024 * 1024)
+        self.assertTrue(profiler.files[0]['peak_memory']
+                        < profiler.stages[0]['peak_memory'])
+
+    def test_stage_scheduler(self):
+        """ Test running the independent stages of a run concurrently. """
+        # The MapChart file only waits for the count of the QTLs, the
+        # map with the QTLs only for the closest markers
+        self.assertEqual(get_stage_dependencies(mq2.STAGES),
+                         [set(), {0}, {0}, {0, 2}, {0, 1}, {2, 3, 4}])
+
+        started = threading.Barrier(2, timeout=5)
+
+        @uses(writes=['a'])
+        def first(context):
+            started.wait()
+            return {'a': 1}
+
+        @uses(writes=['b'])
+        def second(context):
+            started.wait()
+            return {'b': 2}
+
+        def last(context):
+            return {'c': context['a'] + context['b']}
+
+        self.assertEqual(get_stage_dependencies(
+            [('first', first), ('second', second), ('last', last)]),
+            [set(), set(), {0, 1}])
+        context = {'profiler': None}
+        # Both first stages should run at the same time to pass the barrier
+        run_stages([('first', first), ('second', second), ('last', last)],
+                   context, threads=2)
+        self.assertEqual(context['c'], 3)
+
+        # The stages measured by a profiler run one after the other
+        threads = set()
+
+        @uses(writes=['a'])
+        def third(context):
+            threads.add(threading.current_thread())
+
+        @uses(writes=['b'])
+        def fourth(context):
+            threads.add(threading.current_thread())
+
+        profiler = Profiler()
+        run_stages([('third', third), ('fourth', fourth)],
+                   {'profiler': profiler}, threads=2)
+        self.assertEqual(threads, set([threading.current_thread()]))
+        self.assertEqual(len(profiler.stages), 2)
+
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir, stage_threads=3)
+            self.assertEqual(
+                read_file(workspace.get_output_files()['map_chart']),
+                read_file(os.path.join(TEST_FOLDER, 'mapqtl',
+                                       'MapChart.exp')))
+
+    def test_selected_outputs(self):
+        """ Test only running the stages needed by the outputs wanted. """
+        self.assertEqual(
+            [name for name, function in get_required_stages(
+                mq2.STAGES, ['map_qtl'])],
+            [mq2.STAGES[0][0], mq2.STAGES[2][0], mq2.STAGES[3][0]])
+
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir, cleanup=False,
+                        outputs='map_with_qtls.csv')
+            files = workspace.get_output_files()
+            self.assertEqual(
+                read_file(files['map_qtl']),
+                read_file(os.path.join(TEST_FOLDER, 'mapqtl',
+                                       'map_with_qtls.exp')))
+            self.assertFalse(os.path.exists(files['map_chart']))
+            self.assertRaises(
+                MQ2.MQ2Exception, mq2.run_mq2, plugin, folder,
+                lod_threshold=3, session=2,
+                outputfolder=workspace.output_dir, outputs=['foo'])
+
+    def test_streaming_plugins(self):
+        """ Test converting the input of a plugin one trait at a time. """
+        from MQ2.plugins.csv_plugin import CSVPlugin
+        from MQ2.plugins.mapqtl_plugin import MapQTLPlugin
+
+        self.assertTrue(is_streaming(MapQTLPlugin))
+        self.assertFalse(is_streaming(CSVPlugin))
+
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            files = workspace.get_output_files()
+            counts, zones = convert_streaming(
+                plugin, folder=folder, session=2, lod_threshold=3,
+                qtls_file=files['qtls'], matrix_file=files['matrix'],
+                map_file=files['map'])
+            for key in ['qtls', 'map']:
+                self.assertEqual(
+                    read_file(files[key]),
+                    read_file(os.path.join(TEST_FOLDER, 'mapqtl',
+                                           '%s.exp' % key)))
+            expected = MQ2.read_input_file(
+                os.path.join(TEST_FOLDER, 'mapqtl', 'qtls_matrix.exp'),
+                sep=',')
+            self.assertEqual([str(count) for count in counts],
+                             [row[-1] for row in expected[1:]])
+            self.assertEqual(zones.nr_traits, len(expected[0]) - 4)
+
+            self.assertEqual(read_file(files['matrix']), ''.join(
+                [','.join(row[:-1]) + '\n' for row in expected]))
+            # The temporary data file of the LOD values is removed
+            self.assertEqual(
+                sorted(os.listdir(os.path.dirname(files['matrix']))),
+                sorted([os.path.basename(files[key])
+                        for key in ['qtls', 'matrix', 'map']]))
+
+            # The plugins which do not stream are converted at once
+            mq2.run_mq2(CSVPlugin, TEST_INPUT_FILE, lod_threshold=3,
+                        outputfolder=workspace.output_dir)
+            self.assertEqual(
+                read_file(files['map_qtl']),
+                read_file(os.path.join(TEST_FOLDER, 'csv',
+                                       'map_with_qtls.exp')))
+
+    def test_qtl_set(self):
+        """ Test the QTLSet container. """
+        qtls = QTLSet()
+        for trait, lgroup, peak, lod in [('t1', '2', '10.50', 3.5),
+                                         ('t2', '10', '5', 4.2),
+                                         ('t3', '2', '1.0', 6.1)]:
+            qtl = QTL()
+            qtl.trait = trait
+            qtl.linkage_group = lgroup
+            qtl.peak_mk = 'M_%s' % trait
+            qtl.set_positions('0.000', peak, '20.1')
+            qtl.peak_lod = lod
+            qtls.append(qtl)
+        self.assertEqual(len(qtls), 3)
+        self.assertEqual(qtls[0].to_string(), 't1   0.000 10.50 10.50 20.1')
+        self.assertEqual(qtls.to_map_chart()[1],
+                         't2   0.000 5 5 20.1 \n')
+        self.assertRaises(AttributeError, setattr, qtls[0], 'foo', 1)
+
+        self.assertEqual(qtls.filter(min_lod=4).trait, ['t2', 't3'])
+        self.assertEqual(
+            qtls.filter(min_lod=4, linkage_group=2).trait, ['t3'])
+        self.assertEqual(qtls.sort().trait, ['t3', 't1', 't2'])
+        groups = qtls.group_by('linkage_group')
+        self.assertEqual(sorted(groups.keys()), ['10', '2'])
+        self.assertEqual(groups['2'].trait, ['t1', 't3'])
+        self.assertEqual(qtls.get_flanking_markers()['M_t1'], ['NA', 'NA'])
+        self.assertEqual(qtls.to_rows()[3][5], '1.0')
+
+    def test_hotspot_significance(self):
+        """ Test the permutation test of the QTL hotspots. """
+        genetic_map = [['Locus', 'Group', 'Position', '# QTLs']]
+        for cnt in range(20):
+            genetic_map.append(['M%s' % cnt, str(cnt // 10 + 1),
+                                '%s.0' % (cnt % 10 * 5), '0'])
+        genetic_map[4][-1] = '12'
+        genetic_map[5][-1] = '3'
+        genetic_map[15][-1] = '1'
+
+        self.assertEqual(get_windows(genetic_map[1:4], window=10),
+                         [(0, 2), (0, 3), (1, 3)])
+        self.assertEqual(get_windows(genetic_map[1:4], window=5),
+                         [(0, 1), (1, 2), (2, 3)])
+        self.assertEqual(
+            get_marker_weights([['M1', '1', '0'], ['M2', '1', '4'],
+                                ['M3', '1', '10'], ['M4', '2', '2'],
+                                ['M5', 'U', '']]),
+            [2., 5., 3., 0., 0.])
+        self.assertEqual(get_marker_weights([['M1', '1', '0']]), [1.])
+
+        output = add_hotspot_significance(
+            genetic_map, permutations=500, workers=1, seed=42)
+        self.assertEqual(output[0][-3:], ['Window QTLs',
+                                          'Hotspot threshold',
+                                          'Significant'])
+        threshold = int(output[1][-2])
+        self.assertTrue(3 <= threshold < 12)
+        self.assertEqual([row[0] for row in output[1:] if row[-1] == '1'],
+                         ['M3'])
+        self.assertEqual(
+            output, add_hotspot_significance(
+                genetic_map, permutations=500, workers=1, seed=42))
+
+        output = add_hotspot_significance(
+            genetic_map, permutations=500, window=10, workers=2, seed=42)
+        self.assertEqual([row[-3] for row in output[3:7]],
+                         ['12', '15', '15', '3'])
+
+    def test_qtl_intervals_to_map(self):
+        """ Test counting the QTLs on all the markers of their interval.
+        """
+        genetic_map = [['Locus', 'Group', 'Position'],
+                       ['M1', '1', '0.0'], ['M2', '1', '5.0'],
+                       ['M3', '1', '5.0'], ['M4', '1', '12.5'],
+                       ['M1', '2', '0.0'], ['M5', '2', '3.0'],
+                       ['M6', 'U', '']]
+        qtls = [['Trait', 'Group', 'Position', 'Marker', 'LOD',
+                 'Closest marker', 'LOD2 interval start',
+                 'LOD2 interval end'],
+                ['t1', '1', '5.0', 'M2', '4', 'M2', 'M1', 'M3'],
+                ['t2', '1', '12.0', 'M4', '4', 'M4', 'M2', 'M4'],
+                ['t3', '2', '1.0', 'M1', '4', 'M1', 'NA', 'NA'],
+                ['t4', 'U', '1.0', 'M6', '4', 'M6', 'M6', 'M6']]
+        output = add_qtl_intervals_to_map_list(qtls, genetic_map)
+        self.assertEqual(output[0][-1], '# QTLs')
+        self.assertEqual([row[-1] for row in output[1:]],
+                         ['1', '2', '2', '1', '1', '0', '1'])
+        # Without intervals every QTL is on its closest marker
+        qtls = [row[:6] + ['NA', 'NA'] for row in qtls]
+        output = add_qtl_intervals_to_map_list(qtls, genetic_map)
+        self.assertEqual([row[-1] for row in output[1:]],
+                         ['0', '1', '0', '1', '1', '0', '1'])
+
+    def test_catalog(self):
+        """ Test joining the QTLs and the map on the codes of a catalog.
+        """
+        genetic_map = [['Locus', 'Group', 'Position'],
+                       ['M1', '1', '0.0'], ['M2', '1', '4.0'],
+                       ['M3', '1', '8.0'], ['M1', '2', '2.0'],
+                       ['M4', '2', '2.0']]
+        qtls = [['Trait', 'Group', 'Position', 'Marker', 'LOD'],
+                ['t1', '1', '2.0', 'M1', '4'],
+                ['t2', '1', '7.0', 'M3', '4'],
+                ['t3', '2', '3.0', 'M4', '4'],
+                ['t4', '3', '3.0', 'M5', '4']]
+        catalog = Catalog()
+        qtls = add_marker_to_qtl_list(qtls, genetic_map, catalog=catalog)
+        # Ties go to the first marker of the map
+        self.assertEqual([row[-1] for row in qtls[1:]],
+                         ['M1', 'M3', 'M1', ''])
+        self.assertEqual(catalog.markers, ['M1', 'M2', 'M3', 'M4'])
+        self.assertEqual(catalog.groups, ['1', '2'])
+        self.assertEqual(catalog.get_marker('M4'), 3)
+        self.assertEqual(catalog.get_group('3'), None)
+        # The QTLs are counted on the name of their closest marker
+        output = add_qtl_to_map_list(qtls, genetic_map, catalog=catalog)
+        self.assertEqual([row[-1] for row in output[1:]],
+                         ['2', '0', '1', '2', '0'])
+
+    def test_colocalization(self):
+        """ Test listing the traits with overlapping QTL intervals. """
+        genetic_map = [['Locus', 'Group', 'Position'],
+                       ['M1', '1', '0.0'], ['M2', '1', '5.0'],
+                       ['M3', '1', '10.0'], ['M4', '1', '20.0'],
+                       ['M5', '2', '0.0'], ['M6', '2', '3.0']]
+        qtls = [['Trait', 'Group', 'Position', 'Marker', 'LOD',
+                 'Closest marker', 'LOD2 interval start',
+                 'LOD2 interval end'],
+                ['t1', '1', '5.0', 'M2', '4', 'M2', 'M1', 'M3'],
+                ['t2', '1', '12.0', 'M3', '4', 'M3', 'M2', 'M4'],
+                ['t3', '1', '20.0', 'M4', '4', 'M4', 'M4', 'M4'],
+                ['t1', '1', '12.0', 'M3', '4', 'M3', 'M3', 'M4'],
+                ['t1', '2', '3.0', 'M6', '4', 'M6', 'NA', 'NA'],
+                ['t3', '2', '0.0', 'M5', '4', 'M5', 'M5', 'M6']]
+        output = get_colocalization(qtls, genetic_map)
+        self.assertEqual(output[0][0], 'Trait 1')
+        self.assertEqual(
+            output[1:],
+            [['t1', 't2', '1', '5.000', '10.000', '5.000', 'M2 M3'],
+             ['t1', 't2', '1', '10.000', '20.000', '10.000', 'M3 M4'],
+             ['t1', 't3', '1', '20.000', '20.000', '0.000', 'M4'],
+             ['t2', 't3', '1', '20.000', '20.000', '0.000', 'M4'],
+             ['t1', 't3', '2', '3.000', '3.000', '0.000', 'M6']])
+
+    def test_trait_clusters(self):
+        """ Test grouping the traits with correlated LOD profiles. """
+        with Workspace() as workspace:
+            path = os.path.join(workspace.path, 'lods.bin')
+            markers = [['M%s' % cnt, '1', '%s.0' % cnt]
+                       for cnt in range(5)]
+            traits = ['t1', 't2', 't3', 't4', 't5', 't6']
+            with LODStore.create(path, markers, traits) as store:
+                store.set_trait(0, [0, 1, 4, 1, 0])
+                store.set_trait(1, [0, 2, 8, 2, 0])
+                store.set_trait(2, [4, 1, 0, 1, 4])
+                store.set_trait(3, [0.5, 1, 3.5, 1, 0.5])
+                store.set_trait(4, [1, 1, 1, 1, 1])
+                store.set_trait(5, [5, 1.5, 0, 1, 4])
+            with LODStore.open(path) as store:
+                clusters = get_trait_clusters(store, threshold=0.9)
+                self.assertEqual(clusters,
+                                 [['t1', 't2', 't4'], ['t3', 't6'], ['t5']])
+                # One trait per block gives the same clusters
+                self.assertEqual(
+                    get_trait_clusters(store, threshold=0.9, memory=80),
+                    clusters)
+                self.assertEqual(
+                    get_trait_clusters(store, threshold=0.9,
+                                       lod_threshold=4),
+                    [['t1', 't2'], ['t3', 't6']])
+
+    def test_window_counts(self):
+        """ Test counting the QTLs in windows of the linkage groups. """
+        self.assertEqual(parse_resolutions('1, 5:2.5'),
+                         [(1.0, 1.0), (5.0, 2.5)])
+        self.assertRaises(MQ2.MQ2Exception, parse_resolutions, '5:0')
+        self.assertRaises(MQ2.MQ2Exception, parse_resolutions, 'a')
+
+        genetic_map = [['Locus', 'Group', 'Position'],
+                       ['M1', '1', '0.0'], ['M2', '1', '4.0'],
+                       ['M3', '1', '9.5'], ['M4', '2', '2.0'],
+                       ['M5', '2', '6.0']]
+        qtls = [['Trait', 'Group', 'Position', 'Marker', 'LOD',
+                 'Closest marker', 'LOD2 interval start',
+                 'LOD2 interval end'],
+                ['t1', '1', '4.0', 'M2', '4', 'M2', 'M1', 'M3'],
+                ['t2', '1', '5.0', 'M2', '4', 'M2', 'M2', 'M2'],
+                ['t3', '2', '6.0', 'M5', '4', 'M5', 'NA', 'NA']]
+        peaks, sliding = get_window_counts(
+            qtls, genetic_map, [(5, 5), (4, 2)])
+        self.assertEqual(peaks[0], ['Linkage Group', 'Window start',
+                                    'Window end', '# QTLs'])
+        self.assertEqual(peaks[1:],
+                         [['1', '0.000', '5.000', '1'],
+                          ['1', '5.000', '10.000', '1'],
+                          ['2', '0.000', '5.000', '0'],
+                          ['2', '5.000', '10.000', '1']])
+        self.assertEqual([row[1:] for row in sliding[1:6]],
+                         [['0.000', '4.000', '0'], ['2.000', '6.000', '2'],
+                          ['4.000', '8.000', '2'], ['6.000', '10.000', '0'],
+                          ['8.000', '12.000', '0']])
+        intervals = get_window_counts(
+            qtls, genetic_map, [(5, 5)], intervals=True)[0]
+        self.assertEqual([row[-1] for row in intervals[1:]],
+                         ['2', '2', '0', '1'])
+
+    def test_lod_store(self):
+        """ Test writing and reading back a LOD store. """
+        with Workspace() as workspace:
+            path = os.path.join(workspace.path, 'lods.bin')
+            markers = [['M1', '1', '0.0'], ['M2', '1', '5.5'],
+                       ['M3', '2', '0.0']]
+            with LODStore.create(path, markers, ['t1', 't2']) as store:
+                store.set_trait(0, ['1.50', '', '3.25'])
+                store.set_rows(0, [['0.1', 4], ['0.2', 5]])
+                store.set_trait(1, [6.5], position=2)
+
+            with LODStore.open(path) as store:
+                self.assertEqual(store.markers, markers)
+                self.assertEqual(list(store.get_trait(1)), [4, 5, 6.5])
+                self.assertEqual(list(store.get_trait(0, 1, 3)),
+                                 [0.2, 3.25])
+                blocks = list(store.iter_blocks(block_size=1))
+                self.assertEqual([block[1] for block in blocks],
+                                 [['t1'], ['t2']])
+                self.assertEqual(
+                    list(store.iter_rows(chunk_size=2)),
+                    [['Locus', 'Group', 'Position', 't1', 't2'],
+                     ['M1', '1', '0.0', '0.1', '4.0'],
+                     ['M2', '1', '5.5', '0.2', '5.0'],
+                     ['M3', '2', '0.0', '3.25', '6.5']])
+                # The zone map follows the values re-written
+                self.assertEqual(store.zones.groups,
+                                 [['1', 0, 2], ['2', 2, 3]])
+                self.assertEqual(
+                    [list(zones) for zones in store.zones.get_zones(0)],
+                    [[0.2, 3.25], [1, 2]])
+
+    def test_zone_map(self):
+        """ Test the highest LOD of each trait on each linkage group. """
+        matrix = [['Locus', 'Group', 'Position', 't1', 't2', 't3'],
+                  ['M1', '1', '0.0', '1.0', '4.0', ''],
+                  ['M2', '1', '5.0', '3.5', '4.0', ''],
+                  ['M3', '2', '0.0', '0.5', '', '2.0'],
+                  ['M4', '2', '6.0', '', '', '3.0']]
+        zones = ZoneMap.from_matrix(matrix)
+        self.assertEqual(zones.nr_traits, 3)
+        self.assertEqual([list(values) for values in zones.get_zones(0)],
+                         [[3.5, 0.5], [1, 2]])
+        # Last of the highest values, no value on a linkage group
+        self.assertEqual([list(values) for values in zones.get_zones(1)],
+                         [[4.0, float('-inf')], [1, -1]])
+        self.assertEqual(zones.get_significant_groups(2, 3), [1])
+        self.assertEqual(zones.get_significant_groups(2, 3, strict=True),
+                         [])
+        self.assertFalse(zones.is_significant(0, 4))
+        self.assertEqual(zones.get_significant_traits(3.5),
+                         [[0, 1], []])
+        self.assertEqual(ZoneMap.from_dict(zones.to_dict()).get_zones(2),
+                         zones.get_zones(2))
+
+        counts = mq2.add_count_to_matrix(matrix, 3, zones=zones)
+        self.assertEqual(counts, mq2.add_count_to_matrix(matrix, 3))
+        self.assertEqual([row[-1] for row in counts[1:]],
+                         ['1', '2', '0', '0'])
+
+    def test_shared_lods(self):
+        """ Test sharing the LOD values with other processes. """
+        markers = [['M1', '1', '0.0'], ['M2', '1', '5.5'],
+                   ['M3', '2', '0.0']]
+        with SharedLODs.create(markers, ['t1', 't2']) as shared:
+            shared.set_trait(1, [4, 5, 6.5])
+            with SharedLODs.attach(shared.name) as attached:
+                self.assertEqual(attached.markers, markers)
+                self.assertEqual(attached.traits, ['t1', 't2'])
+                self.assertEqual(list(attached.get_trait(1, 1)),
+                                 [5, 6.5])
+                self.assertEqual(list(attached.get_trait(0)), [0, 0, 0])
+        # The owner removes the shared memory
+        self.assertRaises(MQ2.MQ2Exception, SharedLODs.attach, shared.name)
+
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir, processes=2)
+            self.assertEqual(
+                read_file(workspace.get_output_files()['map_chart']),
+                read_file(os.path.join(TEST_FOLDER, 'mapqtl',
+                                       'MapChart.exp')))
+
+            # Over the memory budget, the matrix is not shared
+            shared = []
+            from_source = SharedLODs.__dict__['from_source']
+
+            def _from_source(cls, *args, **kwargs):
+                shared.append(args)
+                return from_source.__func__(cls, *args, **kwargs)
+
+            SharedLODs.from_source = classmethod(_from_source)
+            try:
+                mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                            outputfolder=workspace.output_dir, processes=2,
+                            max_memory=0.001)
+            finally:
+                SharedLODs.from_source = from_source
+            self.assertEqual(shared, [])
+            self.assertEqual(
+                read_file(workspace.get_output_files()['map_chart']),
+                read_file(os.path.join(TEST_FOLDER, 'mapqtl',
+                                       'MapChart.exp')))
+
 
 if __name__ == '__main__':
     SUITE = unittest.TestLoader().loadTestsFromTestCase(MQ2tests)
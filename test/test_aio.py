@@ -0,0 +1,131 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+ MQ² test script for the asyncio API
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath('..'))
+
+import MQ2.aio as aio
+from MQ2.workspace import Workspace
+
+
+TEST_INPUT_PASSED = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'mapqtl', 'Demoset1.zip')
+
+TEST_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_file(filename):
+    """ Reads in a file for a given filename and just return the
+    content.
+    """
+    stream = open(filename)
+    data = stream.read()
+    stream.close()
+    return data
+
+
+class MQ2Aiotests(unittest.TestCase):
+    """ MQ² tests for the asyncio API. """
+
+    def test_run_mq2(self):
+        """ Test the asynchronous run_mq2 with progress events. """
+        events = []
+
+        async def run(workspace, executor):
+            plugin, folder = await aio.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED)
+            await aio.run_mq2(
+                plugin, folder, lod_threshold=3, session=2,
+                outputfolder=workspace.output_dir, executor=executor,
+                progress=events.append, colocalization=True)
+            return folder
+
+        # The run is ran in a thread or in a child process
+        for executor_class in [concurrent.futures.ThreadPoolExecutor,
+                               concurrent.futures.ProcessPoolExecutor]:
+            del events[:]
+            with Workspace() as workspace:
+                with executor_class(1) as executor:
+                    folder = asyncio.run(run(workspace, executor))
+                self.assertFalse(os.path.exists(folder))
+                self.assertEqual(
+                    read_file(workspace.get_output_files()['map_chart']),
+                    read_file(os.path.join(
+                        TEST_FOLDER, 'mapqtl', 'MapChart.exp')))
+                # The options of the synchronous run_mq2 are supported
+                self.assertTrue(os.path.exists(os.path.join(
+                    workspace.output_dir, 'colocalization.csv')))
+            self.assertEqual(len(events), 14)
+            self.assertEqual(events[0]['status'], 'started')
+            self.assertEqual(
+                len([event for event in events
+                     if event['status'] == 'done']), 7)
+            self.assertEqual(events[-1]['total'], 7)
+
+    def test_run_mq2_cancelled(self):
+        """ Test cancelling the asynchronous run_mq2. """
+
+        async def run(workspace, executor):
+            plugin, folder = await aio.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED)
+
+            async def progress(event):
+                if event['status'] == 'done':
+                    task.cancel()
+
+            task = asyncio.ensure_future(aio.run_mq2(
+                plugin, folder, lod_threshold=3, session=2,
+                outputfolder=workspace.output_dir, executor=executor,
+                progress=progress))
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return task, folder
+
+        for executor in [None, concurrent.futures.ProcessPoolExecutor(1)]:
+            with Workspace() as workspace:
+                task, folder = asyncio.run(run(workspace, executor))
+                self.assertTrue(task.cancelled())
+                self.assertFalse(os.path.exists(folder))
+                files = workspace.get_output_files()
+                self.assertTrue(os.path.exists(files['qtls']))
+                self.assertFalse(os.path.exists(files['map_chart']))
+            if executor is not None:
+                executor.shutdown()
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(MQ2Aiotests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
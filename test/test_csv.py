@@ -37,6 +37,11 @@ sys.path.insert(0, os.path.abspath('..'))
 
 import MQ2
 import MQ2.mq2 as mq2
+from MQ2.analysis import analyze
+from MQ2.chunked import MatrixFile
+from MQ2.lodstore import LODStore
+from MQ2.sparse import SparseLODs
+from MQ2.workspace import Workspace
 
 
 TEST_INPUT_PASSED = os.path.join(
@@ -200,6 +205,153 @@ class MQ2CSVtests(unittest.TestCase):
                          read_file(os.path.join(
                             TEST_FOLDER, 'csv', 'MapChart.exp')))
 
+    def test_run_mq2_lod_store(self):
+        """ Test the run_mq2 function with CSV input and the LOD values
+        kept in a LOD store, the output is the same as without the store.
+        """
+        outputs = []
+        for lod_store in [None, 'lods.bin']:
+            with Workspace() as workspace:
+                plugin, folder = mq2.get_plugin_and_folder(
+                    inputfile=TEST_INPUT_FILE)
+                if lod_store:
+                    lod_store = os.path.join(workspace.path, lod_store)
+                mq2.run_mq2(plugin, TEST_INPUT_FILE, lod_threshold=3,
+                            outputfolder=workspace.output_dir,
+                            lod_store=lod_store)
+                outputs.append(dict(
+                    [(key, read_file(filename)) for key, filename in
+                     workspace.get_output_files().items()]))
+                if lod_store:
+                    with LODStore.open(lod_store) as store:
+                        self.assertEqual(store.traits,
+                                         ['pheno1', 'pheno2', 'sex', 'age'])
+                        self.assertEqual(store.nr_positions, 472)
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_run_mq2_max_memory(self):
+        """ Test the run_mq2 function with CSV input and a memory budget
+        so small that the traits are processed one at a time, the output
+        is the same as without budget.
+        """
+        outputs = []
+        for max_memory in [None, 0.001]:
+            with Workspace() as workspace:
+                plugin, folder = mq2.get_plugin_and_folder(
+                    inputfile=TEST_INPUT_FILE)
+                mq2.run_mq2(plugin, TEST_INPUT_FILE, lod_threshold=3,
+                            outputfolder=workspace.output_dir,
+                            max_memory=max_memory)
+                outputs.append(dict(
+                    [(key, read_file(filename)) for key, filename in
+                     workspace.get_output_files().items()]))
+        self.assertEqual(outputs[0], outputs[1])
+
+        with MatrixFile(TEST_INPUT_FILE, noquote=True,
+                        block_memory=472 * 8 * 3) as source:
+            self.assertEqual(source.traits,
+                             ['pheno1', 'pheno2', 'sex', 'age'])
+            self.assertEqual(
+                [(offset, traits) for offset, traits, lods
+                 in source.iter_blocks()],
+                [(0, ['pheno1', 'pheno2', 'sex']), (3, ['age'])])
+            # The chunks read from the spill file are the same as those
+            # read at once
+            columns = list(source.iter_blocks(block_size=4))[0][2]
+            for block_size in [1, 3]:
+                self.assertEqual(
+                    [column for offset, traits, lods
+                     in source.iter_blocks(block_size=block_size)
+                     for column in lods], columns)
+            self.assertEqual(len(columns[0]), source.nr_positions)
+
+    def test_run_mq2_sparse(self):
+        """ Test the run_mq2 function with CSV input and only the LOD
+        values above a floor kept, the output is the same as with all the
+        values.
+        """
+        outputs = []
+        for kwargs in [{}, {'sparse': True}, {'sparse_floor': 0.5}]:
+            with Workspace() as workspace:
+                plugin, folder = mq2.get_plugin_and_folder(
+                    inputfile=TEST_INPUT_FILE)
+                mq2.run_mq2(plugin, TEST_INPUT_FILE, lod_threshold=3,
+                            outputfolder=workspace.output_dir, **kwargs)
+                outputs.append(dict(
+                    [(key, read_file(filename)) for key, filename in
+                     workspace.get_output_files().items()]))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+        # The sparse matrix is read from the matrix file when the LOD
+        # values are stored or read a chunk at a time
+        for kwargs in [{'lod_store': 'lods.bin'}, {'max_memory': 0.001}]:
+            with Workspace() as workspace:
+                if 'lod_store' in kwargs:
+                    kwargs['lod_store'] = os.path.join(
+                        workspace.path, kwargs['lod_store'])
+                plugin, folder = mq2.get_plugin_and_folder(
+                    inputfile=TEST_INPUT_FILE)
+                mq2.run_mq2(plugin, TEST_INPUT_FILE, lod_threshold=3,
+                            outputfolder=workspace.output_dir, sparse=True,
+                            **kwargs)
+                self.assertEqual(outputs[0], dict(
+                    [(key, read_file(filename)) for key, filename in
+                     workspace.get_output_files().items()]))
+
+        plugin, folder = mq2.get_plugin_and_folder(
+            inputfile=TEST_INPUT_FILE)
+        self.assertRaises(
+            MQ2.MQ2Exception, mq2.run_mq2, plugin, TEST_INPUT_FILE,
+            lod_threshold=3, sparse_floor=2)
+
+        sparse = SparseLODs.from_matrix_file(
+            os.path.join(TEST_FOLDER, 'csv', 'qtls_matrix.exp'), 1,
+            count_column=True)
+        self.assertEqual(sparse.traits, ['pheno1', 'pheno2', 'sex', 'age'])
+        self.assertEqual(sparse.nr_positions, 472)
+        self.assertTrue(sparse.nr_values < 472 * 4)
+        self.assertTrue(min([min(values) for values in sparse.values
+                             if values]) >= 1)
+
+    def test_analyze(self):
+        """ Test the in-memory analysis with the matrix of the CSV file.
+        """
+        matrix = MQ2.read_input_file(TEST_INPUT_FILE, sep=',', noquote=True)
+        result = analyze(matrix, lod_threshold=3)
+        self.assertFalse(os.path.exists('qtls.csv'))
+        self.assertEqual(
+            result.map_with_qtls,
+            MQ2.read_input_file(os.path.join(
+                TEST_FOLDER, 'csv', 'map_with_qtls.exp'), sep=','))
+        self.assertEqual(
+            result.matrix,
+            MQ2.read_input_file(os.path.join(
+                TEST_FOLDER, 'csv', 'qtls_matrix.exp'), sep=','))
+        self.assertEqual(len(result.qtls), 5)
+        self.assertEqual(
+            result.qtls[2][:4] + result.qtls[2][5:],
+            ['pheno1', '5', '17.5', 'c5.loc17.5', 'D5M157', 'D5M233',
+             'D5M406'])
+        hotspots = result.get_hotspots()
+        self.assertEqual(hotspots['D5M157'], 1)
+        self.assertEqual(sum(hotspots.values()), 4)
+        self.assertTrue('pheno1   4.4 17.5 17.5 35.01 \n' in result.map_chart)
+
+    def test_analyze_numeric(self):
+        """ Test the in-memory analysis with numbers and a genetic map.
+        """
+        matrix = [['marker', 'chr', 'pos', 'trait']]
+        for cnt in range(10):
+            matrix.append(['M%s' % cnt, 1, cnt * 10, float(cnt % 5)])
+        genetic_map = [row[:3] for row in matrix[1:]]
+        result = analyze(matrix, genetic_map=genetic_map, lod_threshold=3)
+        self.assertEqual(result.genetic_map[0],
+                         ['Locus', 'Group', 'Position'])
+        self.assertEqual(result.matrix[5][-1], '1')
+        self.assertRaises(MQ2.MQ2Exception, analyze, matrix,
+                          lod_threshold='a')
+
     def test_plugin_valid_file(self):
         """ Test the valid_file method of the plugin.
         """
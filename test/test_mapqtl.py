@@ -26,9 +26,12 @@
  MQ² test script for the MapQTL plugin
 """
 
+import json
 import os
 import shutil
 import sys
+import tempfile
+import time
 import unittest
 
 from datetime import date
@@ -36,7 +39,11 @@ from datetime import date
 sys.path.insert(0, os.path.abspath('..'))
 
 import MQ2
+import MQ2.cache
+import MQ2.database
 import MQ2.mq2 as mq2
+from MQ2.distributed import LocalWorkers, analyze_shard, run_distributed
+from MQ2.workspace import Workspace
 
 
 TEST_INPUT_PASSED = os.path.join(
@@ -201,6 +208,355 @@ class MQ2MapQTLtests(unittest.TestCase):
                          read_file(os.path.join(
                             TEST_FOLDER, 'mapqtl', 'MapChart.exp')))
 
+    def test_run_mq2_profile(self):
+        """ Test the run_mq2 function with MapQTL zip input and the
+        profiling report.
+        """
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            profile = os.path.join(workspace.path, 'profile.json')
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir, profile=profile)
+            stream = open(profile)
+            report = json.load(stream)
+            stream.close()
+        self.assertEqual(len(report['stages']), 6)
+        self.assertEqual(len(report['files']), 2)
+        self.assertEqual(report['counts']['traits'], 2)
+        self.assertEqual(report['counts']['qtls'], 4)
+        for stage in report['stages']:
+            self.assertTrue(stage['wall_time'] >= 0)
+            self.assertTrue(stage['peak_memory'] > 0)
+
+    def test_run_mq2_incremental(self):
+        """ Test the run_mq2 function in incremental mode, adding a new
+        trait file to the session between two runs.
+        """
+        plugin_module = sys.modules['MQ2.plugins.mapqtl_plugin']
+        parse_mapqtl_file = plugin_module.parse_mapqtl_file
+        parsed = []
+
+        def _parse_mapqtl_file(filename, *args, **kwargs):
+            parsed.append(os.path.basename(filename))
+            return parse_mapqtl_file(filename, *args, **kwargs)
+
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            plugin_module.parse_mapqtl_file = _parse_mapqtl_file
+            try:
+                mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                            outputfolder=workspace.output_dir,
+                            incremental=True)
+                files = workspace.get_output_files()
+                for key, expected in [('qtls', 'qtls.exp'),
+                                      ('map', 'map.exp'),
+                                      ('matrix', 'qtls_matrix.exp'),
+                                      ('qtls_mk', 'qtls_with_mk.exp'),
+                                      ('map_chart', 'MapChart.exp')]:
+                    self.assertEqual(read_file(files[key]),
+                                     read_file(os.path.join(
+                                         TEST_FOLDER, 'mapqtl', expected)))
+                self.assertEqual(len(parsed), 2)
+
+                shutil.copy(
+                    os.path.join(folder, 'Session 2 (IM)_A_trait02.mqo'),
+                    os.path.join(folder, 'Session 2 (IM)_A_trait03.mqo'))
+                parsed[:] = []
+                mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                            outputfolder=workspace.output_dir,
+                            incremental=True)
+                self.assertEqual(parsed, ['Session 2 (IM)_A_trait03.mqo'])
+
+                # Nothing changed, nothing is parsed
+                parsed[:] = []
+                mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                            outputfolder=workspace.output_dir,
+                            incremental=True)
+                self.assertEqual(parsed, [])
+            finally:
+                plugin_module.parse_mapqtl_file = parse_mapqtl_file
+            matrix = MQ2.read_input_file(files['matrix'], sep=',')
+            self.assertEqual(
+                matrix[0], ['Locus', 'Group', 'Position', 'A_trait01',
+                            'A_trait02', 'A_trait03', '# QTLs'])
+            qtls = MQ2.read_input_file(files['qtls'], sep=',')
+            self.assertEqual(len(qtls), 7)
+
+            # Same outputs as a complete run
+            outputfolder = os.path.join(workspace.path, 'complete')
+            os.mkdir(outputfolder)
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=outputfolder)
+            complete = mq2.get_output_files(outputfolder)
+            for key in ['qtls', 'map', 'matrix', 'qtls_mk', 'map_qtl',
+                        'map_chart']:
+                self.assertEqual(read_file(files[key]),
+                                 read_file(complete[key]))
+
+    def test_parse_mapqtl_file(self):
+        """ Test the parse_mapqtl_file function against the parsing of the
+        whole file in memory.
+        """
+        plugin_module = sys.modules['MQ2.plugins.mapqtl_plugin']
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            filename = sorted(plugin.get_files(folder, session_id=2))[0]
+            matrix = MQ2.read_input_file(filename)
+            headers, lods, qtls, fingerprint, rows = \
+                plugin_module.parse_mapqtl_file(filename, 3, keep_map=True)
+            self.assertEqual(headers, matrix[0])
+            self.assertEqual(
+                lods, [row[4] for row in matrix[1:]])
+            self.assertEqual(qtls, plugin_module.get_qtls_from_mapqtl_data(
+                MQ2.read_input_file(filename), 3, filename))
+            self.assertEqual(rows, [row[:4] for row in matrix])
+            self.assertEqual(fingerprint,
+                             plugin_module.get_map_fingerprint(matrix))
+
+            # A truncated row is reported
+            truncated = os.path.join(workspace.path,
+                                     'Session 2 (IM)_A_trait09.mqo')
+            with open(filename) as stream:
+                lines = stream.readlines()
+            lines[3] = '\t'.join(lines[3].split('\t')[:3]) + '\n'
+            with open(truncated, 'w') as stream:
+                stream.writelines(lines)
+            self.assertRaises(MQ2.MQ2Exception,
+                              plugin_module.parse_mapqtl_file, truncated, 3)
+
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=os.path.join(TEST_FOLDER, 'invalid',
+                                      'Demo_mapqtl_kw.zip'),
+                extract_dir=os.path.join(workspace.path, 'kw'))
+            filename = sorted(plugin.get_files(folder))[0]
+            self.assertRaises(MQ2.MQ2Exception,
+                              plugin_module.parse_mapqtl_file, filename, 3)
+
+    def test_run_mq2_cache(self):
+        """ Test the run_mq2 function with the result cache, the second
+        run with the same input and settings is restored from the cache.
+        """
+        with Workspace() as workspace:
+            cache_dir = os.path.join(workspace.path, 'cache')
+            profile = os.path.join(workspace.path, 'profile.json')
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir,
+                        cache_dir=cache_dir, cleanup=False)
+            files = workspace.get_output_files()
+            expected = dict([(key, read_file(filename))
+                             for key, filename in files.items()])
+            for filename in files.values():
+                os.unlink(filename)
+
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir,
+                        cache_dir=cache_dir, profile=profile,
+                        cleanup=False)
+            stream = open(profile)
+            report = json.load(stream)
+            stream.close()
+            self.assertEqual(len(report['stages']), 1)
+            for key, filename in files.items():
+                self.assertEqual(read_file(filename), expected[key])
+
+            # An entry missing one of its outputs is not restored
+            entries = [os.path.join(cache_dir, prefix, entry)
+                       for prefix in os.listdir(cache_dir)
+                       if not prefix.startswith('.')
+                       for entry in os.listdir(
+                           os.path.join(cache_dir, prefix))]
+            self.assertEqual(len(entries), 1)
+            os.unlink(os.path.join(entries[0], 'qtls'))
+            os.unlink(files['qtls'])
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir,
+                        cache_dir=cache_dir, profile=profile,
+                        cleanup=False)
+            stream = open(profile)
+            report = json.load(stream)
+            stream.close()
+            self.assertTrue(len(report['stages']) > 1)
+            for key, filename in files.items():
+                self.assertEqual(read_file(filename), expected[key])
+            self.assertTrue(os.path.exists(os.path.join(entries[0], 'qtls')))
+
+            # The temporary folders left over by an interrupted process
+            # are removed, not those still being written
+            prefix = os.path.dirname(entries[0])
+            stale = tempfile.mkdtemp(
+                prefix='.', suffix=MQ2.cache.TMP_SUFFIX, dir=prefix)
+            mtime = time.time() - MQ2.cache.STALE_TMP_AGE - 1
+            os.utime(stale, (mtime, mtime))
+            current = tempfile.mkdtemp(
+                prefix='.', suffix=MQ2.cache.TMP_SUFFIX, dir=prefix)
+
+            # Another LOD threshold is another entry of the cache
+            mq2.run_mq2(plugin, folder, lod_threshold=4, session=2,
+                        outputfolder=workspace.output_dir,
+                        cache_dir=cache_dir, cache_size=0)
+            self.assertNotEqual(read_file(files['qtls']), expected['qtls'])
+            self.assertFalse(os.path.exists(stale))
+            self.assertTrue(os.path.exists(current))
+            os.rmdir(current)
+            # With a size of 0 MB every entry is evicted
+            self.assertEqual(
+                [entry for entry in os.listdir(cache_dir)
+                 if not entry.startswith('.')
+                 and os.listdir(os.path.join(cache_dir, entry))], [])
+
+    def test_run_mq2_hotspot(self):
+        """ Test the run_mq2 function assessing the significance of the
+        QTL hotspots.
+        """
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir,
+                        hotspot_permutations=100, hotspot_seed=1)
+            files = workspace.get_output_files()
+            markers = MQ2.read_input_file(files['map_qtl'], sep=',')
+            self.assertEqual(
+                markers[0], ['Locus', 'Group', 'Position', '# QTLs',
+                             'Window QTLs', 'Hotspot threshold',
+                             'Significant'])
+            self.assertEqual(len(set([row[-2] for row in markers[1:]])), 1)
+            self.assertEqual(read_file(files['qtls_mk']),
+                             read_file(os.path.join(
+                                TEST_FOLDER, 'mapqtl', 'qtls_with_mk.exp')))
+
+            # The QTLs counted on their interval cannot be permuted
+            self.assertRaises(MQ2.MQ2Exception, mq2.run_mq2, plugin, folder,
+                              lod_threshold=3, session=2,
+                              outputfolder=workspace.output_dir,
+                              hotspot_permutations=100, count_intervals=True)
+
+    def test_run_mq2_lod_store(self):
+        """ Test the run_mq2 function with MapQTL zip input and the LOD
+        values kept in a LOD store.
+        """
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            lod_store = os.path.join(workspace.path, 'lods.bin')
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir,
+                        lod_store=lod_store)
+            files = workspace.get_output_files()
+            for key, expected in [('qtls', 'qtls.exp'),
+                                  ('map', 'map.exp'),
+                                  ('matrix', 'qtls_matrix.exp'),
+                                  ('map_qtl', 'map_with_qtls.exp'),
+                                  ('qtls_mk', 'qtls_with_mk.exp'),
+                                  ('map_chart', 'MapChart.exp')]:
+                self.assertEqual(read_file(files[key]),
+                                 read_file(os.path.join(
+                                     TEST_FOLDER, 'mapqtl', expected)))
+            self.assertTrue(os.path.exists(lod_store))
+
+    def test_run_distributed(self):
+        """ Test analyzing a MapQTL session in shards sent to local
+        workers.
+        """
+        with Workspace() as workspace, LocalWorkers(2) as workers:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            files = run_distributed(folder, workers.urls, session=2,
+                                    lod_threshold=3,
+                                    outputfolder=workspace.output_dir,
+                                    nr_shards=3)
+            for key, expected in [('qtls', 'qtls.exp'),
+                                  ('map', 'map.exp'),
+                                  ('matrix', 'qtls_matrix.exp'),
+                                  ('map_qtl', 'map_with_qtls.exp'),
+                                  ('qtls_mk', 'qtls_with_mk.exp'),
+                                  ('map_chart', 'MapChart.exp')]:
+                self.assertEqual(read_file(files[key]),
+                                 read_file(os.path.join(
+                                     TEST_FOLDER, 'mapqtl', expected)))
+            self.assertRaises(MQ2.MQ2NoSuchSessionException,
+                              run_distributed, folder, workers.urls,
+                              session=5, lod_threshold=3)
+
+            # The LOD values of a shard are only written in its slice of
+            # the QTL matrix
+            filename = sorted(plugin.get_files(folder, session_id=2))[0]
+            with open(filename) as stream:
+                content = stream.read()
+            matrix_file = os.path.join(workspace.path, 'slice.csv')
+            result = analyze_shard(
+                [(os.path.basename(filename), content)], 2, 3, matrix_file)
+            self.assertEqual(result['traits'], ['A_trait01'])
+            self.assertNotIn('lods', result)
+            matrix = MQ2.read_input_file(files['matrix'], sep=',')
+            self.assertEqual(MQ2.read_input_file(matrix_file, sep=','),
+                             [row[3:4] for row in matrix])
+
+    def test_run_mq2_database(self):
+        """ Test the run_mq2 function adding the results to a database and
+        the queries of the database.
+        """
+        with Workspace() as workspace:
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED, extract_dir=workspace.input_dir)
+            database = os.path.join(workspace.path, 'results.sqlite')
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir,
+                        database=database, run_name='run1', cleanup=False)
+            mq2.run_mq2(plugin, folder, lod_threshold=4, session=2,
+                        outputfolder=workspace.output_dir,
+                        database=database, run_name='run2')
+
+            runs = MQ2.database.get_runs(database)
+            self.assertEqual(
+                runs[0], ['id', 'name', 'created', 'plugin', 'session',
+                          'lod_threshold', 'count_intervals', 'version',
+                          'nr_qtls'])
+            self.assertEqual([row[1] for row in runs[1:]], ['run1', 'run2'])
+            self.assertEqual([row[4] for row in runs[1:]], ['2', '2'])
+            self.assertEqual([row[6] for row in runs[1:]], [0, 0])
+            self.assertEqual([row[8] for row in runs[1:]], [4, 1])
+
+            qtls = MQ2.database.find_qtls_near_marker(
+                database, 'P11M48-215', distance=10)
+            self.assertEqual(
+                [row[:6] for row in qtls[1:]],
+                [('run1', 'A_trait02', 'P08', 68.223, 'E35M49-199', 3.61)])
+
+            qtls = MQ2.database.find_qtls_in_region(database, 'U', 0, 100)
+            self.assertEqual(
+                [row[:6] for row in qtls[1:]],
+                [('run1', 'A_trait01', 'U', 61.884, 'P17M32-222', 6.44),
+                 ('run2', 'A_trait01', 'U', 61.884, 'P17M32-222', 6.44)])
+
+            hotspots = MQ2.database.get_hotspots(database, min_qtls=2)
+            self.assertEqual(hotspots[0], ['marker', 'linkage_group',
+                                           'position', 'nr_qtls',
+                                           'nr_runs'])
+            self.assertEqual(hotspots[1][:2], ('P17M32-222', 'U'))
+            self.assertEqual(hotspots[1][4], 2)
+
+            # Without name, the run is named after the input files of the
+            # temporary folder removed once it is finished
+            database = os.path.join(workspace.path, 'intervals.sqlite')
+            plugin, folder = mq2.get_plugin_and_folder(
+                inputzip=TEST_INPUT_PASSED,
+                extract_dir=MQ2.set_tmp_folder(workspace.path))
+            mq2.run_mq2(plugin, folder, lod_threshold=3, session=2,
+                        outputfolder=workspace.output_dir,
+                        database=database, count_intervals=True)
+            self.assertFalse(os.path.exists(folder))
+            runs = MQ2.database.get_runs(database)
+            self.assertEqual(
+                runs[1][1],
+                'Session 2 (IM)_A_trait01.mqo and 1 other files')
+            self.assertEqual(runs[1][6], 1)
+
     def test_plugin_valid_file(self):
         """ Test the valid_file method of the plugin.
         """
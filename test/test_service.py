@@ -0,0 +1,172 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+ MQ² test script for the service mode
+"""
+
+import json
+import os
+import sys
+import threading
+import unittest
+
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.abspath('..'))
+
+from MQ2.service import MQ2Service, make_server
+
+
+TEST_INPUT_PASSED = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'mapqtl', 'Demoset1.zip')
+
+TEST_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_file(filename):
+    """ Reads in a file for a given filename and just return the
+    content.
+    """
+    stream = open(filename)
+    data = stream.read()
+    stream.close()
+    return data
+
+
+class MQ2Servicetests(unittest.TestCase):
+    """ MQ² tests for the service mode. """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Start the service once for all the tests. """
+        cls.service = MQ2Service(workers=1, max_queue=5)
+        cls.server = make_server(cls.service)
+        cls.url = 'http://localhost:%s' % cls.server.server_address[1]
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Stop the service. """
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.service.shutdown()
+
+    def _request(self, path, data=None, method=None,
+                 content_type='application/json'):
+        """ Send a request to the service and return the decoded answer.
+        """
+        request = Request(self.url + path, data=data, method=method)
+        if data is not None:
+            request.add_header('Content-Type', content_type)
+        stream = urlopen(request)
+        output = stream.read()
+        stream.close()
+        return output
+
+    def test_status(self):
+        """ Test the status end-point. """
+        output = json.loads(self._request('/status').decode('utf-8'))
+        self.assertEqual(output['workers'], 1)
+        self.assertEqual(output['max_queue'], 5)
+
+    def test_sessions(self):
+        """ Test the sessions end-point. """
+        output = json.loads(self._request(
+            '/sessions?path=%s' % TEST_INPUT_PASSED).decode('utf-8'))
+        self.assertEqual(output['plugin'], 'MapQTL plugin')
+        self.assertEqual(output['sessions'], ['2'])
+
+        stream = open(TEST_INPUT_PASSED, 'rb')
+        output = json.loads(self._request(
+            '/sessions', data=stream.read(),
+            content_type='application/zip').decode('utf-8'))
+        stream.close()
+        self.assertEqual(output['sessions'], ['2'])
+
+    def test_job(self):
+        """ Test submitting a job and retrieving its results. """
+        data = json.dumps(
+            {'zipfile': TEST_INPUT_PASSED, 'lod': 3, 'session': 2})
+        job = json.loads(self._request(
+            '/jobs', data=data.encode('utf-8')).decode('utf-8'))
+        job = json.loads(self._request(
+            '/jobs/%s?wait=30' % job['id']).decode('utf-8'))
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['plugin'], 'MapQTL plugin')
+        self.assertEqual(len(job['results']), 6)
+
+        output = self._request(
+            '/jobs/%s/results/MapChart.map' % job['id']).decode('utf-8')
+        self.assertEqual(output, read_file(
+            os.path.join(TEST_FOLDER, 'mapqtl', 'MapChart.exp')))
+
+        self._request('/jobs/%s' % job['id'], method='DELETE')
+        self.assertRaises(
+            HTTPError, self._request, '/jobs/%s' % job['id'])
+
+    def test_job_upload_failed(self):
+        """ Test submitting an uploaded archive with an invalid session.
+        """
+        stream = open(TEST_INPUT_PASSED, 'rb')
+        job = json.loads(self._request(
+            '/jobs?lod=3&session=1', data=stream.read(),
+            content_type='application/zip').decode('utf-8'))
+        stream.close()
+        job = json.loads(self._request(
+            '/jobs/%s?wait=30' % job['id']).decode('utf-8'))
+        self.assertEqual(job['status'], 'failed')
+        self.assertTrue('could not be found' in job['error'])
+        self._request('/jobs/%s' % job['id'], method='DELETE')
+
+    def test_job_retention(self):
+        """ Test removing the oldest finished jobs and their files above
+        the maximum number of jobs kept, and those kept for too long.
+        """
+        service = MQ2Service(workers=1, max_jobs=1, job_ttl=None)
+        try:
+            jobs = []
+            for cnt in range(2):
+                jobs.append(service.submit(
+                    lod_threshold=3, session=2, inputzip=TEST_INPUT_PASSED))
+                jobs[-1].future.result(timeout=30)
+            self.assertEqual(service.expire_jobs(), [jobs[0].job_id])
+            self.assertTrue(service.get_job(jobs[0].job_id) is None)
+            self.assertFalse(os.path.exists(jobs[0].workspace.path))
+            self.assertEqual(service.get_job(jobs[1].job_id), jobs[1])
+
+            service.job_ttl = 0
+            self.assertEqual(service.expire_jobs(), [jobs[1].job_id])
+            self.assertFalse(os.path.exists(jobs[1].workspace.path))
+        finally:
+            service.shutdown()
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(MQ2Servicetests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -37,6 +37,7 @@ sys.path.insert(0, os.path.abspath('..'))
 
 import MQ2
 import MQ2.mq2 as mq2
+from MQ2.workspace import Workspace
 
 
 TEST_INPUT_PASSED = os.path.join(
@@ -224,6 +225,47 @@ class MQ2MapQTLtests(unittest.TestCase):
                          #read_file(os.path.join(
                             #TEST_FOLDER, 'xls', 'MapChart.exp')))
 
+    def test_run_mq2_max_memory(self):
+        """ Test the run_mq2 function from an excel file with a memory
+        budget, the output is the same as without budget.
+        """
+        outputs = []
+        for max_memory in [None, 0.001]:
+            with Workspace() as workspace:
+                plugin, folder = mq2.get_plugin_and_folder(
+                    inputfile=TEST_INPUT_FILE)
+                mq2.run_mq2(plugin, TEST_INPUT_FILE, lod_threshold=3,
+                            session='Sheet1',
+                            outputfolder=workspace.output_dir,
+                            max_memory=max_memory)
+                outputs.append(dict(
+                    [(key, read_file(filename)) for key, filename in
+                     workspace.get_output_files().items()]))
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_run_mq2_sparse(self):
+        """ Test the run_mq2 function from an excel file with only the
+        LOD values above a floor kept, along with a LOD store or a memory
+        budget, the output is the same as with all the values.
+        """
+        outputs = []
+        for kwargs in [{}, {'sparse': True, 'lod_store': 'lods.bin'},
+                       {'sparse': True, 'max_memory': 0.001}]:
+            with Workspace() as workspace:
+                if 'lod_store' in kwargs:
+                    kwargs['lod_store'] = os.path.join(
+                        workspace.path, kwargs['lod_store'])
+                plugin, folder = mq2.get_plugin_and_folder(
+                    inputfile=TEST_INPUT_FILE)
+                mq2.run_mq2(plugin, TEST_INPUT_FILE, lod_threshold=3,
+                            session='Sheet1',
+                            outputfolder=workspace.output_dir, **kwargs)
+                outputs.append(dict(
+                    [(key, read_file(filename)) for key, filename in
+                     workspace.get_output_files().items()]))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
     def test_plugin_valid_file(self):
         """ Test the valid_file method of the plugin.
         """